@@ -7,6 +7,18 @@ First argument changes the 'environment'. Options:
   email - Run over email
   email_daemon - Run email in background, giving A.I. 30m per turn
     (in background, detached from terminal, output in log.txt)
+    An optional second argument changes the time per turn,
+    a third how many games to play at once (e.g. email_daemon 30m 5),
+    and a fourth 'skill' to have stockfish limit its own strength
+    (much cheaper than ranking every move, e.g. email_daemon 30m 5 skill)
+    and a fifth 'metrics' to serve the timings on http://127.0.0.1:9108/metrics
+    (they are always written to assets/metrics.jsonl,
+    e.g. email_daemon 30m 5 sample metrics)
+  analyse - Print stockfish's best moves for a board and quit
+    (e.g. analyse "<fen>" [seconds], by default the starting board)
+  review - Review finished games (by default, the journal archive) at a low
+    priority, writing them annotated to assets/review.pgn
+    (e.g. review assets/tournament.pgn --depth 14 --workers 2)
   kill - kill any currently running email daemons
   find - display PID of any currently running email daemons
 """
@@ -28,6 +40,15 @@ function email_chess {
   python3 src/main.py email
 }
 
+function analyse_chess {
+  # Analyse a single board, then quit (quick, so handy from scripts)
+  python3 src/main.py analyse "${@:2}"
+}
+
+function review_chess {
+  # Review finished games (picking up where the last review left off)
+  python3 src/review.py "${@:2}"
+}
 
 function email_daemon_chess {
   # Run the email chess in this a nohup shell, gives ai player 30m to think
@@ -43,7 +64,10 @@ function email_daemon_chess {
   # > redirects stdout AND stderr to log.txt,
   # and the '&' says run in bg)
   TIME=${2:-'30m'}
-  nohup python3 -u src/main.py email $TIME > log.txt &
+  GAMES=${3:-'1'}
+  STRENGTH=${4:-''}
+  METRICS=${5:-''}
+  nohup python3 -u src/main.py email $TIME $GAMES $STRENGTH $METRICS > log.txt &
   sleep 1
   echo "Done! Tailing the logs, you can ctrl+c at any time, and daemon will continue."
   tail -f log.txt
@@ -51,8 +75,8 @@ function email_daemon_chess {
 
 function find_previous {
   # Return the PIDs of any currently running email daemons
-  # TODO: this prevents two games on the same system...
-  # Hmm.. want to fix that, not sure what is robust enough
+  # (one daemon can play several games at once, so there should
+  # only ever be the one)
   if [ "$2" = "all" ]; then
     PAST_PIDS=$(ps aux | grep -i 'python3 src/main.py' | grep -v "grep" | awk '{print $2}') || true
   else
@@ -92,6 +116,8 @@ case $env in
   local) local_chess $@;;
   email) email_chess $@;;
   email_daemon) email_daemon_chess $@;;
+  analyse) analyse_chess "$@";;
+  review) review_chess "$@";;
   kill) kill_previous $@;;
   find) print_previous $@;;
   *) echo -e "Unknown env: '$env'.\n$help_text" ;;
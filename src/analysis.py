@@ -0,0 +1,94 @@
+class MoveAnalysis():
+    """
+    What stockfish thinks of a single move:
+    its score (from the point of view of the player making it),
+    how deep it was searched, the line stockfish expects to follow
+    (starting with the move itself), and how many nodes were searched.
+    Anything stockfish didn't tell us is None
+    """
+
+    __slots__ = ('move', 'score', 'depth', 'pv', 'nodes')
+
+    def __init__(self, move, score=None, depth=None, pv=None, nodes=None):
+        self.move = move
+        self.score = score
+        self.depth = depth
+        self.pv = pv if pv is not None else [move]
+        self.nodes = nodes
+
+    @classmethod
+    def from_info(cls, info):
+        """
+        Create from one of stockfish's (multipv) info dicts
+        """
+        return cls(info['pv'][0], info['score'].relative, info.get('depth'),
+                   list(info['pv']), info.get('nodes'))
+
+    def reply(self):
+        """
+        Return the reply stockfish expects after this move (or None)
+        """
+        return self.pv[1] if len(self.pv) > 1 else None
+
+    def __repr__(self):
+        return (f'MoveAnalysis({self.move}, score={self.score}, '
+                f'depth={self.depth}, nodes={self.nodes})')
+
+
+class TurnAnalysis():
+    """
+    Everything a player worked out about the moves it could make this turn,
+    ranked best move first, so deciding what to play (or whether to resign)
+    never needs another search.
+    Players keep the latest one as their 'analysis',
+    so the referee (and other players) can see it
+    """
+
+    def __init__(self, fen, moves, source='engine', elapsed=0):
+        """
+        Given the board (fen) that was analysed, the MoveAnalysis of each
+        legal move (in any order), where the scores came from
+        (engine, ponder, cache, or forced), and how long it took (in seconds)
+        """
+        self.fen = fen
+        self.source = source
+        self.elapsed = elapsed
+
+        # Best first, unscored moves last
+        # (ties keep the order they were given in)
+        scored = [m for m in moves if m.score is not None]
+        unscored = [m for m in moves if m.score is None]
+        self.lines = (sorted(scored, key=lambda m: m.score, reverse=True) +
+                      unscored)
+
+    def moves(self):
+        """
+        Return just the moves, best first
+        """
+        return [line.move for line in self.lines]
+
+    def best(self):
+        """
+        Return the MoveAnalysis of the best move
+        """
+        return self.lines[0]
+
+    def get(self, move):
+        """
+        Return the MoveAnalysis of the given move (or None)
+        """
+        for line in self.lines:
+            if line.move == move:
+                return line
+        return None
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __repr__(self):
+        return (f'TurnAnalysis({self.fen!r}, {len(self.lines)} moves, '
+                f'best={self.best() if self.lines else None}, '
+                f'source={self.source})')
@@ -0,0 +1,189 @@
+import asyncio
+import sys
+from abc import ABC, abstractmethod
+
+from player import QueuePlayer
+
+
+class AsyncPlayer(ABC):
+    """
+    Like Player, but for games driven as coroutines (see AsyncReferee):
+    getting a move (and hearing the opponent's) can be awaited, so
+    a player waiting on someone (e.g. an email) doesn't hold up
+    any other game, nor need a thread of its own
+    """
+
+    referee = None
+    name = None
+    analysis = None
+
+    def prep(self, referee, name):
+        """
+        Before the referee starts play, it will set these values
+        """
+        self.referee = referee
+        self.name = name
+
+    @abstractmethod
+    async def get_move(self):
+        """
+        Return a UCI chess move string (or a code), as Player.get_move
+        """
+        pass
+
+    @abstractmethod
+    async def hear_move(self, move):
+        """
+        The other player has made a move
+        """
+        pass
+
+    def ponder(self):
+        """
+        It is the other player's turn (must return right away)
+        """
+        pass
+
+    @abstractmethod
+    def hear(self, s):
+        pass
+
+    @abstractmethod
+    def win(self):
+        pass
+
+    @abstractmethod
+    def lose(self):
+        pass
+
+    @abstractmethod
+    def draw(self):
+        pass
+
+    def identity(self):
+        """
+        Who this player is, as Player.identity
+        """
+        return self.__class__.__name__
+
+    def __str__(self):
+        return f'{self.__class__.__name__} - {self.name}'
+
+
+class PlayerAdapter(AsyncPlayer):
+    """
+    Lets any (synchronous) Player play in an async game.
+    Getting a move runs on a worker thread (by default), so a player
+    that blocks (e.g. on input, or on stockfish searching) only ties up
+    that thread, not the event loop
+    """
+
+    def __init__(self, player, threaded=True):
+        """
+        A player whose get_move returns right away (e.g. a QueuePlayer)
+        doesn't need a thread
+        """
+        self.wrapped = player
+        self.threaded = threaded
+        # Starting to ponder, on a worker thread (see ponder)
+        self.pondering = None
+
+    def prep(self, referee, name):
+        super().prep(referee, name)
+        self.wrapped.prep(referee, name)
+
+    @property
+    def analysis(self):
+        return self.wrapped.analysis
+
+    async def get_move(self):
+        # (once pondering has started, it can be stopped as usual)
+        if self.pondering is not None:
+            pondering, self.pondering = self.pondering, None
+            await pondering
+        if self.threaded:
+            return await asyncio.to_thread(self.wrapped.get_move)
+        return self.wrapped.get_move()
+
+    async def hear_move(self, move):
+        self.wrapped.hear_move(move)
+
+    def ponder(self):
+        # (starting to ponder may start an engine, which mustn't hold up
+        # the event loop, so a threaded player starts on a worker thread)
+        if not self.threaded:
+            self.wrapped.ponder()
+            return
+        self.pondering = asyncio.get_running_loop().run_in_executor(
+            None, self.wrapped.ponder)
+
+    def hear(self, s):
+        self.wrapped.hear(s)
+
+    def win(self):
+        self.wrapped.win()
+
+    def lose(self):
+        self.wrapped.lose()
+
+    def draw(self):
+        self.wrapped.draw()
+
+    def checkpoint(self):
+        return self.wrapped.checkpoint()
+
+    def identity(self):
+        return self.wrapped.identity()
+
+    def __str__(self):
+        return str(self.wrapped)
+
+
+class AsyncInbox():
+    """
+    A queue of emails that the mail router (on its own thread) puts
+    emails on, and a coroutine can wait on (without a thread of its own)
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, message):
+        """
+        Hand over an email (from the router's thread), returning False
+        if the loop has closed (so there is no-one left to hand it to)
+        """
+        if self.loop.is_closed():
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+        except RuntimeError:
+            # (the loop closed since we checked)
+            return False
+        return True
+
+    async def get(self):
+        return await self.queue.get()
+
+    def get_nowait(self):
+        return self.queue.get_nowait()
+
+
+def adapt(player):
+    """
+    Return an async version of a player (which is left as is,
+    if it already is one)
+    """
+    if isinstance(player, AsyncPlayer):
+        return player
+    # (email players are only imported if we have one, as they import
+    # us, so if there is one, its module is already imported)
+    email_player = sys.modules.get('email_player')
+    if email_player is not None and isinstance(player,
+                                               email_player.EmailPlayer):
+        return email_player.AsyncEmailPlayer(player)
+    # Queue players never block
+    if isinstance(player, QueuePlayer):
+        return PlayerAdapter(player, threaded=False)
+    return PlayerAdapter(player)
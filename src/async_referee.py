@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+from referee import Referee
+from async_player import adapt
+from game_state import Ply
+
+
+class AsyncReferee(Referee):
+    """
+    A referee whose games are coroutines, so many games can be played
+    at once on a single event loop (each only waking up when one of its
+    players has a move for it).
+    Any player can play (sync players are adapted, see async_player.adapt).
+    Anything that writes to disk (the journal, the checkpoint, emails
+    being spooled) runs on a worker thread, so one slow write doesn't
+    hold up every game
+    """
+
+    def __init__(self, white_player, black_player, journal=None,
+                 checkpoint=None):
+        super().__init__(adapt(white_player), adapt(black_player),
+                         journal=journal, checkpoint=checkpoint)
+
+    async def play_game(self, board=None, resume=False):
+        """
+        Play a single game of chess, as Referee.play_game
+        """
+        await asyncio.to_thread(self.begin_game, board, resume)
+        while self.running and not self.board.is_game_over():
+            # Let whoever is waiting make use of the time
+            self.opponent().ponder()
+            start = time.monotonic()
+            move = await self.get_move()
+            await self.play_move(move, time.monotonic() - start)
+        await asyncio.to_thread(self.finish_game)
+
+    async def get_move(self):
+        """
+        Wait on a move from the active player, as Referee.get_move
+        """
+        while True:
+            move = self.take_input(await self.active_player().get_move())
+            if move is not None:
+                return move
+
+    async def play_move(self, move, seconds):
+        """
+        Play the active player's move, as Referee.play_move
+        """
+        # Keep what the player thought of the move (if anything)
+        self.analysis = self.active_player().analysis
+        self.record_ply(move, seconds)
+        self.game.push(move, Ply.from_analysis(seconds, self.analysis))
+        await self.active_player().hear_move(move)
+
+        await asyncio.to_thread(self.commit_fen, move)
+
+
+def play_games(referees):
+    """
+    Play a game on each of the given (async) referees, all at once,
+    returning once they have all finished
+    """
+    async def play_all():
+        await asyncio.gather(*(referee.play_game() for referee in referees))
+    asyncio.run(play_all())
@@ -0,0 +1,387 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import chess
+import chess.pgn
+
+import engine_pool
+import eval_cache
+import opening_book
+import store
+import tablebase
+from journal import Journal, MemoryJournal
+from player import QueuePlayer
+from referee import Referee
+from stockfish_player import StockfishPlayer
+
+POSITIONS_FILE = 'assets/bench-positions.epd'
+GAMES_FILE = 'assets/bench-games.pgn'
+
+# A change of less than this (either way) is just noise
+NOISE = 0.05
+
+# The ways main.py can be started (see main.prepare, and main.analyse)
+STARTUP_MODES = ('local', 'fishes', 'email', 'analyse')
+
+
+class Benchmark():
+    """
+    Times the hot paths of the program (ranking moves, translating moves,
+    checking moves, writing to the journal and store, and playing
+    whole games) over fixed sets of positions and games, so runs on
+    different code (or machines) can be compared.
+    Every result is a dict of metric name to value, where names ending in
+    '_per_sec' are better higher, and all others (times) better lower
+    """
+
+    def __init__(self, positions_file=POSITIONS_FILE, games_file=GAMES_FILE,
+                 nodes=200000, repeat=3):
+        """
+        Each position is ranked with the given number of nodes,
+        and the quicker benchmarks are run 'repeat' times
+        (taking the best time)
+        """
+        self.positions = read_positions(positions_file)
+        self.games = read_games(games_file)
+        self.nodes = nodes
+        self.repeat = repeat
+
+        self.referee = Referee(QueuePlayer([]), QueuePlayer([]),
+                               journal=MemoryJournal())
+        self.referee.board = chess.Board()
+
+    def run(self, only=None):
+        """
+        Run the benchmarks (all of them, or just those named),
+        returning a dict of benchmark name to its results
+        """
+        benchmarks = {
+            'rank': self.bench_rank,
+            'english': self.bench_english,
+            'validation': self.bench_validation,
+            'storage': self.bench_storage,
+            'games': self.bench_games,
+            'startup': self.bench_startup,
+        }
+        results = {}
+        for name, bench in benchmarks.items():
+            if only and name not in only:
+                continue
+            print(f'Running {name}...', file=sys.stderr)
+            results[name] = bench()
+        return results
+
+    def best_time(self, func):
+        """
+        Return the quickest of 'repeat' runs of a function (in seconds)
+        """
+        times = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def bench_rank(self):
+        """
+        How quickly stockfish ranks every move of each position
+        (with a fixed number of nodes, and nothing cached)
+        """
+        # Only the engine is being measured, so no book or tables
+        opening_book.BOOK = opening_book.OpeningBook(None, None)
+        tablebase.TABLEBASE = tablebase.Tablebase(None)
+        eval_cache.CACHE = eval_cache.EvalCache(None)
+
+        player = StockfishPlayer(
+            difficulty=1, turn_time=timedelta(minutes=10), persist=False,
+            can_ponder=False, nodes=self.nodes)
+        player.prep(self.referee, 'white')
+
+        times, nodes = [], 0
+        try:
+            for board in self.positions:
+                self.referee.board = board.copy()
+                start = time.perf_counter()
+                player.get_sorted_moves()
+                times.append(time.perf_counter() - start)
+                nodes += player.analysis.best().nodes or 0
+                player.release_stockfish()
+        finally:
+            engine_pool.POOL.close()
+        return {
+            'rank_mean_s': statistics.mean(times),
+            'rank_max_s': max(times),
+            'nodes_per_sec': nodes / sum(times),
+        }
+
+    def bench_english(self):
+        """
+        How many moves a second are translated to English
+        (each board, and each legal move on it, as typed in)
+        """
+        inputs = [(board, move.uci()) for board in self.positions
+                  for move in board.legal_moves]
+        parser = self.referee.parser
+
+        def translate():
+            # (not the remembered translations, the real work)
+            parser.translations.clear()
+            for board, move in inputs:
+                self.referee.board = board
+                parser.move_to_english(move)
+        return {'english_per_sec': len(inputs) / self.best_time(translate)}
+
+    def bench_validation(self):
+        """
+        How many moves a second the referee checks
+        (every legal move, and every move of a piece to any square)
+        """
+        inputs = []
+        for board in self.positions:
+            for square in chess.SquareSet(board.occupied_co[board.turn]):
+                for to_square in chess.SQUARES:
+                    if to_square != square:
+                        inputs.append((board, chess.square_name(square) +
+                                       chess.square_name(to_square)))
+
+        def validate():
+            for board, move in inputs:
+                self.referee.board = board
+                self.referee.check_move(move)
+        return {'checks_per_sec': len(inputs) / self.best_time(validate)}
+
+    def bench_storage(self):
+        """
+        How long committing a move to the journal, and updating a
+        difficulty in the store, take (in a scratch folder, so no real
+        files are touched)
+        """
+        folder = tempfile.mkdtemp()
+        journal = Journal(os.path.join(folder, 'journal.txt'))
+        self.referee.journal = journal
+        commit_times = []
+        for game in self.games:
+            board = game.board()
+            self.referee.board = board
+            journal.start_game(board.fen())
+            for move in game.mainline_moves():
+                board.push(move)
+                start = time.perf_counter()
+                self.referee.commit_fen(move)
+                commit_times.append(time.perf_counter() - start)
+            journal.end_game(game.headers['Result'], board.fen())
+        journal.close()
+
+        saves = store.Store(os.path.join(folder, 'store.db'))
+        save_times = []
+        try:
+            for i in range(100):
+                start = time.perf_counter()
+                saves.adjust(store.opponent_scope(f'bench-{i % 10}'),
+                             'difficulty', 0.02, default=0.5, low=0, high=1)
+                save_times.append(time.perf_counter() - start)
+        finally:
+            saves.close()
+
+        return {
+            'commit_fen_mean_ms': statistics.mean(commit_times) * 1000,
+            'commit_fen_p95_ms': percentile(commit_times, 95) * 1000,
+            'save_update_mean_ms': statistics.mean(save_times) * 1000,
+            'save_update_p95_ms': percentile(save_times, 95) * 1000,
+        }
+
+    def bench_games(self):
+        """
+        How quickly whole games are played through the referee
+        (replaying the fixed games with QueuePlayers, journal and all)
+        """
+        folder = tempfile.mkdtemp()
+        journal = Journal(os.path.join(folder, 'journal.txt'))
+        plies = sum(len(list(game.mainline_moves())) for game in self.games)
+
+        def play():
+            for game in self.games:
+                moves = [move.uci() for move in game.mainline_moves()]
+                white = QueuePlayer(moves[0::2])
+                black = QueuePlayer(moves[1::2])
+                referee = Referee(white, black, journal=journal)
+                referee.play_game(game.board())
+        # (the players print every move, which isn't what we are timing)
+        with contextlib.redirect_stdout(io.StringIO()):
+            best = self.best_time(play)
+        journal.close()
+        return {
+            'games_per_sec': len(self.games) / best,
+            'plies_per_sec': plies / best,
+        }
+
+    def bench_startup(self):
+        """
+        How long main.py takes to start up in each mode (in a fresh
+        process, importing and setting up everything short of playing),
+        and to analyse a board (searching as briefly as it can)
+        """
+        results = {}
+        for mode in STARTUP_MODES:
+            command = startup_command(mode)
+
+            def start():
+                subprocess.run(command, check=True,
+                               stdout=subprocess.DEVNULL)
+            results[f'startup_{mode}_ms'] = self.best_time(start) * 1000
+        return results
+
+
+def startup_command(mode, fen=chess.STARTING_FEN):
+    """
+    Return the command that starts main.py up in the given mode
+    (without playing any games)
+    """
+    if mode == 'analyse':
+        return [sys.executable, 'src/main.py', 'analyse', fen, '0.01']
+    code = (f'import sys; sys.argv = ["main.py", "{mode}"]; '
+            f'sys.path.insert(0, "src"); '
+            f'import main; main.prepare("{mode}")')
+    return [sys.executable, '-c', code]
+
+
+def import_profile(mode, top=15):
+    """
+    Return a table of the slowest imports (by cumulative time, so
+    including whatever they import) when starting up in the given mode
+    """
+    command = startup_command(mode)
+    process = subprocess.run(command[:1] + ['-X', 'importtime'] +
+                             command[1:], check=True, text=True,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE)
+    imports = []
+    for line in process.stderr.splitlines():
+        # (lines are like 'import time: self | cumulative | name')
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]), fields[2].strip()))
+    imports.sort(reverse=True)
+
+    lines = [f'{"Module":<40} {"Cumulative ms":>14}']
+    for cumulative, name in imports[:top]:
+        lines.append(f'{name:<40} {cumulative / 1000:>14.1f}')
+    return '\n'.join(lines)
+
+
+def read_positions(file_name):
+    """
+    Return the boards of an EPD file
+    """
+    with open(file_name) as f:
+        return [chess.Board.from_epd(line)[0] for line in f if line.strip()]
+
+
+def read_games(file_name):
+    """
+    Return the games of a PGN file
+    """
+    games = []
+    with open(file_name) as f:
+        while True:
+            game = chess.pgn.read_game(f)
+            if game is None:
+                return games
+            games.append(game)
+
+
+def percentile(values, percent):
+    """
+    Return the value that the given percent of values are at or below
+    """
+    values = sorted(values)
+    return values[min(len(values) * percent // 100, len(values) - 1)]
+
+
+def metadata():
+    """
+    What (and where) the benchmarks were run on
+    """
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'python_chess': chess.__version__,
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results, baseline):
+    """
+    Return a table of how each metric changed since the baseline
+    """
+    lines = [f'{"Metric":<32} {"Baseline":>12} {"Now":>12} {"Change":>8}']
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get('results', {}).get(name, {}).get(metric)
+            if not old:
+                lines.append(f'{name + "." + metric:<32} {"-":>12} '
+                             f'{value:>12.4g}')
+                continue
+            change = value / old - 1
+            better = change > 0 if metric.endswith('_per_sec') else change < 0
+            verdict = ''
+            if abs(change) >= NOISE:
+                verdict = 'better' if better else 'WORSE'
+            lines.append(f'{name + "." + metric:<32} {old:>12.4g} '
+                         f'{value:>12.4g} {change:>+8.1%} {verdict}'.rstrip())
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the hot paths, writing the results as JSON '
+                    '(and comparing them to a baseline, if given)')
+    parser.add_argument('--out', help='file to write the JSON results to '
+                                      '(default, standard out)')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--only', help='comma separated benchmarks to run '
+                                       '(rank, english, validation, storage, '
+                                       'games, startup)')
+    parser.add_argument('--nodes', type=int, default=200000,
+                        help='nodes to rank each position with')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--profile', choices=STARTUP_MODES,
+                        help='just list the slowest imports of starting '
+                             'up in a mode')
+    args = parser.parse_args()
+
+    if args.profile:
+        print(import_profile(args.profile))
+        return
+
+    benchmark = Benchmark(nodes=args.nodes, repeat=args.repeat)
+    only = args.only.split(',') if args.only else None
+    report = {'meta': metadata(), 'results': benchmark.run(only)}
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(compare(report['results'], baseline), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
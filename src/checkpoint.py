@@ -0,0 +1,140 @@
+import importlib
+import json
+import os
+
+import chess
+
+from player import Player
+
+
+class Checkpoint():
+    """
+    What a game needs to carry on after the process dies, that isn't
+    already in its journal: who is playing, and whatever they need to pick
+    up where they left off (match name, email subject, unsent emails,
+    difficulty, etc). The journal holds every move of the game, so the two
+    together let a crashed game be resumed (see resume), only reading the
+    game being played (the journal's finished games are archived).
+    (which emails have been handled is already kept by the mail router)
+    """
+
+    def __init__(self, file_name='assets/checkpoint.json'):
+        self.file_name = file_name
+        # What we last wrote (so nothing is written if nothing changed)
+        self.state = None
+
+    def save(self, referee):
+        """
+        Write the players' state to file, if it has changed since the
+        last write (first making sure the journal is on disk, so it is
+        always at least as far along as the checkpoint)
+        """
+        state = {'white': player_state(referee.white_player),
+                 'black': player_state(referee.black_player)}
+        if state == self.state:
+            return
+        referee.journal.sync()
+
+        with open(f'{self.file_name}.tmp', 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{self.file_name}.tmp', self.file_name)
+        self.state = state
+
+    def load(self):
+        """
+        Return the state on file (or None, if there is none)
+        """
+        try:
+            with open(self.file_name) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def clear(self):
+        """
+        Forget the game (once it's over, or given up on)
+        """
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+        self.state = None
+
+    def resume(self, journal):
+        """
+        If a game was left unfinished, return its (white, black, board),
+        with the players as they were and the board replayed from the
+        journal (otherwise None)
+        """
+        state = self.load()
+        if state is None:
+            return None
+        board = replay_game(journal.game_records())
+        if board is None:
+            # (the game finished, we just didn't get to clear up after it)
+            self.clear()
+            return None
+        self.state = state
+        return (restore_player(state['white']),
+                restore_player(state['black']), board)
+
+
+def player_state(player):
+    """
+    Return the kind of player (and the module it is from),
+    along with its checkpoint
+    """
+    # (an async game checkpoints the player its adapter wraps)
+    player = getattr(player, 'wrapped', player)
+    return {'kind': type(player).__name__, 'module': type(player).__module__,
+            'state': player.checkpoint()}
+
+
+def restore_player(saved):
+    """
+    Create a player again from what player_state returned
+    (importing its module, as it may not have been imported yet)
+    """
+    if 'module' in saved:
+        module = importlib.import_module(saved['module'])
+        kind = getattr(module, saved['kind'], None)
+    else:
+        # (checkpoints from before the module was kept)
+        kinds = {cls.__name__: cls for cls in player_classes(Player)}
+        kind = kinds.get(saved['kind'])
+    if kind is None:
+        raise ValueError(f'Unknown kind of player: {saved["kind"]}')
+    return kind.restore(saved['state'])
+
+
+def player_classes(cls):
+    """
+    Return every (imported) subclass of a class, and theirs, and so on
+    """
+    classes = []
+    for subclass in cls.__subclasses__():
+        classes += [subclass] + player_classes(subclass)
+    return classes
+
+
+def replay_game(records):
+    """
+    Given journal records (kind, timestamp, data, fen) of a game,
+    return the board it was left on (with every move on its stack),
+    or None if the game finished (or never started).
+    Wherever the board was changed by a code (a load, a resign, etc)
+    rather than a move, the board starts over from there
+    """
+    if not records or records[0][0] != 'start' or records[-1][0] == 'end':
+        return None
+    board = chess.Board(records[0][3])
+    for kind, timestamp, data, fen in records[1:]:
+        if kind != 'move':
+            continue
+        move = chess.Move.from_uci(data)
+        # (passing the turn is never legal, but is how a resign ends)
+        if not move or board.is_legal(move):
+            board.push(move)
+        if board.fen() != fen:
+            board = chess.Board(fen)
+    return board
@@ -1,4 +1,5 @@
-import save_file
+# How many previous boards to list when showing turns
+SHOW_TURNS = 10
 
 
 class CodeChecker():
@@ -120,7 +121,7 @@ class CodeChecker():
         name = self.referee.opponent().name
 
         # Set the board as a clear win for our opponent
-        self.referee.board.set_fen(name_to_fen[name])
+        self.referee.game.set_fen(name_to_fen[name])
 
         # TODO GROSS HACK
         # Because the game doesn't end when it is the opponent's
@@ -135,7 +136,7 @@ class CodeChecker():
         """
         Load the given fen to the game board
         """
-        self.referee.board.set_fen(code_str)
+        self.referee.game.set_fen(code_str)
         self.show_board()
 
     def show_turns(self, code_str):
@@ -143,10 +144,10 @@ class CodeChecker():
         Show previous boards stored in memory
         """
         # Board so we can print expected fen load
-        board = self.referee.board.copy()
+        board = self.referee.board.copy(stack=False)
 
-        # Load fens from file
-        fens = save_file.load().setdefault('fens', [])
+        # Load fens from the journal
+        fens = self.referee.journal.previous_fens(SHOW_TURNS)
         self.hear('Previously played boards:')
         for i, fen in enumerate(fens):
             board.set_fen(fen)
@@ -166,8 +167,7 @@ class CodeChecker():
         if code_str is None or code_str == '':
             return self.show_turns(code_str)
 
-        # Load fens from file
-        fens = save_file.load().setdefault('fens', [])
-        fen = fens[int(code_str)]
-        self.referee.board.set_fen(fen)
+        # Load the fen from the journal
+        fen = self.referee.journal.previous_fen(int(code_str))
+        self.referee.game.set_fen(fen)
         self.show_board()
@@ -1,21 +1,30 @@
-import time
-from datetime import timezone, datetime as dt
-from dateutil.parser import parse as date_parse
-import re
-import socket
-
-import smtplib
-import poplib
-from email.parser import Parser
+import asyncio
+import queue
+
 from email.mime.text import MIMEText
 import save_file
 
 from player import Player
+from async_player import PlayerAdapter, AsyncInbox
 from match_names import generate_match_name
+from mail_transport import get_outbox
+from mail_router import get_router
+import metrics
+
+
+# Email setup data from the yaml file (see get_config)
+CONFIG = None
 
 
-# Get email setup data from yaml file
-CONFIG = save_file.read_config_file()
+def get_config():
+    """
+    Return the email setup data
+    (read the first time it is needed, rather than on import)
+    """
+    global CONFIG
+    if CONFIG is None:
+        CONFIG = save_file.read_config_file()
+    return CONFIG
 
 
 class EmailPlayer(Player):
@@ -23,29 +32,43 @@ class EmailPlayer(Player):
     A human typing in their moves in the terminal
     """
 
-    email_list = []
-
-    def __init__(self, *args, **kwargs):
+    def __init__(self, match_name=None, subject=None, email_list=None):
         """
         Initialize normally, only add that this player gives a match
         name to the game
-        (so multiple email players can keep track of separate games)
+        (so multiple email players can keep track of separate games).
+        A game picked back up after a crash gives the match name, subject
+        and unsent emails it had (see checkpoint)
         """
-        super().__init__(*args, **kwargs)
-        self.match_name = generate_match_name()
+        super().__init__()
+        if match_name is None:
+            match_name = generate_match_name()
+        self.match_name = match_name
+
+        # Emails waiting to be sent (each game has its own)
+        self.email_list = list(email_list or [])
 
         # Set some initial values used below
-        self._subject = self.match_name
-        self.last_check_date = dt.now(timezone.utc)
+        self._subject = subject or self.match_name
+        # The mail router puts emails about this match on this queue
+        self.inbox = get_router(get_config()).register(self.match_name)
+        # (starting the outbox sends anything left unsent by a crash,
+        # e.g. the last move of a game being resumed)
+        get_outbox(get_config())
 
     def get_move(self):
         """
         Poll from std-in until we get an input that
         is a valid move
         """
+        return self.took_input(self.get_email_input())
+
+    def took_input(self, inp):
+        """
+        Echo back the input we got (in english), returning it
+        """
         # TODO technically emoji incorrectly assumes other player is human,
         # but, you know, whatevs
-        inp = self.get_email_input()
         english_str = self.referee.parser.move_to_english(inp)
         self.email_list.append(f'🧑 {english_str} ({inp})')
         return inp
@@ -60,14 +83,27 @@ class EmailPlayer(Player):
     def win(self):
         self.email_list.append(f'You win!')
         self.commit_emails()
+        get_router(get_config()).unregister(self.match_name)
 
     def lose(self):
         self.email_list.append(f'You lose...')
         self.commit_emails()
+        get_router(get_config()).unregister(self.match_name)
 
     def draw(self):
         self.email_list.append('Game was a draw')
         self.commit_emails()
+        get_router(get_config()).unregister(self.match_name)
+
+    def checkpoint(self):
+        return {'match_name': self.match_name, 'subject': self._subject,
+                'email_list': [str(s) for s in self.email_list]}
+
+    def identity(self):
+        """
+        We are whoever we email
+        """
+        return 'email:' + ','.join(sorted(get_config().targets))
 
     def get_subject(self):
         """
@@ -86,25 +122,25 @@ class EmailPlayer(Player):
         if self.email_list == []:
             return
         strs = [str(s) for s in self.email_list]
-        try:
-            self.send_email('\n'.join(strs))
-            self.email_list = []
-        except smtplib.SMTPDataError as e:
-            print(f'Error sending emails {strs}: {str(e)}')
+        self.send_email('\n'.join(strs))
+        self.email_list = []
+        # (the emails are in the outbox now, so a game resumed from the
+        # checkpoint mustn't send them again)
+        if self.referee is not None:
+            self.referee.save_checkpoint()
 
     def send_email(self, s):
         """
         Given a string 's', send an email with that body as the string
+        (the email is queued, and sent in the background)
         """
         msg = MIMEText(s)
         msg['Subject'] = self.get_subject()
-        msg['From'] = CONFIG.sender
-        msg['To'] = ','.join(CONFIG.targets)
+        config = get_config()
+        msg['From'] = config.sender
+        msg['To'] = ','.join(config.targets)
 
-        server = smtplib.SMTP_SSL(CONFIG.smtp_ssl_host, CONFIG.smtp_ssl_port)
-        server.login(CONFIG.username, CONFIG.password)
-        server.sendmail(CONFIG.sender, CONFIG.targets, msg.as_string())
-        server.quit()
+        get_outbox(config).send(msg, config.sender, config.targets)
 
     def get_email_input(self):
         """
@@ -116,95 +152,46 @@ class EmailPlayer(Player):
             # Send any unsent responses
             self.commit_emails()
 
-            # Useful for debugging
-            # TODO would be nice to not fill up file
-            check_time = dt.now(timezone.utc)
-            print(f'Checking at {check_time}...')
+            # (counted, rather than printed, so the log doesn't fill up)
+            metrics.METRICS.count('email_checks')
 
             message = self.get_email_message()
             # If we have a non-trivial message
             if message.replace('\n', ''):
                 return message
 
-            time.sleep(10)  # Could make config-able
-
-    def _get_email_messages(self):
+    def _get_email_messages(self, timeout=10):
         """
-        Poll the email server, filtering to find only emails that
-        have to do with this game of chess. The 'raw' email
-        info is returned as an object with the following dict keys:
-        'Subject', 'Date', 'From'
+        Wait (up to timeout seconds) for the mail router to give us
+        emails that have to do with this game of chess
+        (from the targets, about this match, and not seen before).
+        The 'raw' email info is returned as an object with the following
+        dict keys: 'Subject', 'Date', 'From'
         The body of the email is gotten with:
         '.get_payload()' (though there may be multiple payloads)
         """
-
-        # There can be occasional connectivity errors
-        # (if, for example, our datetime drifts and has not
-        # self-corrected yet)
-        # In these cases, we just try again in a bit
-        try:
-            pop_conn = poplib.POP3_SSL('mail.gandi.net')
-            pop_conn.user(CONFIG.username)
-            pop_conn.pass_(CONFIG.password)
-        except socket.gaierror as e:
-            print(f'Socket error getting email messages: {str(e)}')
-            return []
-
-        # Helper function that gets given raw email bytes and returns
-        # dict of useful info
-        # TODO should use parser or whatever
-        def get_message_info(pop_conn, i):
-            # Get the raw info from the email
-            # (for whatever reason, they are 1-indexed)
-            try:
-                resp, lines, octets = pop_conn.retr(i + 1)
-            except (poplib.error_proto, ConnectionResetError):
-                return None
-
-            # Decode, and use parser to create useful Message object
-            msg_content = b'\r\n'.join(lines).decode('utf-8')
-            return Parser().parsestr(msg_content)
-
-        # Get messages from server, and parse them to message objects
-        all_messages = []
-        numMessages = len(pop_conn.list()[1])
-        # We don't need to check all messages, just the most recent ones
-        recent_msg_count = 5
-        for i in range(numMessages - recent_msg_count, numMessages):
-            msg = get_message_info(pop_conn, i)
-            if msg is not None:
-                all_messages.append(msg)
-        pop_conn.quit()
-
         messages = []
-        for m in all_messages:
-            # Filer so we only get messages from the targets
-            if not any(t in m.get('From') for t in CONFIG.targets):
-                continue
-
-            # Filter so it only responds to its own match
-            # (remove special chars)
-            msg_subject = re.sub(r'\W+', '', m['Subject'])
-            match_subject = re.sub(r'\W+', '', self.match_name)
-            if match_subject not in msg_subject:
-                continue
-
-            # Check to see if we should have seen this message before
-            message_date = date_parse(m.get('Date'))
-            if message_date < self.last_check_date:
-                continue
-
-            # Update our most recent check as being now, so we don't use
-            # these same messages again
-            self.last_check_date = dt.now(timezone.utc)
-            self._subject = f"Re: {m['Subject']}"
-            messages.append(m)
-
+        try:
+            messages.append(self.inbox.get(timeout=timeout))
+            while True:
+                messages.append(self.inbox.get_nowait())
+        except queue.Empty:
+            pass
         return messages
 
     def get_email_message(self):
         # Get all message dicts
-        messages = self._get_email_messages()
+        return self.read_messages(self._get_email_messages())
+
+    def read_messages(self, messages):
+        """
+        Return the (first lines of the) bodies of the given emails,
+        replying in the same thread as the latest of them from now on
+        (once read, the router can forget them)
+        """
+        get_router(get_config()).consumed(messages)
+        for m in messages:
+            self._subject = f"Re: {m['Subject']}"
 
         # Return all of their bodies
         bodies = []
@@ -225,3 +212,38 @@ class EmailPlayer(Player):
             for b in bodies if not b.startswith('<')
         ]
         return '\n'.join(bodies)
+
+
+class AsyncEmailPlayer(PlayerAdapter):
+    """
+    An email player for async games: waiting on an email is just a
+    coroutine waiting on the mail router, so any number of games can
+    wait on their emails at once, without a thread each
+    """
+
+    def __init__(self, player):
+        super().__init__(player, threaded=False)
+        self.inbox = None
+
+    async def get_move(self):
+        player = self.wrapped
+        if self.inbox is None:
+            # (anything already routed to the player's queue is moved over)
+            self.inbox = get_router(get_config()).register(
+                player.match_name, AsyncInbox(asyncio.get_running_loop()))
+        while True:
+            # Send any unsent responses
+            # (spooling them writes to disk, so not on the event loop)
+            await asyncio.to_thread(player.commit_emails)
+            metrics.METRICS.count('email_checks')
+
+            messages = [await self.inbox.get()]
+            while True:
+                try:
+                    messages.append(self.inbox.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            message = player.read_messages(messages)
+            # If we have a non-trivial message
+            if message.replace('\n', ''):
+                return player.took_input(message)
@@ -0,0 +1,223 @@
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from chess.engine import SimpleEngine, EngineError, EngineTerminatedError
+
+
+class EnginePool():
+    """
+    A process-wide set of running stockfish engines.
+    Rather than each player spawning (and killing) their own engine every
+    game, players borrow an engine for as long as they need it,
+    and give it back when they are done, so the engines (and their
+    hash tables) live on across games and players.
+    """
+
+    def __init__(self, size=1, options=None):
+        """
+        Creates an (empty) pool, which will spawn up to 'size' engines
+        as they are asked for.
+        The given engine options (Hash, Threads, etc) are applied once,
+        when each engine is spawned
+        """
+        self.size = size
+        if options is None:
+            options = {'Hash': 16, 'Threads': 1}
+        self.options = options
+
+        # Engines that are running, but not checked out by anyone
+        self.idle = []
+        # How many engines are running (idle or checked out)
+        self.spawned = 0
+        # Every engine that is running, so all of them can be quit
+        self.engines = set()
+
+        # Engines that are checked out, but can be taken back if someone
+        # else needs them (e.g. one that is only pondering),
+        # mapped to the function that asks the borrower to give it back
+        self.lent = {}
+
+        self.condition = threading.Condition()
+        # Those waiting on an engine are served first come first served
+        self.waiting = deque()
+
+    def get_stockfish_file(self):
+        """
+        Find the stockfish engine asset file
+        (searches for any file that starts with stockfish_10)
+        """
+        prefixed = [filename for filename in os.listdir('assets')
+                    if filename.startswith('stockfish_10')]
+
+        if len(prefixed) == 0:
+            raise FileNotFoundError(
+                'Stockfish engine file not found. Download '
+                '"stockfish_10_x64", or whichever archatecture '
+                'version suits the platform.')
+        if len(prefixed) > 1:
+            raise ValueError(f'Found multiple possible stockfish files: '
+                             f'{prefixed}. Change prefix on (or remove) '
+                             f'unwated files.')
+
+        return f'assets/{prefixed[0]}'
+
+    def spawn(self):
+        """
+        Start a new stockfish engine, with our options applied
+        """
+        engine = SimpleEngine.popen_uci(self.get_stockfish_file())
+        engine.configure(self.options)
+        with self.condition:
+            self.engines.add(engine)
+        return engine
+
+    def is_healthy(self, engine):
+        """
+        Check that the engine is still alive, and answering
+        """
+        try:
+            engine.ping()
+            return True
+        except (EngineError, EngineTerminatedError, TimeoutError):
+            return False
+
+    def discard(self, engine):
+        """
+        Get rid of a (probably broken) engine, freeing up its spot
+        """
+        try:
+            engine.close()
+        except Exception:
+            pass
+        with self.condition:
+            self.spawned -= 1
+            self.engines.discard(engine)
+            self.condition.notify_all()
+
+    def checkout(self, block=True, preempt=None):
+        """
+        Borrow an engine from the pool, spawning a new one if there is room.
+        If all engines are taken, wait for one to be given back
+        (or, if not blocking, return None).
+        If a preempt function is given, the engine is only lent out:
+        when someone else is waiting on an engine, preempt(engine) is called,
+        and the borrower must check it back in (see reclaim)
+        """
+        # Our place in line, kept until we have an engine
+        # (so asking for a lent one back doesn't lose us our turn)
+        ticket = object()
+        with self.condition:
+            self.waiting.append(ticket)
+        try:
+            while True:
+                engine, spawn, preempted = self._take(ticket, block)
+                if preempted is not None:
+                    # Ask the borrower to give it back (outside of the lock,
+                    # as the borrower may be busy with their engine),
+                    # then retry
+                    preempted[1](preempted[0])
+                    continue
+                if engine is None and not spawn:
+                    return None
+
+                if spawn:
+                    try:
+                        engine = self.spawn()
+                    except Exception:
+                        with self.condition:
+                            self.spawned -= 1
+                            self.condition.notify_all()
+                        raise
+                # An idle engine may have died while we were not looking
+                elif not self.is_healthy(engine):
+                    self.discard(engine)
+                    continue
+
+                if preempt is not None:
+                    with self.condition:
+                        self.lent[engine] = preempt
+                return engine
+        finally:
+            with self.condition:
+                self.waiting.remove(ticket)
+                # (whoever is next in line, or waiting to take back
+                # the engine we were just lent, can now go)
+                self.condition.notify_all()
+
+    def _take(self, ticket, block):
+        """
+        Wait for our turn (see checkout), and take an idle engine,
+        a spot to spawn a new one, or a lent engine to take back
+        """
+        with self.condition:
+            while True:
+                first = self.waiting[0] is ticket
+                if first and self.idle:
+                    return self.idle.pop(), False, None
+                if first and self.spawned < self.size:
+                    # Reserve the spot, and spawn outside of the lock
+                    self.spawned += 1
+                    return None, True, None
+                if not block:
+                    return None, False, None
+                if first and self.lent:
+                    return None, False, self.lent.popitem()
+                self.condition.wait()
+
+    def reclaim(self, engine):
+        """
+        A borrower of a lent engine wants to keep it for good.
+        Returns false if it was already preempted
+        (in which case the preempt function will be giving it back)
+        """
+        with self.condition:
+            return self.lent.pop(engine, None) is not None
+
+    def checkin(self, engine):
+        """
+        Give a borrowed engine back to the pool
+        """
+        if engine is None:
+            return
+        with self.condition:
+            self.lent.pop(engine, None)
+            if not engine.returncode.done():
+                self.idle.append(engine)
+                self.condition.notify_all()
+                return
+        # Engine died while checked out
+        self.discard(engine)
+
+    @contextmanager
+    def borrow(self):
+        """
+        Checkout an engine for the duration of a with block
+        """
+        engine = self.checkout()
+        try:
+            yield engine
+        finally:
+            self.checkin(engine)
+
+    def close(self):
+        """
+        Quit all of the engines, idle, lent or checked out
+        (engines need to be killed to allow the script to exit).
+        Any engine still checked out is discarded when it is checked in
+        """
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.spawned -= len(idle)
+            engines = list(self.engines)
+            self.engines.difference_update(idle)
+        for engine in engines:
+            try:
+                engine.quit()
+            except (EngineError, EngineTerminatedError, TimeoutError):
+                pass
+
+
+# The pool that every player in this process borrows from
+POOL = EnginePool()
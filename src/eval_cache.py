@@ -0,0 +1,189 @@
+import mmap
+import os
+import struct
+import threading
+
+from chess.engine import Cp, Mate, MateGiven
+from chess.polyglot import zobrist_hash
+
+import metrics
+
+# File header: magic, number of buckets, last use 'tick'
+HEADER = struct.Struct('<4sIQ')
+MAGIC = b'EVC1'
+
+# One cached evaluation:
+# zobrist hash, depth limit, time limit (ms), score kind, depth searched,
+# score, and the tick it was last used on (for evicting old entries)
+RECORD = struct.Struct('<QHIBBiI')
+
+# Score kinds (kind 0 is an empty record)
+EMPTY, CP, MATE, MATE_GIVEN = 0, 1, 2, 3
+
+# How many records share a bucket (the least recently used
+# of which is replaced when the bucket is full)
+BUCKET_SIZE = 4
+
+
+class EvalCache():
+    """
+    An on-disk cache of stockfish evaluations, so positions we have seen
+    before (openings, common endgames) don't need to be analysed again.
+    Positions are keyed by their zobrist hash, along with the limits
+    they were analysed with.
+    The file is a fixed size hash table of small binary records, which is
+    memory-mapped, so it costs next to nothing to keep open
+    """
+
+    def __init__(self, file_name='assets/eval-cache.bin', buckets=16384):
+        """
+        Creates a cache with room for buckets * BUCKET_SIZE evaluations
+        (the file is only opened once the cache is first used).
+        With no file name, the cache is only kept in memory
+        """
+        self.file_name = file_name
+        self.buckets = buckets
+        self.map = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """
+        Memory-map the cache file, creating it if needed
+        (a file of the wrong size, or from some other program,
+        is simply started over)
+        """
+        size = HEADER.size + self.buckets * BUCKET_SIZE * RECORD.size
+        if self.file_name is None:
+            self.map = mmap.mmap(-1, size)
+            HEADER.pack_into(self.map, 0, MAGIC, self.buckets, 0)
+            return
+        with open(self.file_name, 'a+b') as f:
+            f.seek(0)
+            header = f.read(HEADER.size)
+            fresh = (
+                os.path.getsize(self.file_name) != size or
+                header[:4] != MAGIC or
+                HEADER.unpack(header)[1] != self.buckets
+            )
+            if fresh:
+                f.truncate(0)
+                f.truncate(size)
+            self.map = mmap.mmap(f.fileno(), size)
+        if fresh:
+            HEADER.pack_into(self.map, 0, MAGIC, self.buckets, 0)
+
+    def close(self):
+        """
+        Write everything out to disk, and unmap the file
+        """
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+                self.map.close()
+                self.map = None
+
+    def key(self, board, limit):
+        """
+        Given a board and the engine limit used to analyse it,
+        return the (zobrist hash, depth, time in ms) cache key
+        """
+        depth = limit.depth or 0
+        time_ms = int((limit.time or 0) * 1000)
+        return zobrist_hash(board), depth, time_ms
+
+    def bucket_offsets(self, key):
+        """
+        Return the file offsets of the records in the bucket for this key
+        """
+        zobrist, depth, time_ms = key
+        h = zobrist ^ (depth << 48) ^ (time_ms * 0x9E3779B1)
+        first = HEADER.size + (h % self.buckets) * BUCKET_SIZE * RECORD.size
+        return [first + i * RECORD.size for i in range(BUCKET_SIZE)]
+
+    def tick(self):
+        """
+        Bump, and return, the counter used to tell which records
+        were used least recently
+        """
+        magic, buckets, tick = HEADER.unpack_from(self.map, 0)
+        tick += 1
+        HEADER.pack_into(self.map, 0, magic, buckets, tick)
+        return tick & 0xFFFFFFFF
+
+    def get(self, board, limit):
+        """
+        Return the cached score for the board (relative to whoever is
+        to move) if it was analysed with this limit before, otherwise None
+        """
+        entry = self.get_entry(board, limit)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, board, limit):
+        """
+        Like get, but return the (score, depth searched) of the board
+        """
+        key = self.key(board, limit)
+        with self.lock:
+            if self.map is None:
+                self.open()
+            for offset in self.bucket_offsets(key):
+                record = list(RECORD.unpack_from(self.map, offset))
+                if record[3] != EMPTY and tuple(record[:3]) == key:
+                    record[6] = self.tick()
+                    RECORD.pack_into(self.map, offset, *record)
+                    metrics.METRICS.count('eval_cache_hits')
+                    return to_score(record[3], record[5]), record[4]
+        metrics.METRICS.count('eval_cache_misses')
+        return None
+
+    def put(self, board, limit, score, depth=0):
+        """
+        Cache the score for a board (relative to whoever is to move),
+        replacing the least recently used record if need be
+        """
+        key = self.key(board, limit)
+        kind, value = from_score(score)
+        with self.lock:
+            if self.map is None:
+                self.open()
+            offsets = self.bucket_offsets(key)
+            records = [RECORD.unpack_from(self.map, o) for o in offsets]
+
+            # Overwrite this key if it is already here, otherwise
+            # an empty record, otherwise the oldest one
+            def priority(record):
+                if record[3] != EMPTY and record[:3] == key:
+                    return -2
+                if record[3] == EMPTY:
+                    return -1
+                return record[6]
+            i = min(range(BUCKET_SIZE), key=lambda i: priority(records[i]))
+
+            RECORD.pack_into(self.map, offsets[i], *key, kind,
+                             min(depth, 255), value, self.tick())
+
+
+def from_score(score):
+    """
+    Given a python-chess score, return its (kind, value) record fields
+    """
+    if score == MateGiven:
+        return MATE_GIVEN, 0
+    if score.is_mate():
+        return MATE, score.mate()
+    return CP, score.score()
+
+
+def to_score(kind, value):
+    """
+    Given (kind, value) record fields, return the python-chess score
+    """
+    if kind == MATE_GIVEN:
+        return MateGiven
+    if kind == MATE:
+        return Mate(value)
+    return Cp(value)
+
+
+# The cache every player in this process shares
+CACHE = EvalCache()
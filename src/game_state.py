@@ -0,0 +1,143 @@
+from array import array
+
+import chess
+
+# How far the board's move stack can grow past what it needs, before it is
+# trimmed back (so it is only copied every so often, rather than every ply)
+SLACK = 32
+
+# What a mate is worth (in centipawns), when keeping a ply's score
+MATE_SCORE = 10000
+
+
+class Ply():
+    """
+    What we know about a ply, other than its move: how long it took,
+    and (if the player analysed it) its score and depth
+    """
+
+    __slots__ = ('seconds', 'score', 'depth')
+
+    def __init__(self, seconds=None, score=None, depth=None):
+        self.seconds = seconds
+        self.score = score
+        self.depth = depth
+
+    @classmethod
+    def from_analysis(cls, seconds, analysis):
+        """
+        Create from how long the ply took, and the TurnAnalysis behind it
+        """
+        if not analysis:
+            return cls(seconds)
+        best = analysis.best()
+        score = None
+        if best.score is not None:
+            score = best.score.score(mate_score=MATE_SCORE)
+        return cls(seconds, score, best.depth)
+
+
+class GameState():
+    """
+    A game being played, kept small (so hundreds of games can be kept
+    in memory at once): every move is packed into 2 bytes (see pack_move),
+    and the board only keeps as much of its move stack as it needs to spot
+    repetitions (moves since the last capture or pawn move, see
+    bounded_copy), rather than the whole game.
+    Whenever the whole game is needed (e.g. undoing past what the board
+    kept), the board is rebuilt from the packed moves
+    """
+
+    __slots__ = ('root_fen', 'moves', 'plies', 'board')
+
+    def __init__(self, board=None):
+        """
+        Start from the given board (by default, the starting board),
+        along with any moves already on its stack
+        (the board is played on as is, its stack trimmed as it goes)
+        """
+        if board is None:
+            board = chess.Board()
+        self.root_fen = board.root().fen()
+        self.moves = array('H', (pack_move(m) for m in board.move_stack))
+        self.plies = [Ply() for _ in board.move_stack]
+        self.board = board
+
+    def push(self, move, ply=None):
+        """
+        Play a move (along with what we know about it)
+        """
+        self.board.push(move)
+        self.moves.append(pack_move(move))
+        self.plies.append(ply or Ply())
+        if len(self.board.move_stack) > self.board.halfmove_clock + SLACK:
+            self.board = bounded_copy(self.board)
+
+    def pop(self):
+        """
+        Take back the last move, returning it
+        """
+        if not self.board.move_stack:
+            self.board = self.full_board()
+        self.moves.pop()
+        self.plies.pop()
+        return self.board.pop()
+
+    def set_fen(self, fen):
+        """
+        Jump to a board (e.g. loading one, or resigning), which the game
+        carries on from
+        """
+        self.board.set_fen(fen)
+        self.root_fen = self.board.fen()
+        self.moves = array('H')
+        self.plies = []
+
+    def move_list(self):
+        """
+        Return every move played (since the game started, or last jumped)
+        """
+        return [unpack_move(code) for code in self.moves]
+
+    def full_board(self):
+        """
+        Return the board with every move played on its stack
+        """
+        board = chess.Board(self.root_fen)
+        for code in self.moves:
+            board.push(unpack_move(code))
+        return board
+
+    def seconds(self, color):
+        """
+        How long the given side has taken over its moves
+        """
+        # (whoever moved first, moved every other ply)
+        turn = chess.WHITE if self.root_fen.split()[1] == 'w' else chess.BLACK
+        first = 0 if turn == color else 1
+        return sum(ply.seconds or 0 for ply in self.plies[first::2])
+
+
+def pack_move(move):
+    """
+    Pack a move into 16 bits (the null move is 0)
+    """
+    return (move.from_square | move.to_square << 6 |
+            (move.promotion or 0) << 12)
+
+
+def unpack_move(code):
+    """
+    Return the move packed by pack_move
+    """
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+
+def bounded_copy(board):
+    """
+    Copy a board, with only as much of its move stack as is needed to spot
+    repetitions (none of the moves before the last capture or pawn move
+    can repeat), along with the move that led to it
+    (e.g. to see if the last move was a capture)
+    """
+    return board.copy(stack=board.halfmove_clock + 1)
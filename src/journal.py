@@ -0,0 +1,356 @@
+import json
+import os
+import struct
+import time
+
+# Each entry in the index file is the offset of a record in the journal
+OFFSET = struct.Struct('<Q')
+# How much of the archive to read at a time, when reading back from its end
+ARCHIVE_BLOCK = 4096
+
+
+class Journal():
+    """
+    An append-only log of every game played, so if there is a crash or
+    mistake, we can go back to any previous board.
+    Each record is a line of tab separated:
+    kind (start, move, or end), timestamp, uci move (or result), and fen.
+    Alongside the journal sits an index of where each record starts, so
+    any previous board can be looked up without reading the whole file
+    """
+
+    def __init__(self, file_name='assets/journal.txt', sync_every=10):
+        """
+        Set where the journal (and its index and archive) live.
+        Records are only fsync'd to disk every 'sync_every' records
+        (and at the end of a game)
+        """
+        self.file_name = file_name
+        base_name, _ = os.path.splitext(file_name)
+        self.index_name = f'{base_name}.idx'
+        self.archive_name = f'{base_name}-archive.txt'
+        # (only there while compacting, see compact)
+        self.compacting_name = f'{base_name}.compacting'
+        self.sync_every = sync_every
+
+        self.journal_file = None
+        self.index_file = None
+        # How many records there are, and which one started this game
+        self.count = 0
+        self.game_start = 0
+        self.unsynced = 0
+
+    def open(self):
+        """
+        Open the journal and its index, rebuilding the index if the two
+        don't line up (e.g. we crashed halfway through a write)
+        """
+        if self.journal_file is not None:
+            return
+        self.finish_compacting()
+        self.journal_file = open(self.file_name, 'a+b')
+        self.index_file = open(self.index_name, 'a+b')
+
+        self.index_file.seek(0, os.SEEK_END)
+        index_size = self.index_file.tell()
+        self.count = index_size // OFFSET.size
+        self.journal_file.seek(0, os.SEEK_END)
+        end = self.journal_file.tell()
+
+        if index_size % OFFSET.size != 0:
+            expected_end = None
+        elif self.count == 0:
+            expected_end = 0
+        else:
+            last = self.read_record(self.count - 1)
+            expected_end = (self.read_offset(self.count - 1) +
+                            len('\t'.join(last).encode()) + 1)
+        if end != expected_end:
+            self.rebuild_index()
+
+        self.game_start = self.find_game_start()
+
+    def close(self):
+        """
+        Sync anything outstanding, and close the files
+        """
+        if self.journal_file is None:
+            return
+        self.sync()
+        self.journal_file.close()
+        self.index_file.close()
+        self.journal_file = None
+        self.index_file = None
+
+    def sync(self):
+        """
+        Make sure every record so far is safely on disk
+        """
+        for f in (self.journal_file, self.index_file):
+            f.flush()
+            os.fsync(f.fileno())
+        self.unsynced = 0
+
+    def rebuild_index(self):
+        """
+        Scan through the journal, dropping any half written record at
+        the end, and write a fresh index of where each record starts
+        """
+        self.journal_file.seek(0)
+        offsets = []
+        offset = 0
+        for line in self.journal_file:
+            if not line.endswith(b'\n'):
+                break
+            offsets.append(offset)
+            offset += len(line)
+        self.journal_file.truncate(offset)
+
+        self.index_file.truncate(0)
+        self.index_file.write(b''.join(OFFSET.pack(o) for o in offsets))
+        self.count = len(offsets)
+        self.sync()
+
+    def find_game_start(self):
+        """
+        Return the record number of the latest game's start
+        (searching back from the end, so this only reads the one game)
+        """
+        for i in range(self.count - 1, -1, -1):
+            if self.read_record(i)[0] == 'start':
+                return i
+        return self.count
+
+    def append(self, kind, data, fen):
+        """
+        Add a record to the end of the journal (and index)
+        """
+        self.open()
+        self.journal_file.seek(0, os.SEEK_END)
+        offset = self.journal_file.tell()
+        line = f'{kind}\t{time.time():.3f}\t{data}\t{fen}\n'
+        self.journal_file.write(line.encode())
+        self.index_file.write(OFFSET.pack(offset))
+        self.count += 1
+
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def read_offset(self, i):
+        """
+        Return where the i-th record starts in the journal
+        """
+        self.index_file.flush()
+        self.index_file.seek(i * OFFSET.size)
+        return OFFSET.unpack(self.index_file.read(OFFSET.size))[0]
+
+    def read_record(self, i):
+        """
+        Return the i-th record as a list of: kind, timestamp, data, fen
+        """
+        self.journal_file.flush()
+        self.journal_file.seek(self.read_offset(i))
+        line = self.journal_file.readline().decode()
+        return line.rstrip('\n').split('\t')
+
+    def start_game(self, fen):
+        """
+        Mark the start of a new game (first moving any finished games
+        out into the archive)
+        """
+        self.open()
+        self.compact()
+        self.game_start = self.count
+        self.append('start', '-', fen)
+
+    def add_move(self, move, fen):
+        """
+        Record a move that was played, along with the board it led to
+        """
+        self.append('move', move.uci(), fen)
+
+    def end_game(self, result, fen):
+        """
+        Record how a game ended, making sure it is all on disk
+        """
+        self.append('end', result, fen)
+        self.sync()
+
+    def previous_fen(self, n):
+        """
+        Return the fen of the n-th previous board (0 is the current board),
+        going back into the archive (i.e. earlier games) if need be
+        """
+        self.open()
+        if n < 0:
+            raise ValueError(f'No board {n} turns ago')
+        if n < self.count:
+            return self.read_record(self.count - 1 - n)[3]
+        archived = self.archived_fens(n - self.count + 1)
+        if len(archived) <= n - self.count:
+            raise ValueError(f'No board {n} turns ago (only '
+                             f'{self.count + len(archived)} boards)')
+        return archived[n - self.count]
+
+    def previous_fens(self, limit):
+        """
+        Return the fens of (up to 'limit') previous boards,
+        most recent first (going back into the archive if need be)
+        """
+        self.open()
+        fens = [self.read_record(i)[3]
+                for i in range(self.count - 1, self.count - 1 - limit, -1)
+                if i >= 0]
+        if len(fens) < limit:
+            fens += self.archived_fens(limit - len(fens))
+        return fens
+
+    def archived_fens(self, limit):
+        """
+        Return the fens of (up to 'limit') of the last boards archived,
+        most recent first (reading back from the end of the archive,
+        so only those records are read)
+        """
+        if not os.path.exists(self.archive_name):
+            return []
+        with open(self.archive_name, 'rb') as archive:
+            start = archive.seek(0, os.SEEK_END)
+            tail = b''
+            # (one more line than needed, as the first may be cut off)
+            while start > 0 and tail.count(b'\n') <= limit:
+                step = min(ARCHIVE_BLOCK, start)
+                start -= step
+                archive.seek(start)
+                tail = archive.read(step) + tail
+        lines = tail.split(b'\n')[:-1]
+        if start > 0:
+            lines = lines[1:]
+        return [line.decode().split('\t')[3]
+                for line in reversed(lines[-limit:])]
+
+    def game_records(self):
+        """
+        Return every record of this game (kind, timestamp, data, fen),
+        oldest first
+        """
+        self.open()
+        return [self.read_record(i)
+                for i in range(self.game_start, self.count)]
+
+    def compact(self):
+        """
+        Move all of the finished games out of the journal and onto the end
+        of the archive, so the journal (and its index) only ever hold
+        the game being played
+        """
+        self.open()
+        keep_from = self.count
+        if self.count > 0 and self.read_record(self.count - 1)[0] != 'end':
+            keep_from = self.game_start
+        if keep_from == 0:
+            return
+
+        # Copy out the finished games, then swap in a journal
+        # of only what is left
+        self.sync()
+        split = (self.read_offset(keep_from) if keep_from < self.count
+                 else os.path.getsize(self.file_name))
+        self.journal_file.seek(0)
+        finished = self.journal_file.read(split)
+        remaining = self.journal_file.read()
+
+        # Note down how things stood, so if we crash partway through,
+        # the games copied out can be taken back off the archive
+        # (see finish_compacting), rather than being archived twice
+        archive_size = (os.path.getsize(self.archive_name)
+                        if os.path.exists(self.archive_name) else 0)
+        write_synced(self.compacting_name, json.dumps(
+            {'archive_size': archive_size,
+             'journal_size': split + len(remaining)}).encode())
+
+        with open(self.archive_name, 'ab') as archive:
+            archive.write(finished)
+            archive.flush()
+            os.fsync(archive.fileno())
+
+        self.journal_file.close()
+        write_synced(self.file_name, remaining)
+        self.journal_file = open(self.file_name, 'a+b')
+        self.rebuild_index()
+        self.game_start = self.find_game_start()
+        os.remove(self.compacting_name)
+
+    def finish_compacting(self):
+        """
+        If we crashed partway through compacting: if the journal was
+        already swapped for the new one, the compacting is done, otherwise
+        take whatever was copied out back off the archive (the games are
+        still in the journal, and are archived next time)
+        """
+        if not os.path.exists(self.compacting_name):
+            return
+        with open(self.compacting_name) as f:
+            compacting = json.load(f)
+        if (os.path.exists(self.file_name) and
+                os.path.getsize(self.file_name) ==
+                compacting['journal_size'] and
+                os.path.exists(self.archive_name)):
+            with open(self.archive_name, 'r+b') as archive:
+                archive.truncate(compacting['archive_size'])
+                os.fsync(archive.fileno())
+        os.remove(self.compacting_name)
+
+
+def write_synced(file_name, data):
+    """
+    Replace a file with the given bytes, making sure they are on disk
+    (the file is written in full before it replaces the old one, so a
+    crash leaves one or the other, never half of one)
+    """
+    with open(f'{file_name}.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{file_name}.tmp', file_name)
+
+
+class MemoryJournal(Journal):
+    """
+    A journal of just the game being played, kept only in memory,
+    for games that don't need to survive a crash (e.g. tournaments)
+    """
+
+    def __init__(self):
+        self.records = []
+        self.count = 0
+        self.game_start = 0
+        self.unsynced = 0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def sync(self):
+        pass
+
+    def append(self, kind, data, fen):
+        self.records.append([kind, f'{time.time():.3f}', data, fen])
+        self.count += 1
+
+    def read_record(self, i):
+        return self.records[i]
+
+    def archived_fens(self, limit):
+        return []
+
+    def compact(self):
+        """
+        Forget any finished game
+        """
+        if self.records and self.records[-1][0] == 'end':
+            self.records = []
+            self.count = 0
+            self.game_start = 0
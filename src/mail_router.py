@@ -0,0 +1,272 @@
+import email
+import os
+import queue
+import re
+import threading
+import time
+
+from mail_transport import get_inbound_transport
+import metrics
+
+
+class MailRouter():
+    """
+    A single reader of the mailbox, shared by every match in this process.
+    Each new email is fetched once, and handed to the queue of the match
+    it is about (by subject), so checking for mail costs the same no
+    matter how many matches are being played.
+    The uids of emails already handled are kept on file, so no email is
+    handled twice (even across restarts), and each email is written to a
+    spool folder before its uid is, and only removed once a player has
+    read it (see consumed), so no email is lost either
+    """
+
+    # How long to hold onto emails for matches no-one is waiting on
+    # (in seconds)
+    max_unclaimed_age = 7 * 24 * 60 * 60
+    # How many handled uids to keep on file
+    max_seen = 1000
+
+    def __init__(self, transport, seen_file='assets/seen-uids.txt',
+                 spool_folder=None, poll_wait=10):
+        """
+        Given the transport to read mail with, where to keep the handled
+        uids, and the emails not yet read (by default, an 'inbox' folder
+        next to the uids), and how long to wait between checks (if the
+        transport can't tell us when mail arrives)
+        """
+        self.transport = transport
+        self.seen_file = seen_file
+        if spool_folder is None:
+            spool_folder = os.path.join(os.path.dirname(seen_file), 'inbox')
+        self.spool_folder = spool_folder
+        self.poll_wait = poll_wait
+
+        # Match key (see match_key) to the queue of its emails
+        self.queues = {}
+        # Emails that arrived before their match was registered
+        # (e.g. while a match is being resumed), oldest first,
+        # starting with any left unread last time
+        self.unclaimed = self.load_spool()
+
+        # If we have never read the mailbox before, whatever is already
+        # in it is old news
+        self.priming = not os.path.exists(seen_file)
+        self.seen = []
+        if not self.priming:
+            with open(seen_file) as f:
+                self.seen = f.read().split()[-self.max_seen:]
+        self.seen_set = set(self.seen)
+        # (rewrite the file, so it doesn't grow forever)
+        self.save_seen()
+
+        # Have the transport pick up where we left off
+        # (so emails that came in while we were down aren't missed)
+        numbered = [int(uid) for uid in self.seen if uid.isdigit()]
+        if numbered:
+            transport.start_after(max(numbered))
+
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def save_seen(self):
+        """
+        Rewrite the file of handled uids
+        """
+        with open(f'{self.seen_file}.tmp', 'w') as f:
+            f.write(''.join(f'{uid}\n' for uid in self.seen))
+        os.replace(f'{self.seen_file}.tmp', self.seen_file)
+
+    def mark_seen(self, uid):
+        """
+        Remember that an email has been handled
+        """
+        self.seen.append(uid)
+        self.seen_set.add(uid)
+        with open(self.seen_file, 'a') as f:
+            f.write(f'{uid}\n')
+
+        if len(self.seen) > 2 * self.max_seen:
+            self.seen = self.seen[-self.max_seen:]
+            self.seen_set = set(self.seen)
+            self.save_seen()
+
+    def load_spool(self):
+        """
+        Return the emails left unread last time, oldest first
+        (dropping any that are too old to still be wanted)
+        """
+        os.makedirs(self.spool_folder, exist_ok=True)
+        messages = []
+        for file_name in sorted(os.listdir(self.spool_folder)):
+            if not file_name.endswith('.eml'):
+                continue
+            spool_name = os.path.join(self.spool_folder, file_name)
+            with open(spool_name, 'rb') as f:
+                message = email.message_from_bytes(f.read())
+            message.spool_name = spool_name
+            message.arrived = float(file_name.split('-')[0])
+            messages.append(message)
+        self.expire(messages)
+        return messages
+
+    def spool(self, uid, message):
+        """
+        Write an email to the spool folder (until it is read)
+        """
+        message.arrived = time.time()
+        # (named by when it arrived, so they are read back in order)
+        safe_uid = re.sub(r'\W', '_', uid)
+        message.spool_name = os.path.join(
+            self.spool_folder, f'{message.arrived:017.6f}-{safe_uid}.eml')
+        with open(f'{message.spool_name}.tmp', 'wb') as f:
+            f.write(message.as_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{message.spool_name}.tmp', message.spool_name)
+
+    def consumed(self, messages):
+        """
+        Forget emails that a player has read
+        (so they aren't handed over again after a restart)
+        """
+        for message in messages:
+            spool_name = getattr(message, 'spool_name', None)
+            if spool_name is not None and os.path.exists(spool_name):
+                os.remove(spool_name)
+
+    def expire(self, messages):
+        """
+        Drop (in place) any of the given unclaimed emails that are too old
+        """
+        too_old = time.time() - self.max_unclaimed_age
+        for message in [m for m in messages if m.arrived < too_old]:
+            messages.remove(message)
+            self.consumed([message])
+
+    def start(self):
+        """
+        Start reading the mailbox in the background (if we aren't already)
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(
+                target=self.run, name='mail-router', daemon=True)
+            self.thread.start()
+
+    def register(self, match_name, inbox=None):
+        """
+        Start routing emails about the given match,
+        returning the queue they will be put on
+        (a new one, or the given one: anything with a put method, which
+        takes over from any queue the match already had)
+        """
+        key = match_key(match_name)
+        with self.lock:
+            if inbox is None:
+                inbox = self.queues.setdefault(key, queue.Queue())
+            else:
+                old_inbox = self.queues.get(key)
+                self.queues[key] = inbox
+                while old_inbox is not None and not old_inbox.empty():
+                    inbox.put(old_inbox.get_nowait())
+            # Hand over anything that came in early
+            for message in self.unclaimed[:]:
+                if self.find_key(message) == key:
+                    self.unclaimed.remove(message)
+                    inbox.put(message)
+        return inbox
+
+    def unregister(self, match_name):
+        """
+        Stop routing emails about the given match
+        """
+        with self.lock:
+            self.queues.pop(match_key(match_name), None)
+
+    def find_key(self, message):
+        """
+        Return the key of the match an email is about (or None)
+        """
+        key = match_key(message.get('Subject', ''))
+        if key in self.queues:
+            return key
+        # The subject may have more added to it than just 'Re:'
+        for match in self.queues:
+            if match in key:
+                return match
+        return None
+
+    def route(self, message):
+        """
+        Put an email on the queue of the match it is about
+        (or hold onto it, in case that match shows up later)
+        """
+        with self.lock:
+            key = self.find_key(message)
+            if key is not None:
+                # (a queue that can no longer take it, e.g. an AsyncInbox
+                # whose loop has closed, is dropped, and the email held
+                # onto like any other unclaimed one)
+                if self.queues[key].put(message) is not False:
+                    return
+                del self.queues[key]
+            self.unclaimed.append(message)
+            self.expire(self.unclaimed)
+
+    def check(self):
+        """
+        Fetch any new emails, and route each one we have not seen before
+        (spooling it first, so it is never lost in between)
+        """
+        start = time.monotonic()
+        fetched = self.transport.fetch_new()
+        metrics.METRICS.record(
+            'mail_poll', labels={'transport': type(self.transport).__name__},
+            seconds=time.monotonic() - start, emails=len(fetched))
+        for uid, message in fetched:
+            if uid in self.seen_set:
+                continue
+            if not self.priming:
+                self.spool(uid, message)
+                self.route(message)
+            self.mark_seen(uid)
+        self.priming = False
+
+    def run(self):
+        """
+        Check for mail forever
+        """
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                print(f'Error checking for mail: {str(e)}')
+            self.transport.wait(self.poll_wait)
+
+
+def match_key(subject):
+    """
+    Boil a subject (or match name) down to what identifies the match
+    (no 'Re:'s, no special chars, no case)
+    """
+    subject = re.sub(r'^\s*((re|fwd?)\s*:\s*)*', '', subject, flags=re.I)
+    return re.sub(r'\W+', '', subject).lower()
+
+
+# The router every match in this process gets its emails from
+ROUTER = None
+ROUTER_LOCK = threading.Lock()
+
+
+def get_router(config):
+    """
+    Return the process-wide mail router (creating it if need be)
+    """
+    global ROUTER
+    with ROUTER_LOCK:
+        if ROUTER is None:
+            ROUTER = MailRouter(get_inbound_transport(config))
+            ROUTER.start()
+        return ROUTER
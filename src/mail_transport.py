@@ -0,0 +1,515 @@
+import imaplib
+import itertools
+import json
+import os
+import poplib
+import queue
+import re
+import select
+import smtplib
+import socket
+import ssl
+import threading
+import time
+from abc import ABC, abstractmethod
+from email.parser import BytesParser, Parser
+
+import metrics
+
+
+class InboundTransport(ABC):
+    """
+    Abstract class for a way of getting emails from the mail server,
+    (polling over POP3, or a kept open IMAP connection, etc)
+    """
+
+    @abstractmethod
+    def fetch_new(self, subject=None):
+        """
+        Return a list of (uid, message) for the emails that arrived
+        from our targets since the last fetch
+        (only those with the given text in their subject, if given)
+        """
+        pass
+
+    def start_after(self, uid):
+        """
+        Only fetch emails that came after the given uid
+        (for transports with ordered uids, others can ignore this)
+        """
+        pass
+
+    def wait(self, timeout):
+        """
+        Wait (up to timeout seconds) until there may be new emails
+        """
+        time.sleep(timeout)
+
+    def close(self):
+        """
+        Let go of any connection to the mail server
+        """
+        pass
+
+
+class POP3Transport(InboundTransport):
+    """
+    Logs in to the POP3 server every time we check for mail,
+    only looking through the most recent few emails
+    """
+
+    # We don't need to check all messages, just the most recent ones
+    recent_msg_count = 5
+
+    def __init__(self, host, username, password, targets):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.targets = targets
+
+    def fetch_new(self, subject=None):
+        # There can be occasional connectivity errors
+        # (if, for example, our datetime drifts and has not
+        # self-corrected yet)
+        # In these cases, we just try again in a bit
+        try:
+            pop_conn = poplib.POP3_SSL(self.host)
+            pop_conn.user(self.username)
+            pop_conn.pass_(self.password)
+        except socket.gaierror as e:
+            print(f'Socket error getting email messages: {str(e)}')
+            return []
+
+        # Helper function that gets given raw email bytes and returns
+        # dict of useful info
+        def get_message_info(pop_conn, i):
+            # Get the raw info from the email
+            # (for whatever reason, they are 1-indexed)
+            try:
+                resp, lines, octets = pop_conn.retr(i + 1)
+                uid = pop_conn.uidl(i + 1).split()[-1].decode()
+            except (poplib.error_proto, ConnectionResetError):
+                return None
+
+            # Decode, and use parser to create useful Message object
+            msg_content = b'\r\n'.join(lines).decode('utf-8')
+            return uid, Parser().parsestr(msg_content)
+
+        # Get messages from server, and parse them to message objects
+        all_messages = []
+        numMessages = len(pop_conn.list()[1])
+        first = max(numMessages - self.recent_msg_count, 0)
+        for i in range(first, numMessages):
+            msg = get_message_info(pop_conn, i)
+            if msg is not None:
+                all_messages.append(msg)
+        pop_conn.quit()
+
+        return [(uid, m) for uid, m in all_messages
+                if is_from(m, self.targets) and has_subject(m, subject)]
+
+
+class IMAPTransport(InboundTransport):
+    """
+    Keeps a single logged in IMAP connection open, has the server search
+    for new emails from our targets, only downloads the headers and text
+    of those, and (if the server can) waits for mail with IDLE
+    """
+
+    # How long the server has to answer us (in seconds), and how many lines
+    # it can send us after we finish idling, before we give up on it
+    reply_timeout = 30
+    max_done_lines = 100
+
+    def __init__(self, host, port, username, password, targets,
+                 use_ssl=True, connect=None):
+        """
+        The connect function, given (host, port), should return an
+        imaplib.IMAP4-like connection (by default, a real one)
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.targets = targets
+        if connect is None:
+            connect = imaplib.IMAP4_SSL if use_ssl else imaplib.IMAP4
+        self.connect = connect
+
+        self.conn = None
+        # The highest uid we have already seen
+        # (on first connecting, anything already there counts as seen)
+        self.last_uid = None
+
+    def connection(self):
+        """
+        Return our connection, logging in (again) if need be
+        """
+        if self.conn is None:
+            conn = self.connect(self.host, self.port)
+            conn.login(self.username, self.password)
+            conn.select('INBOX')
+            if self.last_uid is None:
+                typ, data = conn.status('INBOX', '(UIDNEXT)')
+                uid_next = re.search(rb'UIDNEXT (\d+)', data[0]).group(1)
+                self.last_uid = int(uid_next) - 1
+            self.conn = conn
+        return self.conn
+
+    def start_after(self, uid):
+        self.last_uid = uid
+
+    def drop(self, e):
+        """
+        Something went wrong with the connection,
+        so forget it (we log in again next time)
+        """
+        print(f'Error with IMAP connection: {str(e)}')
+        try:
+            self.conn.logout()
+        except Exception:
+            pass
+        self.conn = None
+
+    def search(self, subject=None):
+        """
+        Have the server find the uids of new emails from our targets
+        """
+        criteria = [f'UID {self.last_uid + 1}:*']
+        # (IMAP's OR only takes two at a time, so they get nested)
+        senders = [f'FROM "{t}"' for t in self.targets]
+        while len(senders) > 1:
+            senders = [f'OR {senders[0]} {senders[1]}'] + senders[2:]
+        criteria += senders
+        if subject:
+            criteria.append(f'SUBJECT "{subject}"')
+
+        typ, data = self.conn.uid('SEARCH', None, *criteria)
+        # (a range of n:* always includes the newest email, even if old)
+        uids = [int(uid) for uid in data[0].split()]
+        return sorted(uid for uid in uids if uid > self.last_uid)
+
+    def fetch(self, uid):
+        """
+        Download just the headers, and text, of a single email
+        """
+        typ, data = self.conn.uid(
+            'FETCH', str(uid),
+            '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)] BODY.PEEK[1])')
+        parts = [part[1] for part in data if isinstance(part, tuple)]
+        header, text = parts[0], parts[1] if len(parts) > 1 else b''
+
+        message = BytesParser().parsebytes(header, headersonly=True)
+        message.set_payload(text.decode('utf-8', errors='replace'))
+        return message
+
+    def fetch_new(self, subject=None):
+        messages = []
+        try:
+            self.connection()
+            for uid in self.search(subject):
+                messages.append((str(uid), self.fetch(uid)))
+                self.last_uid = uid
+        except (imaplib.IMAP4.error, OSError) as e:
+            # (whatever we did get, we still hand over)
+            self.drop(e)
+        return messages
+
+    def wait(self, timeout):
+        """
+        Ask the server to tell us as soon as new mail arrives (IDLE),
+        giving up after timeout seconds.
+        Servers drop idling connections now and then (e.g. after half an
+        hour), which is noticed, and the connection started over
+        """
+        try:
+            conn = self.connection()
+            if 'IDLE' not in conn.capabilities:
+                return super().wait(timeout)
+
+            tag = conn._new_tag()
+            conn.send(tag + b' IDLE\r\n')
+            if not read_line(conn, self.reply_timeout).startswith(b'+'):
+                raise imaplib.IMAP4.error('Server would not IDLE')
+
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not wait_readable(conn, remaining):
+                    break
+                if b'EXISTS' in read_line(conn):
+                    break
+
+            # Finish idling, reading until the server is done with it
+            # (though only for so long)
+            conn.send(b'DONE\r\n')
+            for _ in range(self.max_done_lines):
+                if read_line(conn, self.reply_timeout).startswith(tag):
+                    break
+            else:
+                raise imaplib.IMAP4.abort('Server never finished idling')
+        except (imaplib.IMAP4.error, OSError) as e:
+            self.drop(e)
+            time.sleep(timeout)
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+            self.conn = None
+
+
+def wait_readable(conn, timeout):
+    """
+    Wait (up to timeout seconds) for there to be something to read from
+    an IMAP connection, returning whether there is
+    """
+    if buffered(conn):
+        return True
+    ready, _, _ = select.select([conn.sock], [], [], timeout)
+    return bool(ready)
+
+
+def buffered(conn):
+    """
+    Whether an IMAP connection has already read something off its socket,
+    that it has yet to hand over (which select can't see)
+    """
+    # (SSL keeps decrypted data of its own)
+    if getattr(conn.sock, 'pending', lambda: 0)():
+        return True
+    timeout = conn.sock.gettimeout()
+    conn.sock.setblocking(False)
+    try:
+        return bool(conn.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        conn.sock.settimeout(timeout)
+
+
+def read_line(conn, timeout=None):
+    """
+    Read a line from an IMAP connection (first waiting up to timeout
+    seconds for one, if given), raising an abort if the server closed it
+    (imaplib just hands back nothing)
+    """
+    if timeout is not None and not wait_readable(conn, timeout):
+        raise imaplib.IMAP4.abort('Timed out waiting on the server')
+    line = conn.readline()
+    if not line:
+        raise imaplib.IMAP4.abort('Connection closed by the server')
+    return line
+
+
+class Outbox():
+    """
+    A queue of emails to send, which a background thread sends out over
+    a single kept open SMTP connection (shared by every match), so
+    sending an email never holds up a game.
+    Each email is first written to a spool folder, and only removed
+    once sent, so emails still waiting survive a crash
+    """
+
+    # How long to keep an unused connection open (in seconds)
+    idle_timeout = 60
+    # Retries wait twice as long each time, up to a limit (in seconds)
+    first_retry_wait = 1
+    last_retry_wait = 300
+    # After this many tries, an email is put aside as failed
+    max_tries = 10
+
+    def __init__(self, host, port, username, password,
+                 spool_folder='assets/outbox', connect=None):
+        """
+        The connect function, given (host, port), should return an
+        smtplib.SMTP-like connection (by default, a real SSL one)
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.spool_folder = spool_folder
+        if connect is None:
+            connect = smtplib.SMTP_SSL
+        self.connect = connect
+
+        self.conn = None
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        # Keeps spool file names unique, and in the order they were sent
+        self.counter = itertools.count()
+
+    def start(self):
+        """
+        Start the background sender (if it isn't already),
+        first queuing up any emails left over from last time
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            os.makedirs(self.spool_folder, exist_ok=True)
+            for file_name in sorted(os.listdir(self.spool_folder)):
+                if file_name.endswith('.json'):
+                    self.queue.put(os.path.join(self.spool_folder, file_name))
+            self.thread = threading.Thread(
+                target=self.run, name='outbox', daemon=True)
+            self.thread.start()
+
+    def send(self, msg, sender, targets):
+        """
+        Queue an email to be sent (returns right away)
+        """
+        self.start()
+        file_name = os.path.join(
+            self.spool_folder,
+            f'{time.time_ns()}-{next(self.counter):06}.json')
+        with open(f'{file_name}.tmp', 'w') as f:
+            json.dump({'sender': sender, 'targets': targets,
+                       'message': msg.as_string()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{file_name}.tmp', file_name)
+        self.queue.put(file_name)
+
+    def run(self):
+        """
+        Send queued emails, one after another, forever
+        (letting go of the connection when there is nothing to send)
+        """
+        while True:
+            try:
+                file_name = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self.disconnect()
+                continue
+            self.send_spooled(file_name)
+            self.queue.task_done()
+
+    def send_spooled(self, file_name):
+        """
+        Send a spooled email, retrying (and reconnecting) with
+        longer and longer waits if it doesn't go through
+        """
+        with open(file_name) as f:
+            spooled = json.load(f)
+
+        wait = self.first_retry_wait
+        for attempt in range(self.max_tries):
+            try:
+                start = time.monotonic()
+                self.connection().sendmail(
+                    spooled['sender'], spooled['targets'],
+                    spooled['message'])
+                metrics.METRICS.record(
+                    'mail_send', seconds=time.monotonic() - start,
+                    queued_seconds=spool_age(file_name), tries=attempt + 1)
+                os.remove(file_name)
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                print(f'Error sending email {file_name} '
+                      f'(try {attempt + 1}): {str(e)}')
+                self.disconnect()
+                time.sleep(wait)
+                wait = min(wait * 2, self.last_retry_wait)
+
+        # Put it aside, so it isn't retried forever
+        metrics.METRICS.count('mail_send_failures')
+        os.replace(file_name, f'{file_name}.failed')
+
+    def connection(self):
+        """
+        Return our connection, logging in (again) if need be
+        """
+        if self.conn is None:
+            conn = self.connect(self.host, self.port)
+            conn.login(self.username, self.password)
+            self.conn = conn
+        return self.conn
+
+    def disconnect(self):
+        """
+        Close the connection (if we have one)
+        """
+        if self.conn is None:
+            return
+        try:
+            self.conn.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.conn = None
+
+    def flush(self):
+        """
+        Wait until every queued email has been sent (or put aside)
+        """
+        self.queue.join()
+
+
+def spool_age(file_name):
+    """
+    How long ago (in seconds) a spooled email was queued
+    (its file name starts with the time it was queued, in nanoseconds)
+    """
+    queued = os.path.basename(file_name).split('-')[0]
+    if not queued.isdigit():
+        return None
+    return (time.time_ns() - int(queued)) / 1e9
+
+
+def is_from(message, targets):
+    """
+    Check that an email was sent by one of the targets
+    """
+    return any(t in message.get('From', '') for t in targets)
+
+
+def has_subject(message, subject):
+    """
+    Check that an email's subject contains the given subject
+    (ignoring special chars)
+    """
+    if subject is None:
+        return True
+    msg_subject = re.sub(r'\W+', '', message.get('Subject', ''))
+    return re.sub(r'\W+', '', subject) in msg_subject
+
+
+# The outbox every match in this process sends through
+OUTBOX = None
+OUTBOX_LOCK = threading.Lock()
+
+
+def get_outbox(config):
+    """
+    Return the process-wide outbox (creating it if need be, and starting
+    it right away, so emails left over from a crash are sent even if
+    no new ones are)
+    """
+    global OUTBOX
+    with OUTBOX_LOCK:
+        if OUTBOX is None:
+            OUTBOX = Outbox(config.smtp_ssl_host, config.smtp_ssl_port,
+                            config.username, config.password)
+            OUTBOX.start()
+        return OUTBOX
+
+
+def get_inbound_transport(config):
+    """
+    Create the transport named in the config (inbound: imap or pop3)
+    """
+    kind = getattr(config, 'inbound', 'pop3')
+    if kind == 'imap':
+        return IMAPTransport(
+            config.imap_ssl_host, config.imap_ssl_port,
+            config.username, config.password, config.targets,
+            use_ssl=getattr(config, 'imap_use_ssl', True))
+    if kind == 'pop3':
+        return POP3Transport(
+            getattr(config, 'pop_ssl_host', 'mail.gandi.net'),
+            config.username, config.password, config.targets)
+    raise ValueError(f'Unknown inbound mail transport: {kind}')
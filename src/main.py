@@ -1,26 +1,133 @@
 import sys
 import os
+import time
 from datetime import timedelta
 
-from referee import Referee
-from player import TerminalPlayer
-from stockfish_player import StockfishPlayer
-from email_player import EmailPlayer
+# Note: modules are only imported once we know what they are needed for
+# (e.g. a local game never touches the email modules, and analysing a
+# board never touches the game modules), so short runs start quickly.
+# Time them with: python src/benchmark.py --only startup
+
+# How long a one-shot analysis searches for (in seconds),
+# and how many of the best moves it lists
+ANALYSE_TIME = 0.1
+ANALYSE_LINES = 5
 
 
 def main():
     """
     Start games on and on forever
+    (several at once, if a number of games is given),
+    or with 'analyse', just analyse a board and quit
+    """
+    if len(sys.argv) > 1 and sys.argv[1] == 'analyse':
+        fen = sys.argv[2] if len(sys.argv) > 2 else None
+        seconds = float(sys.argv[3]) if len(sys.argv) > 3 else ANALYSE_TIME
+        print(analyse(fen, seconds))
+        return
+
+    scheduler = prepare(get_mode())
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        # Games still blocked (on someone typing, or on stockfish) are
+        # left behind: once everything is written out and closed,
+        # we exit without waiting on them
+        print('\nStopping')
+        scheduler.close()
+        close()
+        sys.stdout.flush()
+        os._exit(130)
+    finally:
+        close()
+
+
+def get_mode():
+    """
+    Which kind of games to play: 'email', 'fishes' (stockfish against
+    itself), or 'local' (against someone at this terminal)
     """
+    for mode in ('email', 'fishes'):
+        if mode in sys.argv:
+            return mode
+    return 'local'
+
+
+def prepare(mode):
+    """
+    Import, and set up, everything the games of the given mode need,
+    returning the scheduler to play them with
+    """
+    import engine_pool
+    import metrics
+    from scheduler import Scheduler, AsyncScheduler
+
+    if mode == 'email':
+        # Because we may want to kill this PID later on
+        print(f'PID: {os.getpid()}')
+
+    games = get_game_count()
+    print(f'Playing {games} game(s) at once - ({get_turn_time()} per turn)')
+    # Up to one engine per game, but no more than we have cores for
+    engine_pool.POOL.size = max(min(games, os.cpu_count() or 1), 1)
+
+    # Keep a record of where the time goes (and, if asked, serve it up
+    # for Prometheus to scrape)
+    metrics.METRICS = metrics.Metrics(metrics.METRICS_FILE)
+    if 'metrics' in sys.argv:
+        port = metrics.METRICS.serve()
+        if port is not None:
+            print(f'Serving metrics at http://127.0.0.1:{port}/metrics')
+
+    # (so the first game doesn't pay for importing its players)
+    get_player_classes(mode)
+
     # Note: the reason we start new games rather than just using the same
     # players is because, for now, we want new email games to use new names
-    while True:
-        start_game()
+    # (the engines, however, are kept running from game to game)
+    # Games can also all be played on one event loop, rather than a thread
+    # each (so lots of email games, mostly waiting, cost next to nothing)
+    scheduler_class = AsyncScheduler if 'async' in sys.argv else Scheduler
+    return scheduler_class(make_players, games=games)
 
 
-def start_game():
+def close():
+    """
+    Close everything the games left open
     """
-    Create new players, and play a single game
+    import engine_pool
+    import eval_cache
+    import tablebase
+    import opening_book
+    import metrics
+    import store
+
+    # Engines need to be killed to allow the script to exit
+    engine_pool.POOL.close()
+    eval_cache.CACHE.close()
+    tablebase.TABLEBASE.close()
+    opening_book.BOOK.close()
+    metrics.METRICS.close()
+    store.STORE.close()
+
+
+def get_game_count():
+    """
+    How many games to play at once
+    (the first number given as an argument, default 1)
+    """
+    # Only games where no-one types into this terminal can share it
+    if get_mode() == 'local':
+        return 1
+    for arg in sys.argv[1:]:
+        if arg.isdigit():
+            return max(int(arg), 1)
+    return 1
+
+
+def get_turn_time():
+    """
+    How long the AI gets to think each turn
     """
     # TODO rudimentary, but works for now
     turn_time = timedelta(seconds=10)
@@ -28,22 +135,78 @@ def start_game():
         turn_time = timedelta(seconds=1)
     elif '30m' in sys.argv:
         turn_time = timedelta(minutes=30)
+    return turn_time
 
-    white = StockfishPlayer(turn_time=turn_time)
 
-    if 'email' in sys.argv:
-        # Because we may want to kill this PID later on
-        print(f'PID: {os.getpid()}')
-        black = EmailPlayer()
-    elif 'fishes' in sys.argv:
-        black = StockfishPlayer(turn_time=turn_time)
+def get_player_classes(mode):
+    """
+    Return the (white, black) player classes of the given mode
+    (only importing the ones it needs)
+    """
+    from stockfish_player import StockfishPlayer
+
+    if mode == 'email':
+        from email_player import EmailPlayer
+        return StockfishPlayer, EmailPlayer
+    if mode == 'fishes':
+        return StockfishPlayer, StockfishPlayer
+    from player import TerminalPlayer
+    return StockfishPlayer, TerminalPlayer
+
+
+def make_players():
+    """
+    Create the new players for a single game
+    """
+    white_class, black_class = get_player_classes(get_mode())
+    turn_time = get_turn_time()
+    # Stockfish can limit its own strength, rather than us picking
+    # from all of its moves (much cheaper, when running lots of games)
+    strength = 'skill' if 'skill' in sys.argv else 'sample'
+    white = white_class(turn_time=turn_time, strength=strength)
+
+    if black_class is white_class:
+        black = black_class(turn_time=turn_time, strength=strength)
     else:
-        black = TerminalPlayer()
+        black = black_class()
+    return white, black
+
+
+def analyse(fen=None, seconds=ANALYSE_TIME):
+    """
+    Return stockfish's best few moves for a board (given as a fen,
+    by default the starting board), searching for the given time
+    e.g. python src/main.py analyse "<fen>" [seconds]
+    """
+    import chess
+    from chess.engine import Limit
+    import engine_pool
+    from analysis import MoveAnalysis, TurnAnalysis
+    from parser import translate
+
+    board = chess.Board(fen) if fen else chess.Board()
+    if board.is_game_over():
+        return f'Game over: {board.result()}'
 
-    print(f'Starting game with {white} vs {black} - ({turn_time} per turn)')
-    r = Referee(white, black)
+    start = time.monotonic()
+    lines = min(board.legal_moves.count(), ANALYSE_LINES)
+    try:
+        with engine_pool.POOL.borrow() as engine:
+            infos = engine.analyse(board, Limit(time=seconds), multipv=lines)
+    finally:
+        engine_pool.POOL.close()
+    analysis = TurnAnalysis(
+        board.fen(), [MoveAnalysis.from_info(info) for info in infos
+                      if 'pv' in info and 'score' in info],
+        elapsed=time.monotonic() - start)
 
-    r.play_game()
+    text = [f'{board}\n\n{board.fen()}\n']
+    for i, line in enumerate(analysis):
+        text.append(f'{i + 1}. {line.move.uci():<6} {str(line.score):>6} '
+                    f'(depth {line.depth}) {translate(board, line.move)}')
+    text.append(f'({analysis.elapsed:.2f}s)')
+    return '\n'.join(text)
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,27 @@
 # File for using random nouns and verbs to generate a chess match name
 import random as rand
+from functools import lru_cache
 
-noun_file = open('assets/nouns.txt', 'r')
-nouns = [l for l in noun_file.readlines()]
-adjective_file = open('assets/adjectives.txt', 'r')
-adjectives = [l for l in adjective_file.readlines()]
+NOUNS_FILE = 'assets/nouns.txt'
+ADJECTIVES_FILE = 'assets/adjectives.txt'
+
+
+@lru_cache(maxsize=None)
+def read_words(file_name):
+    """
+    Return the lines of a word file
+    (read the first time they are needed, rather than on import)
+    """
+    with open(file_name, 'r') as f:
+        return f.readlines()
 
 
 def generate_adjective():
-    return rand.choice(adjectives)
+    return rand.choice(read_words(ADJECTIVES_FILE))
 
 
 def generate_noun():
-    return rand.choice(nouns)
+    return rand.choice(read_words(NOUNS_FILE))
 
 
 def generate_match_name():
@@ -0,0 +1,208 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Where the daemon writes its metrics (see main.py)
+METRICS_FILE = 'assets/metrics.jsonl'
+# The port the (local only) Prometheus endpoint listens on
+METRICS_PORT = 9108
+
+# Every metric name on the endpoint starts with this
+PREFIX = 'chess_'
+# Numeric fields that mean nothing added up (only written to the file)
+# (e.g. nodes per second comes from the totals of nodes and seconds)
+UNSUMMED = ('ply', 'nps')
+
+
+class Metrics():
+    """
+    Where the timings (and other numbers) of a running program go,
+    so we can see where the time goes without attaching a profiler.
+    Every event (a ply played, an engine search, a mail check, etc) is
+    written as a line of JSON to a metrics file, which is rotated once
+    it gets too big (keeping a few of the old ones around).
+    Each event (and numeric field of it) is also added up in memory,
+    which can be served up Prometheus-style over HTTP (see serve)
+    """
+
+    def __init__(self, file_name=None, max_bytes=5 * 1024 * 1024,
+                 backups=3):
+        """
+        With no file name, nothing is written (only added up in memory).
+        Once the file passes 'max_bytes' it becomes file_name.1
+        (and the old file_name.1 becomes file_name.2, etc, up to 'backups')
+        """
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self.file = None
+        self.server = None
+        self.lock = threading.Lock()
+        # (metric name, labels) to its running total
+        self.totals = defaultdict(float)
+
+    def record(self, event, labels=None, **fields):
+        """
+        Record that something happened, along with any numbers (or other
+        details) about it, e.g.
+        record('ply', labels={'player': 'white'}, seconds=1.5, move='e2e4').
+        Labels (a dict of a few, repeating, values) tell apart totals on the
+        endpoint, while only numeric (and true or false) fields are added
+        up (the rest only go into the file)
+        """
+        labels = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            self.totals[f'{event}_total', labels] += 1
+            for field, value in fields.items():
+                if field in UNSUMMED:
+                    continue
+                # (true or false fields count how often they were true,
+                # numbers are added up, e.g. ply_seconds_total)
+                if isinstance(value, (int, float)):
+                    self.totals[f'{event}_{field}_total', labels] += value
+
+            if self.file_name is None:
+                return
+            line = {'time': round(time.time(), 3), 'event': event}
+            line.update(labels)
+            line.update(fields)
+            self.write(json.dumps(line, default=str) + '\n')
+
+    def count(self, name, amount=1, labels=None):
+        """
+        Add to a counter, without writing anything to the file
+        (for things that happen far too often to each get a line)
+        """
+        labels = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            self.totals[f'{name}_total', labels] += amount
+
+    def write(self, line):
+        """
+        Write a line to the file, first rotating it if it is full
+        (call with the lock held)
+        """
+        if self.file is None:
+            folder = os.path.dirname(self.file_name)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self.file = open(self.file_name, 'a')
+        if self.file.tell() + len(line) > self.max_bytes:
+            self.rotate()
+        self.file.write(line)
+        # (a line at a time, so a crash only loses the line being written)
+        self.file.flush()
+
+    def rotate(self):
+        """
+        Move the full file out of the way (dropping the oldest backup),
+        and start a new one
+        """
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.file_name}.{i}'):
+                os.replace(f'{self.file_name}.{i}',
+                           f'{self.file_name}.{i + 1}')
+        if self.backups:
+            os.replace(self.file_name, f'{self.file_name}.1')
+        else:
+            os.remove(self.file_name)
+        self.file = open(self.file_name, 'a')
+
+    def get(self, name, labels=None):
+        """
+        Return the running total of a metric (0 if never recorded)
+        """
+        labels = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            return self.totals.get((name, labels), 0)
+
+    def exposition(self):
+        """
+        Return every running total in Prometheus' text format
+        """
+        with self.lock:
+            totals = sorted(self.totals.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in totals:
+            name = PREFIX + name
+            if name not in typed:
+                # (every total is a count or a sum, which only go up,
+                # and counters have to end in _total)
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            label_text = ','.join(f'{key}="{escape(value)}"'
+                                  for key, value in labels)
+            if label_text:
+                name = f'{name}{{{label_text}}}'
+            lines.append(f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=METRICS_PORT, host='127.0.0.1'):
+        """
+        Serve the running totals at http://host:port/metrics,
+        from a background thread (only to this machine, by default).
+        Returns the port, or None if it couldn't be listened on
+        (e.g. another copy of the program already has it), in which case
+        everything is still recorded, just not served
+        """
+        # (only imported when serving, as it is slow to import)
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # (scrapes would otherwise fill up the log)
+                return
+
+        try:
+            self.server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print(f'Not serving metrics on port {port}: {e}')
+            return None
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics',
+                         daemon=True).start()
+        return self.server.server_address[1]
+
+    def close(self):
+        """
+        Stop serving, and close the file
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def escape(value):
+    """
+    Escape a label value for Prometheus' text format
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+# Where everything in this process records its metrics
+# (only in memory, unless swapped for one with a file, as main.py does)
+METRICS = Metrics()
@@ -0,0 +1,236 @@
+import glob
+import os
+import random as rand
+import struct
+import sys
+import threading
+from collections import defaultdict
+
+import chess
+import chess.polyglot
+
+# Each polyglot book entry is a (big-endian) zobrist key, move,
+# weight, and learn value, with the entries sorted by key
+ENTRY = struct.Struct('>QHHI')
+MAX_WEIGHT = 0xFFFF
+
+# Points a move gets for each game that went on to be won, drawn or lost
+# (by whoever made the move)
+WIN_POINTS = 2
+DRAW_POINTS = 1
+
+
+class OpeningBook():
+    """
+    Polyglot opening books, which give the moves to play (and how often to
+    play each) in positions we have seen before, without any searching.
+    Any book kept at 'file_name' (e.g. a downloaded one) is only ever read,
+    while our own book (at 'own_file_name') is built up from the games
+    we finish. Books are opened once, and kept open across games
+    """
+
+    def __init__(self, file_name='assets/book.bin',
+                 own_file_name='assets/own-book.bin', max_plies=16):
+        """
+        Only the first 'max_plies' moves of each game go into our own book
+        """
+        self.file_name = file_name
+        self.own_file_name = own_file_name
+        self.max_plies = max_plies
+
+        # File name to its open reader (only for the books that exist)
+        self.readers = None
+        self.lock = threading.RLock()
+
+    def open(self):
+        """
+        Open whichever of the books exist (if not already open)
+        """
+        with self.lock:
+            if self.readers is not None:
+                return
+            self.readers = {}
+            for file_name in (self.file_name, self.own_file_name):
+                if file_name and os.path.exists(file_name) and \
+                        os.path.getsize(file_name):
+                    self.readers[file_name] = \
+                        chess.polyglot.open_reader(file_name)
+
+    def close(self):
+        """
+        Close any books we opened
+        """
+        with self.lock:
+            for reader in (self.readers or {}).values():
+                reader.close()
+            self.readers = None
+
+    def find(self, board):
+        """
+        Return a dict of each book move for the board, to its weight
+        (adding together the weights from each book)
+        """
+        with self.lock:
+            self.open()
+            weights = defaultdict(int)
+            for reader in self.readers.values():
+                for entry in reader.find_all(board):
+                    weights[entry.move] += entry.weight
+            return dict(weights)
+
+    def choose(self, board, difficulty, rng=rand):
+        """
+        Pick a book move for the board (or return None, if there is none).
+        Like choosing from stockfish's ranking, the book moves are cut down
+        to the top (1 - difficulty) of them, and one of those is picked at
+        random (in proportion to its weight)
+        """
+        weights = self.find(board)
+        if not weights:
+            return None
+        moves = sorted(weights, key=weights.get, reverse=True)
+        limit = max(int(len(moves) * (1 - difficulty)), 1)
+        moves = moves[:limit]
+        return rng.choices(moves, [weights[m] for m in moves])[0]
+
+    def add_games(self, games):
+        """
+        Add finished games, each given as (starting fen, list of moves,
+        result), to our own book (rewriting it, so readers never see
+        a half written book)
+        """
+        with self.lock:
+            self.open()
+            points = self.read_points()
+            for fen, moves, result in games:
+                self.score_game(points, fen, moves, result)
+            self.write_points(points)
+            self.close()
+
+    def read_points(self):
+        """
+        Return the (zobrist key, raw polyglot move) to weight of every
+        entry in our own book
+        """
+        points = defaultdict(int)
+        reader = self.readers.get(self.own_file_name)
+        if reader is not None:
+            for i in range(len(reader)):
+                entry = reader[i]
+                points[entry.key, entry.raw_move] += entry.weight
+        return points
+
+    def score_game(self, points, fen, moves, result):
+        """
+        Give points to each of the (first few) moves of a finished game,
+        depending on how it went for whoever made the move
+        """
+        if result not in ('1-0', '0-1', '1/2-1/2'):
+            return
+        board = chess.Board(fen)
+        for move in moves[:self.max_plies]:
+            if not board.is_legal(move):
+                return
+            if result == '1/2-1/2':
+                earned = DRAW_POINTS
+            elif (result == '1-0') == (board.turn == chess.WHITE):
+                earned = WIN_POINTS
+            else:
+                earned = 0
+            # (a move that only ever loses stays in, but is never played)
+            points[chess.polyglot.zobrist_hash(board),
+                   raw_move(board, move)] += earned
+            board.push(move)
+
+    def write_points(self, points):
+        """
+        Write (key, raw move) to weight out as our own polyglot book
+        """
+        # Weights have to fit into 16 bits, so scale them all down if need be
+        scale = max(max(points.values(), default=0) / MAX_WEIGHT, 1)
+        entries = sorted((key, move, int(weight / scale))
+                         for (key, move), weight in points.items())
+
+        with open(f'{self.own_file_name}.tmp', 'wb') as f:
+            for key, move, weight in entries:
+                f.write(ENTRY.pack(key, move, weight, 0))
+        os.replace(f'{self.own_file_name}.tmp', self.own_file_name)
+
+    def build(self, journal_names):
+        """
+        Start our own book over, from the finished games in the
+        given journals (and their archives)
+        """
+        with self.lock:
+            self.close()
+            if os.path.exists(self.own_file_name):
+                os.remove(self.own_file_name)
+            self.add_games(read_games(journal_names))
+
+
+def raw_move(board, move):
+    """
+    Encode a move the way polyglot books do
+    (castling is written as the king taking its own rook)
+    """
+    to_square = move.to_square
+    if board.is_castling(move):
+        rook_file = 7 if board.is_kingside_castling(move) else 0
+        to_square = chess.square(rook_file, chess.square_rank(to_square))
+    promotion = move.promotion - 1 if move.promotion else 0
+    return to_square | move.from_square << 6 | promotion << 12
+
+
+def read_games(journal_names):
+    """
+    Return every finished game in the given journal files,
+    as (starting fen, list of moves, result)
+    """
+    games = []
+    for file_name in journal_names:
+        if os.path.exists(file_name):
+            with open(file_name) as f:
+                games += parse_games(
+                    line.rstrip('\n').split('\t') for line in f)
+    return games
+
+
+def parse_games(records):
+    """
+    Given journal records (kind, timestamp, data, fen), return every
+    finished game in them, as (starting fen, list of moves, result).
+    A game's moves stop wherever the board was changed by a code
+    (a resign, a load, etc) rather than by a move
+    """
+    games = []
+    board, moves, following = None, [], False
+    for record in records:
+        if len(record) != 4:
+            continue
+        kind, timestamp, data, fen = record
+        if kind == 'start':
+            board, moves, following = chess.Board(fen), [], True
+        elif kind == 'move' and board is not None and following:
+            move = chess.Move.from_uci(data)
+            following = board.is_legal(move)
+            if following:
+                board.push(move)
+                following = board.fen() == fen
+            if following:
+                moves.append(move)
+        elif kind == 'end' and board is not None:
+            games.append((board.root().fen(), moves, data))
+            board = None
+    return games
+
+
+# The books every game in this process reads from (and adds to)
+BOOK = OpeningBook()
+
+
+if __name__ == '__main__':
+    # Rebuild our own book from our journals (by default, all of them)
+    # e.g. python src/opening_book.py assets/journal-archive.txt
+    journal_names = sys.argv[1:] or sorted(glob.glob('assets/journal*.txt'))
+    BOOK.build(journal_names)
+    print(f'Built {BOOK.own_file_name} from {journal_names}')
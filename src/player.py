@@ -13,6 +13,9 @@ class Player(ABC):
     referee = None
     # Similarly, their 'white' or 'black' names will be given
     name = None
+    # Players that analyse their moves (like stockfish) keep the
+    # TurnAnalysis of their latest turn here, for anyone to look at
+    analysis = None
 
     def prep(self, referee, name):
         """
@@ -44,6 +47,15 @@ class Player(ABC):
         """
         pass
 
+    def ponder(self):
+        """
+        It is the other player's turn, and the referee is about to wait
+        on their move. A player who can make use of that time (e.g. an
+        AI thinking ahead) can start doing so here,
+        but this must return right away rather than block
+        """
+        pass
+
     @abstractmethod
     def hear(sefl, s):
         """
@@ -68,6 +80,28 @@ class Player(ABC):
         # This player has drawn a match
         pass
 
+    def checkpoint(self):
+        """
+        Return what this player needs to carry on a game after a crash
+        (as a JSON-able dict), see restore
+        """
+        return {}
+
+    @classmethod
+    def restore(cls, state):
+        """
+        Create the player again from what checkpoint returned
+        """
+        return cls(**state)
+
+    def identity(self):
+        """
+        Who this player is, from game to game (e.g. so an AI can keep
+        a difficulty per opponent, see store).
+        By default, every player of a kind is taken to be the same person
+        """
+        return self.__class__.__name__
+
     def __str__(self):
         return f'{self.__class__.__name__} - {self.name}'
 
@@ -119,3 +153,6 @@ class QueuePlayer(TerminalPlayer):
         if not self.moves:
             return '*resign'
         return self.moves.pop(0)
+
+    def checkpoint(self):
+        return {'moves': list(self.moves)}
@@ -1,8 +1,12 @@
+import time
+
 import chess  # python-chess chess board management
 
 from code_checker import CodeChecker
 from parser import UCIParser
-import save_file
+from journal import MemoryJournal
+from game_state import GameState, Ply
+import metrics
 
 
 class Referee():
@@ -16,10 +20,14 @@ class Referee():
     # Gives us a boolean we can set to false if we want the games to stop
     running = True
 
-    def __init__(self, white_player, black_player):
+    def __init__(self, white_player, black_player, journal=None,
+                 checkpoint=None):
         """
         Given the two players for this set of games, initialize the
         referee to be able to play continual chess games when 'run' is called
+        (every move is recorded to the given journal, or if not given,
+        one only kept in memory, and if given a Checkpoint, the players
+        are kept in it, so the game can be resumed after a crash)
         """
         self.white_player = white_player
         self.black_player = black_player
@@ -31,24 +39,69 @@ class Referee():
         self.code_checker = CodeChecker(self)
         # Allows us to translate UCI to english
         self.parser = UCIParser(self)
+        # Keeps a record of every board, to recover from crashes or mistakes
+        if journal is None:
+            journal = MemoryJournal()
+        self.journal = journal
+        self.checkpoint = checkpoint
 
-    def play_game(self):
+    def play_game(self, board=None, resume=False):
         """
-        Play a single game of chess, when the game ends,
-        informing both the winner and looser of their status
+        Play a single game of chess (from the given board, or a new one),
+        when the game ends, informing both the winner and looser
+        of their status.
+        If resuming, the board is the one the journal's unfinished game
+        was left on (so the game carries on in the journal, rather than
+        starting a new one)
         TODO is that what we should return?
         """
-        self.board = chess.Board()
+        self.begin_game(board, resume)
         while self.running and not self.board.is_game_over():
+            # Let whoever is waiting make use of the time
+            self.opponent().ponder()
+            start = time.monotonic()
             move = self.get_move()
-            self.board.push(move)
-            self.active_player().hear_move(move)
+            self.play_move(move, time.monotonic() - start)
+        self.finish_game()
 
-            self.commit_fen()
+    def begin_game(self, board=None, resume=False):
+        """
+        Set up the board, and journal, for a game (see play_game)
+        """
+        self.game = GameState(board)
+        # The analysis behind the last move played (if the player had one)
+        self.analysis = None
+        if not resume:
+            self.journal.start_game(self.board.fen())
+        self.save_checkpoint()
+        self.game_start = time.monotonic()
 
+    def play_move(self, move, seconds):
+        """
+        Play the move the active player came up with (in the given number
+        of seconds), telling their opponent about it, and recording it
+        """
+        # Keep what the player thought of the move (if anything)
+        self.analysis = self.active_player().analysis
+        self.record_ply(move, seconds)
+        self.game.push(move, Ply.from_analysis(seconds, self.analysis))
+        self.active_player().hear_move(move)
+
+        self.commit_fen(move)
+
+    def finish_game(self):
+        """
+        Record how the game ended, and let the players know
+        """
         # TODO who wins if game was called (self.running set to false)? Draw?
 
         result = self.board.result()
+        self.journal.end_game(result, self.board.fen())
+        metrics.METRICS.record(
+            'game', result=result, plies=self.board.ply(),
+            seconds=time.monotonic() - self.game_start,
+            white_seconds=self.game.seconds(chess.WHITE),
+            black_seconds=self.game.seconds(chess.BLACK))
 
         if result == '1-0':  # If white player won
             self.white_player.win()
@@ -63,6 +116,10 @@ class Referee():
             raise ValueError(f'Unknown game end: "{result}"\n'
                              f'{self.board}\n\n{self.board.fen()}')
 
+        # (nothing left to resume)
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+
     def get_move(self):
         """
         Get a move from the active player (calling get_move).
@@ -73,39 +130,80 @@ class Referee():
         chess moves, let them know and try again.
         """
         while True:
-            try:
-                raw = self.active_player().get_move()
+            move = self.take_input(self.active_player().get_move())
+            if move is not None:
+                return move
 
-                if self.is_code(raw):
-                    # If the code returns a suggested next input,
-                    # then we will submit that
-                    move_str = self.run_code(raw)
-                    if move_str is not None:
-                        return self.to_move(move_str)
+    def take_input(self, raw):
+        """
+        Given what the active player input, return the move it comes to,
+        or None if they have to input something else (after running it,
+        if it was a code, or telling them what was wrong with it)
+        """
+        try:
+            if self.is_code(raw):
+                # If the code returns a suggested next input,
+                # then we will submit that
+                move_str = self.run_code(raw)
+                if move_str is not None:
+                    return self.to_move(move_str)
 
-                elif self.is_move(raw):
-                    return self.to_move(raw)
+            else:
+                # (the move is only parsed the once)
+                check = self.check_move(raw)
+                if check:
+                    return check.move
+                metrics.METRICS.count('bad_moves',
+                                      labels={'problem': check.problem})
+                self.active_player().hear(check.message())
 
-                else:
-                    # TODO could add more info
-                    self.active_player().hear(f'Illegal "{raw}"')
+        except ValueError as e:
+            self.active_player().hear(f'Invalid "{raw}": {e}')
+        return None
 
-            except ValueError as e:
-                self.active_player().hear(f'Invalid "{raw}": {e}')
+    def record_ply(self, move, seconds):
+        """
+        Record how long the active player took to come up with a move
+        (and, if they searched for it, how deep and how quickly)
+        """
+        # (for an async game, the player its adapter wraps)
+        player = getattr(self.active_player(), 'wrapped',
+                         self.active_player())
+        fields = {}
+        if self.analysis:
+            best = self.analysis.best()
+            fields = {'source': self.analysis.source, 'depth': best.depth,
+                      'nodes': best.nodes}
+        metrics.METRICS.record(
+            'ply', labels={'player': type(player).__name__},
+            ply=self.board.ply(), move=move.uci(), seconds=seconds, **fields)
 
-    def commit_fen(self):
+    @property
+    def board(self):
         """
-        Add the current board state to the board, so if there is a crash or
-        mistake, we can reset the board to a previous state.
+        The board being played on (see GameState)
         """
-        dikt = save_file.load()
-        dikt.setdefault('fens', [])
-        # Add to the front of the fens list (nicer looking)
-        dikt['fens'].insert(0, self.board.fen())
-        # Only keep (for now) the past 10 board states
-        while len(dikt['fens']) > 10:
-            dikt['fens'].pop()
-        save_file.save(dikt)
+        return self.game.board
+
+    @board.setter
+    def board(self, board):
+        self.game = GameState(board)
+
+    def commit_fen(self, move):
+        """
+        Add the move, and the board state it led to, to the journal, so if
+        there is a crash or mistake, we can reset the board to a previous
+        state.
+        """
+        self.journal.add_move(move, self.board.fen())
+        self.save_checkpoint()
+
+    def save_checkpoint(self):
+        """
+        Keep the players' state up to date in our checkpoint (if we have one)
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.save(self)
 
     def active_player(self, board=None):
         """
@@ -140,13 +238,24 @@ class Referee():
         (thus allowing them to, say, ask for re-input if it is not).
         Note: the move str should be a UCI move string
         """
-        # TODO should really have it return a string if there is a problem,
-        # to differentiate between invalid and illegal
+        return bool(self.check_move(move_str))
+
+    def check_move(self, move_str):
+        """
+        Check if a UCI move string is a legal move on the current board,
+        returning a MoveCheck (which is truthy if it is), which says
+        whether there was a problem with the string itself (invalid),
+        or with playing it now (illegal)
+        """
         try:
-            moves = list(self.board.legal_moves) + [chess.Move.null()]
-            return True if self.to_move(move_str) in moves else False
-        except ValueError:
-            return False
+            move = self.to_move(move_str)
+        except ValueError as e:
+            return MoveCheck(move_str, problem='invalid', reason=str(e))
+
+        # (passing the turn is always allowed)
+        if move and not self.board.is_legal(move):
+            return MoveCheck(move_str, move, problem='illegal')
+        return MoveCheck(move_str, move)
 
     def is_code(self, code_str):
         """
@@ -179,3 +288,32 @@ class Referee():
         else:
             raise ValueError(f'{player} was not black ({self.black_player}) '
                              f'nor white ({self.white_player})')
+
+
+class MoveCheck():
+    """
+    The result of checking a move string (see Referee.check_move):
+    the move it parsed to (if it could be), and what is wrong with it
+    ('invalid' if it isn't a UCI move at all, 'illegal' if it can't be
+    played on the board, or None if it's fine)
+    """
+
+    def __init__(self, move_str, move=None, problem=None, reason=None):
+        self.move_str = move_str
+        self.move = move
+        self.problem = problem
+        self.reason = reason
+
+    def __bool__(self):
+        return self.problem is None
+
+    def message(self):
+        """
+        Say what is wrong with the move, for the player
+        """
+        if self.problem == 'invalid':
+            return f'Invalid "{self.move_str}": {self.reason}'
+        if self.problem == 'illegal':
+            # TODO could add more info
+            return f'Illegal "{self.move_str}"'
+        return f'Legal "{self.move_str}"'
@@ -0,0 +1,462 @@
+import argparse
+import json
+import math
+import multiprocessing.util
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import chess
+import chess.pgn
+from chess.engine import Limit, Cp, Mate
+from chess.polyglot import zobrist_hash
+
+import engine_pool
+import eval_cache
+import metrics
+from opening_book import parse_games
+
+# How deep every position is searched (a depth, rather than a time, so
+# reviews are repeatable, and their evaluations can be cached)
+REVIEW_DEPTH = 12
+# The review's own cache of evaluations (the games' cache is keyed by
+# their turn times, so would never be of use here, and it is written to
+# by the games while they are being played)
+CACHE_FILE = 'assets/review-cache.bin'
+# How many games are reviewed between checkpoints
+BATCH_SIZE = 20
+# How many positions each worker evaluates at a time
+CHUNK_SIZE = 50
+# How much less of the CPU the workers (and their engines) get than
+# anything else (e.g. the games being played)
+NICENESS = 10
+
+# How much (in %) a move can lower the chance of winning before it is
+# a blunder, mistake, or inaccuracy (the same as lichess)
+BAD_MOVES = ((15, 'blunders', chess.pgn.NAG_BLUNDER),
+             (10, 'mistakes', chess.pgn.NAG_MISTAKE),
+             (5, 'inaccuracies', chess.pgn.NAG_DUBIOUS_MOVE))
+# What a mate is worth, in centipawns
+MATE_SCORE = 10000
+# Losing more than this many centipawns in a move counts as no more
+CP_LOSS_CAP = 1000
+
+
+class Review():
+    """
+    Reviews finished games after the fact: every position is evaluated
+    by stockfish (spread over a pool of worker processes, each with an
+    engine of its own), and each game is written out as PGN annotated
+    with its evaluations and bad moves, along with how accurately each
+    player played (e.g. to see how difficulty plays out against people).
+    Games are read (and reviewed) a batch at a time, so any number of
+    them can be reviewed in a bounded amount of memory.
+    Positions are only evaluated once, however often they come up (even
+    across reviews, see CACHE_FILE).
+    Progress (how far into each file the review got) is checkpointed
+    after every batch, so a review that is stopped (or crashes) carries
+    on where it left off when run again, and running it again once more
+    games are played only reviews those (so files are expected to only
+    ever be added to, like the journal archive).
+    The workers run at a lower priority (see NICENESS), so reviewing
+    can be left running beside the games being played
+    """
+
+    def __init__(self, file_names, out_file='assets/review.pgn',
+                 depth=REVIEW_DEPTH, workers=1, niceness=NICENESS, pause=0,
+                 batch_size=BATCH_SIZE, cache_file=CACHE_FILE):
+        """
+        Review the games in the given PGN and journal files
+        (journals are any files ending in .txt), writing them to
+        the out file, pausing for 'pause' seconds between batches
+        (to leave even more of the CPU for everything else)
+        """
+        self.file_names = file_names
+        self.out_file = out_file
+        self.progress_file = f'{out_file}.progress.json'
+        self.depth = depth
+        self.workers = workers
+        self.niceness = niceness
+        self.pause = pause
+        self.batch_size = batch_size
+        self.cache = eval_cache.EvalCache(cache_file)
+
+        # How far into each file has been reviewed, how many bytes of the
+        # out file the reviewed games take up, and each player's stats
+        self.positions = {}
+        self.out_size = 0
+        self.stats = {}
+        # How many games have been reviewed this run
+        self.reviewed = 0
+
+    def run(self):
+        """
+        Review every game not already reviewed, returning the summary
+        table of how each player played
+        """
+        self.load_progress()
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers,
+                                     initializer=lower_priority,
+                                     initargs=(self.niceness,)) as executor:
+                batch = []
+                for found in read_games(self.file_names, self.positions):
+                    batch.append(found)
+                    if len(batch) >= self.batch_size:
+                        self.review_batch(executor, batch)
+                        batch = []
+                        time.sleep(self.pause)
+                if batch:
+                    self.review_batch(executor, batch)
+        finally:
+            self.cache.close()
+        return self.summary()
+
+    def load_progress(self):
+        """
+        Pick up where the last review left off (throwing away anything
+        written to the out file after its last checkpoint)
+        """
+        try:
+            with open(self.progress_file) as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            progress = {}
+        # (progress from before positions were kept starts over)
+        if 'positions' not in progress:
+            progress = {'positions': {}, 'out_size': 0, 'stats': {}}
+        self.positions = progress['positions']
+        self.out_size = progress['out_size']
+        self.stats = progress['stats']
+        with open(self.out_file, 'a+b') as f:
+            f.truncate(self.out_size)
+
+    def save_progress(self):
+        """
+        Write the progress so far to file
+        (only once the reviewed games are on disk)
+        """
+        progress = {'positions': self.positions, 'out_size': self.out_size,
+                    'stats': self.stats}
+        with open(f'{self.progress_file}.tmp', 'w') as f:
+            json.dump(progress, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{self.progress_file}.tmp', self.progress_file)
+
+    def review_batch(self, executor, batch):
+        """
+        Evaluate, annotate and write out a batch of
+        (file name, position after the game, game), then checkpoint
+        """
+        start = time.monotonic()
+        boards = []
+        for _, _, game in batch:
+            board = game.board()
+            boards.append(board.copy(stack=False))
+            for move in game.mainline_moves():
+                board.push(move)
+                boards.append(board.copy(stack=False))
+        scores, evaluated = self.evaluate(executor, boards)
+
+        with open(self.out_file, 'a') as f:
+            for file_name, position, game in batch:
+                self.annotate(game, scores)
+                f.write(f'{game}\n\n')
+                self.positions[file_name] = position
+            f.flush()
+            os.fsync(f.fileno())
+            self.out_size = f.tell()
+        self.save_progress()
+
+        metrics.METRICS.record('review', games=len(batch),
+                               positions=len(boards), evaluated=evaluated,
+                               seconds=time.monotonic() - start)
+        self.reviewed += len(batch)
+        print(f'Reviewed {self.reviewed} games '
+              f'({evaluated} new positions evaluated)')
+
+    def evaluate(self, executor, boards):
+        """
+        Return the score of each of the boards (relative to whoever is to
+        move), keyed by its zobrist hash, along with how many had to be
+        evaluated by the engine (the rest were cached, repeats, or over)
+        """
+        limit = Limit(depth=self.depth)
+        scores = {}
+        todo = {}
+        for board in boards:
+            key = zobrist_hash(board)
+            if key in scores or key in todo:
+                continue
+            score = game_over_score(board)
+            if score is None:
+                score = self.cache.get(board, limit)
+            if score is None:
+                todo[key] = board
+            else:
+                scores[key] = score
+
+        keys = list(todo)
+        chunks = [keys[i:i + CHUNK_SIZE]
+                  for i in range(0, len(keys), CHUNK_SIZE)]
+        fens = [[todo[key].fen() for key in chunk] for chunk in chunks]
+        for chunk, results in zip(chunks, executor.map(
+                evaluate, fens, [self.depth] * len(chunks))):
+            for key, (kind, value, depth) in zip(chunk, results):
+                score = eval_cache.to_score(kind, value)
+                self.cache.put(todo[key], limit, score, depth)
+                scores[key] = score
+        return scores, len(keys)
+
+    def annotate(self, game, scores):
+        """
+        Add the evaluation after every move, and mark the bad ones, then
+        add up how accurately each player played (to the game's headers,
+        and each player's stats)
+        """
+        board = game.board()
+        names = {color: player_name(game, color)
+                 for color in (chess.WHITE, chess.BLACK)}
+        totals = {color: new_totals() for color in names}
+        for node in game.mainline():
+            mover = board.turn
+            before = scores[zobrist_hash(board)]
+            board.push(node.move)
+            after = -scores[zobrist_hash(board)]
+
+            # (evaluations are written from white's point of view)
+            white_after = after if mover == chess.WHITE else -after
+            node.comment = f'[%eval {format_score(white_after)}]'
+
+            lost = win_chance(before) - win_chance(after)
+            cp_loss = min(max(to_cp(before) - to_cp(after), 0), CP_LOSS_CAP)
+            counts = totals[mover]
+            counts['moves'] += 1
+            counts['accuracy'] += move_accuracy(lost)
+            counts['cp_loss'] += cp_loss
+            for threshold, kind, nag in BAD_MOVES:
+                if lost >= threshold:
+                    counts[kind] += 1
+                    node.nags.add(nag)
+                    break
+
+        for color, counts in totals.items():
+            side = 'White' if color == chess.WHITE else 'Black'
+            if counts['moves']:
+                accuracy = counts['accuracy'] / counts['moves']
+                game.headers[f'{side}Accuracy'] = f'{accuracy:.1f}'
+                game.headers[f'{side}ACPL'] = \
+                    f'{counts["cp_loss"] / counts["moves"]:.0f}'
+            game.headers[f'{side}Blunders'] = str(counts['blunders'])
+            stats = self.stats.setdefault(names[color], new_totals())
+            stats['games'] += 1
+            for kind, value in counts.items():
+                if kind != 'games':
+                    stats[kind] += value
+        game.headers['Annotator'] = f'Stockfish (depth {self.depth})'
+
+    def summary(self):
+        """
+        Return a table of how accurately each player played,
+        over every game reviewed
+        """
+        lines = [f'{"Player":<30} {"Games":>5} {"Moves":>6} '
+                 f'{"Accuracy":>8} {"ACPL":>5} {"?!":>4} {"?":>4} {"??":>4}']
+        for name, stats in sorted(self.stats.items()):
+            moves = max(stats['moves'], 1)
+            lines.append(
+                f'{name:<30} {stats["games"]:>5} {stats["moves"]:>6} '
+                f'{stats["accuracy"] / moves:>7.1f}% '
+                f'{stats["cp_loss"] / moves:>5.0f} '
+                f'{stats["inaccuracies"]:>4} {stats["mistakes"]:>4} '
+                f'{stats["blunders"]:>4}')
+        return '\n'.join(lines)
+
+
+def lower_priority(niceness):
+    """
+    Set up a worker process: run it (and the engine it starts) at a lower
+    priority, with an engine pool of its own, whose engine is kept for
+    as long as the worker runs (and quit when it exits)
+    """
+    os.nice(niceness)
+    # (the pool this process was forked with belongs to the parent)
+    engine_pool.POOL = engine_pool.EnginePool()
+    # (workers exit without running atexit, but do run these)
+    multiprocessing.util.Finalize(None, engine_pool.POOL.close,
+                                  exitpriority=10)
+
+
+def evaluate(fens, depth):
+    """
+    Evaluate each board (in a worker process), returning each one's score
+    (relative to whoever is to move) as (kind, value, depth searched)
+    """
+    results = []
+    with engine_pool.POOL.borrow() as engine:
+        for fen in fens:
+            info = engine.analyse(chess.Board(fen), Limit(depth=depth))
+            kind, value = eval_cache.from_score(info['score'].relative)
+            results.append((kind, value, info.get('depth', depth)))
+    return results
+
+
+def read_games(file_names, positions=None):
+    """
+    Read the finished games out of PGN files and journals (files ending
+    in .txt), one at a time, starting each file from the given position
+    (if any), as (file name, position after the game, game)
+    """
+    positions = positions or {}
+    for file_name in file_names:
+        if not os.path.exists(file_name):
+            continue
+        position = positions.get(file_name, 0)
+        # (a file smaller than where we got to must have been started over)
+        if os.path.getsize(file_name) < position:
+            position = 0
+        if file_name.endswith('.txt'):
+            yield from read_journal(file_name, position)
+            continue
+        with open(file_name) as f:
+            f.seek(position)
+            while True:
+                game = chess.pgn.read_game(f)
+                if game is None:
+                    break
+                yield file_name, f.tell(), game
+
+
+def read_journal(file_name, position):
+    """
+    Read the finished games out of a journal, from the given position
+    (holding onto only one game's records at a time)
+    """
+    with open(file_name, 'rb') as f:
+        f.seek(position)
+        records = []
+        for line in iter(f.readline, b''):
+            # (a half written record is the end, for now)
+            if not line.endswith(b'\n'):
+                break
+            record = line.decode().rstrip('\n').split('\t')
+            if record[0] == 'start':
+                records = []
+            records.append(record)
+            if record[0] == 'end':
+                for fen, moves, result in parse_games(records):
+                    yield (file_name, f.tell(),
+                           journal_game(file_name, fen, moves, result))
+                records = []
+
+
+def journal_game(file_name, fen, moves, result):
+    """
+    Return a PGN game of a game from a journal
+    """
+    game = chess.pgn.Game()
+    if fen != chess.STARTING_FEN:
+        game.setup(fen)
+    node = game
+    for move in moves:
+        node = node.add_variation(move)
+    game.headers['Event'] = 'Journal'
+    game.headers['Site'] = file_name
+    game.headers['Result'] = result
+    return game
+
+
+def player_name(game, color):
+    """
+    Who played the given color (along with the difficulty they played at,
+    if the game says, e.g. in tournaments)
+    """
+    side = 'White' if color == chess.WHITE else 'Black'
+    name = game.headers.get(side, '?')
+    if name == '?':
+        name = f'{game.headers.get("Event", "?")} {side.lower()}'
+    difficulty = game.headers.get(f'{side}Difficulty')
+    if difficulty:
+        name += f' @{difficulty}'
+    return name
+
+
+def new_totals():
+    """
+    A player's stats, before any moves are added up
+    """
+    return {'games': 0, 'moves': 0, 'accuracy': 0.0, 'cp_loss': 0,
+            'inaccuracies': 0, 'mistakes': 0, 'blunders': 0}
+
+
+def game_over_score(board):
+    """
+    The score of a board whose game is over (or None, if it isn't)
+    """
+    if board.is_checkmate():
+        return Mate(0)
+    if board.is_game_over():
+        return Cp(0)
+    return None
+
+
+def to_cp(score):
+    """
+    A score in centipawns (mates being worth MATE_SCORE)
+    """
+    return score.score(mate_score=MATE_SCORE)
+
+
+def win_chance(score):
+    """
+    The chance (in %) that whoever the score is for goes on to win
+    (as lichess works it out)
+    """
+    return 50 + 50 * (2 / (1 + math.exp(-0.00368208 * to_cp(score))) - 1)
+
+
+def move_accuracy(lost):
+    """
+    How accurate (in %) a move was, given how much it lowered the chance
+    of winning (as lichess works it out)
+    """
+    accuracy = 103.1668 * math.exp(-0.04354 * lost) - 3.1669
+    return min(max(accuracy, 0), 100)
+
+
+def format_score(score):
+    """
+    Write a score the way PGN evaluations are (pawns, or #mate in)
+    """
+    if score.is_mate():
+        return f'#{score.mate()}'
+    return f'{score.score() / 100:.2f}'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Review finished games, writing them out annotated '
+                    'with evaluations and bad moves, along with how '
+                    'accurately each player played')
+    parser.add_argument('games', nargs='*',
+                        default=['assets/journal-archive.txt'],
+                        help='PGN files and journals (.txt) to review '
+                             '(default, the journal archive)')
+    parser.add_argument('--out', default='assets/review.pgn')
+    parser.add_argument('--depth', type=int, default=REVIEW_DEPTH)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--nice', type=int, default=NICENESS,
+                        help='how much lower a priority the workers run at')
+    parser.add_argument('--pause', type=float, default=0,
+                        help='seconds to rest between batches of games')
+    args = parser.parse_args()
+
+    review = Review(args.games, out_file=args.out, depth=args.depth,
+                    workers=args.workers, niceness=args.nice,
+                    pause=args.pause)
+    print(review.run())
+
+
+if __name__ == '__main__':
+    main()
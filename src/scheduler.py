@@ -0,0 +1,268 @@
+import asyncio
+import glob
+import re
+import threading
+import time
+import traceback
+
+from referee import Referee
+from async_referee import AsyncReferee
+from journal import Journal
+from checkpoint import Checkpoint
+import opening_book
+import store
+
+
+class Scheduler():
+    """
+    Plays many games of chess at once, in this one process.
+    Each game gets a 'slot' (a thread), which plays one game after another,
+    with its own referee, board and journal. All of the games share the
+    process-wide engine pool (which hands out engines first come first
+    served), so while one game waits on an email, the others keep playing.
+    Each slot also keeps a checkpoint of its game, so a game that was
+    being played when the process died is picked back up on restart
+    """
+
+    # How long a slot waits before starting over, if its game crashed
+    crash_wait = 10
+    # How many times in a row a game can crash before it's given up on
+    # (rather than resumed yet again)
+    max_crashes = 3
+    # What referees the games (see AsyncScheduler)
+    referee_class = Referee
+    # Errors that mean we can't play at all (e.g. no stockfish, or email
+    # config), which are raised rather than retried
+    startup_errors = (FileNotFoundError,)
+
+    def __init__(self, make_players, games=1):
+        """
+        Given a function that creates a fresh (white, black) pair of
+        players for each new game, and how many games to play at once
+        """
+        self.make_players = make_players
+        self.games = games
+        self.running = True
+        # The referee of the game currently being played in each slot
+        self.referees = {}
+        # The start up error a slot stopped on (if any)
+        self.error = None
+
+    def journal_name(self, slot):
+        """
+        Each slot keeps its own journal
+        (the first slot uses the default journal)
+        """
+        if slot == 0:
+            return 'assets/journal.txt'
+        return f'assets/journal-{slot}.txt'
+
+    def checkpoint_name(self, slot):
+        """
+        Each slot keeps its own checkpoint (alongside its journal)
+        """
+        if slot == 0:
+            return 'assets/checkpoint.json'
+        return f'assets/checkpoint-{slot}.json'
+
+    def extra_slots(self):
+        """
+        Return the slots past the number of games we are playing that
+        still have a game to resume (e.g. we were restarted with fewer)
+        """
+        slots = []
+        for file_name in glob.glob('assets/checkpoint-*.json'):
+            match = re.search(r'checkpoint-(\d+)\.json$', file_name)
+            if match and int(match.group(1)) >= self.games:
+                slots.append(int(match.group(1)))
+        return sorted(slots)
+
+    def run(self):
+        """
+        Play games in every slot until stopped
+        (any extra slots only finish the game they were left with).
+        On ctrl-c (or a start up error) we stop right away, rather than
+        wait on games blocked on someone typing, or on stockfish
+        (the slots' threads are daemons, so don't keep us running)
+        """
+        slots = [(slot, True) for slot in range(self.games)]
+        slots += [(slot, False) for slot in self.extra_slots()]
+        threads = [threading.Thread(target=self.run_thread, args=slot,
+                                    name=f'game-{slot[0]}', daemon=True)
+                   for slot in slots]
+        for thread in threads:
+            thread.start()
+        try:
+            while self.error is None and any(t.is_alive() for t in threads):
+                for thread in threads:
+                    thread.join(1)
+        except KeyboardInterrupt:
+            self.stop()
+            raise
+        if self.error is not None:
+            raise self.error
+
+    def run_thread(self, slot, keep_playing=True):
+        """
+        Run a slot on its own thread, keeping hold of any start up error
+        (for run to raise)
+        """
+        try:
+            self.run_slot(slot, keep_playing)
+        except self.startup_errors as e:
+            self.stop()
+            self.error = e
+
+    def run_slot(self, slot, keep_playing=True):
+        """
+        Play games one after another in a single slot
+        (starting with the game left unfinished in it, if there is one).
+        A game that crashes is reported, and resumed (or if it keeps
+        crashing, a new one started), without bothering the games in
+        other slots
+        """
+        journal = Journal(self.journal_name(slot))
+        checkpoint = Checkpoint(self.checkpoint_name(slot))
+        crashes = 0
+        while self.running:
+            try:
+                self.play_game(slot, journal, checkpoint)
+                crashes = 0
+            except self.startup_errors:
+                raise
+            except Exception:
+                crashes = self.crashed(slot, checkpoint, crashes)
+                time.sleep(self.crash_wait)
+            if not keep_playing and checkpoint.load() is None:
+                return
+
+    def crashed(self, slot, checkpoint, crashes):
+        """
+        Report a crashed game, giving up on it if it keeps crashing,
+        and return how many times in a row it has crashed now
+        """
+        print(f'Game in slot {slot} crashed:')
+        traceback.print_exc()
+        crashes += 1
+        if crashes >= self.max_crashes:
+            print(f'Giving up on the game in slot {slot}')
+            checkpoint.clear()
+            crashes = 0
+        return crashes
+
+    def play_game(self, slot, journal, checkpoint):
+        """
+        Play a single game in the given slot: the one left unfinished
+        in it (if there is one), otherwise one between new players
+        """
+        referee, board, resume = self.make_referee(slot, journal, checkpoint)
+        referee.play_game(board, resume=resume)
+        self.learn(referee)
+
+    def make_referee(self, slot, journal, checkpoint):
+        """
+        Return the referee for the next game in the slot, along with the
+        board to start on, and whether that's resuming an unfinished game
+        """
+        resumed = checkpoint.resume(journal)
+        if resumed is not None:
+            white, black, board = resumed
+            print(f'Resuming game (slot {slot}) with {white} vs {black} '
+                  f'from {board.fen()}')
+        else:
+            white, black = self.make_players()
+            board = None
+            print(f'Starting game (slot {slot}) with {white} vs {black}')
+        referee = self.referee_class(white, black, journal=journal,
+                                     checkpoint=checkpoint)
+        self.referees[slot] = referee
+        return referee, board, resumed is not None
+
+    def learn(self, referee):
+        """
+        Learn from how the game just played went, for next time
+        (and keep it in the match's history)
+        """
+        try:
+            opening_book.BOOK.add_games(
+                opening_book.parse_games(referee.journal.game_records()))
+        except OSError as e:
+            print(f'Error adding game to opening book: {str(e)}')
+
+        players = [getattr(player, 'wrapped', player)
+                   for player in (referee.white_player, referee.black_player)]
+        # (only email games have a match name, for now)
+        match = next((player.match_name for player in players
+                      if getattr(player, 'match_name', None)), None)
+        store.STORE.add_game(players[0].identity(), players[1].identity(),
+                             referee.board.result(), referee.board.ply(),
+                             match=match)
+
+    def stop(self):
+        """
+        Don't start any new games
+        (the games being played are still finished)
+        """
+        self.running = False
+
+    def close(self):
+        """
+        Write out, and close, the journal of every slot
+        (e.g. before exiting with games still being played)
+        """
+        for referee in list(self.referees.values()):
+            referee.journal.close()
+
+
+class AsyncScheduler(Scheduler):
+    """
+    Like Scheduler, but each slot is a coroutine on the one event loop
+    (rather than a thread), so thousands of games waiting on emails cost
+    next to nothing. Players that do block (stockfish searching, someone
+    typing) only get a worker thread while they are at it
+    """
+
+    referee_class = AsyncReferee
+
+    def run(self):
+        """
+        Play games in every slot until stopped
+        """
+        try:
+            asyncio.run(self.run_slots())
+        except KeyboardInterrupt:
+            self.stop()
+            raise
+
+    async def run_slots(self):
+        slots = [self.run_slot(slot) for slot in range(self.games)]
+        slots += [self.run_slot(slot, False) for slot in self.extra_slots()]
+        await asyncio.gather(*slots)
+
+    async def run_slot(self, slot, keep_playing=True):
+        """
+        Play games one after another in a single slot, as Scheduler.run_slot
+        """
+        journal = Journal(self.journal_name(slot))
+        checkpoint = Checkpoint(self.checkpoint_name(slot))
+        crashes = 0
+        while self.running:
+            try:
+                await self.play_game(slot, journal, checkpoint)
+                crashes = 0
+            except self.startup_errors:
+                raise
+            except Exception:
+                crashes = self.crashed(slot, checkpoint, crashes)
+                await asyncio.sleep(self.crash_wait)
+            if not keep_playing and checkpoint.load() is None:
+                return
+
+    async def play_game(self, slot, journal, checkpoint):
+        """
+        Play a single game in the given slot, as Scheduler.play_game
+        """
+        referee, board, resume = self.make_referee(slot, journal, checkpoint)
+        await referee.play_game(board, resume=resume)
+        # (rewriting the opening book takes a moment, so not on the loop)
+        await asyncio.to_thread(self.learn, referee)
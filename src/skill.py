@@ -0,0 +1,204 @@
+import random as rand
+import sys
+
+import chess
+from chess.engine import Limit
+
+from time_manager import score_cp
+
+# Stockfish's own strength limiting goes from 0 (weakest) to 20 (full)
+MAX_SKILL_LEVEL = 20
+
+# How to play about as well as the sampling strategy (see
+# StockfishPlayer.choose_move) does at each difficulty.
+# These values are hand-set (not the output of a recorded run); to
+# measure them against your own stockfish, run calibrate() with
+# 'python src/skill.py 40 8' (40 positions, 8 tries per skill level)
+# and paste in the table it prints. (Stockfish's skill levels pick
+# their moves at random, so no two runs give quite the same table.)
+# Even at Skill Level 0 stockfish plays better than the sampling does at
+# most difficulties, so it also plays a share of its moves at random
+# (which costs nothing to search).
+# Between two difficulties, the settings are interpolated
+CALIBRATION = [
+    # (difficulty, skill level, share of random moves)
+    (0.0, 0, 1.0),
+    (0.1, 0, 0.82),
+    (0.2, 0, 0.69),
+    (0.3, 0, 0.58),
+    (0.4, 0, 0.49),
+    (0.5, 0, 0.41),
+    (0.6, 0, 0.32),
+    (0.7, 0, 0.2),
+    (0.8, 0, 0.07),
+    (0.9, 8, 0.0),
+    (1.0, 20, 0.0),
+]
+
+# Losses are capped, so a single missed mate doesn't swamp everything else
+MAX_LOSS = 1000
+
+
+def skill_settings(difficulty):
+    """
+    Return the (skill level, share of random moves) that plays about as
+    well as the given difficulty (float [0-1])
+    """
+    difficulty = min(max(difficulty, 0), 1)
+    for low, high in zip(CALIBRATION, CALIBRATION[1:]):
+        if difficulty <= high[0]:
+            share = (difficulty - low[0]) / (high[0] - low[0])
+            level = round(low[1] + share * (high[1] - low[1]))
+            return level, low[2] + share * (high[2] - low[2])
+    return CALIBRATION[-1][1], CALIBRATION[-1][2]
+
+
+def skill_limit(level, turn_time):
+    """
+    Return the search limit for a skill level.
+    Stockfish picks its (weakened) move once it reaches a depth of
+    1 + the level, so there is no point searching any deeper than that
+    (full strength still searches deep, but never past the turn time)
+    """
+    if level >= MAX_SKILL_LEVEL:
+        return Limit(time=turn_time)
+    return Limit(depth=level + 1, time=turn_time)
+
+
+def skill_options(level):
+    """
+    Return the engine options that limit stockfish to a skill level
+    """
+    return {'Skill Level': level}
+
+
+def rank(engine, board, depth=12):
+    """
+    Return a dict of each legal move to its score (from the point of view
+    of whoever is to move), as found by a full strength MultiPV search
+    """
+    infos = engine.analyse(board, Limit(depth=depth),
+                           multipv=len(list(board.legal_moves)))
+    return {info['pv'][0]: score_cp(info['score'].relative)
+            for info in infos if 'pv' in info and 'score' in info}
+
+
+def loss(scores, move):
+    """
+    How many centipawns worse the given move is than the best one
+    """
+    best = max(scores.values())
+    return min(best - scores.get(move, best - MAX_LOSS), MAX_LOSS)
+
+
+def sampling_loss(scores, difficulty):
+    """
+    The average loss of the sampling strategy at a difficulty
+    (a random choice from the top (1 - difficulty) share of moves)
+    """
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    top = ranked[:max(int(len(ranked) * (1 - difficulty)), 1)]
+    return sum(loss(scores, move) for move in top) / len(top)
+
+
+def skill_loss(engine, board, scores, level, tries):
+    """
+    The average loss of stockfish's own moves at a skill level
+    (it picks its move at random, so we give it a few tries)
+    """
+    total = 0
+    for _ in range(tries):
+        result = engine.play(board, skill_limit(level, 1),
+                             options=skill_options(level))
+        total += loss(scores, result.move)
+    return total / tries
+
+
+def sample_positions(engine, count=40, seed=0):
+    """
+    Play quick, slightly random, games to come up with the given number
+    of (middling) positions to calibrate on
+    """
+    rng = rand.Random(seed)
+    positions = []
+    while len(positions) < count:
+        board = chess.Board()
+        while not board.is_game_over() and board.ply() < 80:
+            infos = engine.analyse(board, Limit(depth=6), multipv=3)
+            board.push(rng.choice([info['pv'][0] for info in infos
+                                   if 'pv' in info]))
+            if board.ply() >= 8 and board.ply() % 6 == 0 and \
+                    not board.is_game_over():
+                positions.append(board.copy(stack=False))
+    return positions[:count]
+
+
+def calibrate(engine, positions=None, tries=8, difficulties=None):
+    """
+    Work out how to make moves about as good as the sampling strategy
+    does (by average centipawn loss, over the given positions) at each
+    difficulty, returning a new CALIBRATION table
+    """
+    if positions is None:
+        positions = sample_positions(engine)
+    if difficulties is None:
+        difficulties = [row[0] for row in CALIBRATION]
+    ranked = [(board, rank(engine, board)) for board in positions]
+
+    skill_losses = []
+    for level in range(MAX_SKILL_LEVEL + 1):
+        skill_losses.append(sum(
+            skill_loss(engine, board, scores, level, tries)
+            for board, scores in ranked) / len(ranked))
+        print(f'Skill level {level}: {skill_losses[-1]:.1f} cp lost')
+
+    targets = []
+    for difficulty in difficulties:
+        targets.append(sum(sampling_loss(scores, difficulty)
+                           for board, scores in ranked) / len(ranked))
+        print(f'Difficulty {difficulty}: {targets[-1]:.1f} cp lost')
+    # (a difficulty of 0 samples from every move, so is a random move)
+    random_loss = sum(sampling_loss(scores, 0)
+                      for board, scores in ranked) / len(ranked)
+    return fit(difficulties, targets, skill_losses, random_loss)
+
+
+def fit(difficulties, targets, skill_losses, random_loss):
+    """
+    Given the average loss of the sampling strategy at each difficulty,
+    of each skill level, and of a random move,
+    return the CALIBRATION table that matches them
+    """
+    # The losses are noisy, but a higher level should never play worse
+    # (so a level only counts for as well as the levels below it)
+    smoothed = [min(skill_losses[:level + 1])
+                for level in range(len(skill_losses))]
+
+    table = []
+    for difficulty, target in zip(difficulties, targets):
+        if target >= smoothed[0]:
+            # Weaker than stockfish can make itself, so mix in random moves
+            share = (target - smoothed[0]) / max(random_loss - smoothed[0], 1)
+            table.append((difficulty, 0, round(min(share, 1), 2)))
+            continue
+        # Otherwise, the lowest level that plays at least that well
+        level = next((level for level, lost in enumerate(smoothed)
+                      if lost <= target), MAX_SKILL_LEVEL)
+        table.append((difficulty, level, 0.0))
+    return table
+
+
+if __name__ == '__main__':
+    # Re-run the calibration (python src/skill.py [positions] [tries])
+    import engine_pool
+    args = [int(arg) for arg in sys.argv[1:]]
+    count = args[0] if args else 40
+    tries = args[1] if len(args) > 1 else 8
+    with engine_pool.POOL.borrow() as engine:
+        positions = sample_positions(engine, count)
+        table = calibrate(engine, positions, tries)
+    engine_pool.POOL.close()
+    print('CALIBRATION = [')
+    for difficulty, level, share in table:
+        print(f'    ({difficulty}, {level}, {share}),')
+    print(']')
@@ -1,11 +1,21 @@
 import random as rand
-import os
+import threading
+import time
 from datetime import timedelta
 
-from chess.engine import Limit, SimpleEngine, Cp
+from chess.engine import Limit, Cp, INFO_ALL
 
 from player import Player
-import save_file
+from analysis import MoveAnalysis, TurnAnalysis
+import engine_pool
+import eval_cache
+import metrics
+import skill
+import tablebase
+import opening_book
+from time_manager import TimeManager
+from game_state import bounded_copy
+import store
 
 
 class StockfishPlayer(Player):
@@ -13,45 +23,100 @@ class StockfishPlayer(Player):
     An AI which gets it's moves from the stock-fish engine
     """
 
-    # Only load the stockfish engine once it is actually needed
+    # The engine we have borrowed from the pool (only while we need it)
     stockfish = None
 
-    def __init__(self, difficulty=None, turn_time=timedelta(seconds=10)):
+    # The background analysis we run on our opponent's time (if any),
+    # and the board it is analysing
+    pondering = None
+    ponder_board = None
+    ponder_start = None
+    # The reply we expect from our opponent (from our last search)
+    ponder_move = None
+
+    # How much the difficulty changes after each win (or loss)
+    difficulty_step = 0.02
+
+    def __init__(self, difficulty=None, turn_time=timedelta(seconds=10),
+                 multipv=True, strength='sample', persist=True,
+                 can_ponder=True, nodes=None):
         """
         Creates a stockfish AI chess player.
         The AI difficulty is modulated by limiting stockfish's intelligence
         (difficulty is float [0-1], roughly what % of it's brain it can to use)
         The amount of time stockfish can spend
         thinking on a turn is limited to the given turn_time (default 10)
+        If multipv is set (default), all moves are ranked in one search,
+        otherwise each move gets a separate search of its own.
+        The strength says how difficulty is played out: 'sample' (default)
+        ranks every move and picks one at random from the top few,
+        'skill' has stockfish weaken itself (its Skill Level), and only
+        search for a single move (much cheaper, for easy opponents)
+        Unless a difficulty is given, we play at the difficulty saved for
+        our opponent (see store), and unless persist is set (default),
+        changes in difficulty are never saved, and unless can_ponder
+        is set (default),
+        we never think on our opponent's time.
+        If nodes is given, every search also stops after that many nodes
+        (and isn't cached), so searches are repeatable (e.g. for benchmarks)
         """
         self.turn_time = turn_time
+        self.multipv = multipv
+        self.persist = persist
+        self.can_ponder = can_ponder
+        self.nodes = nodes
+        if strength not in ('sample', 'skill'):
+            raise ValueError(f'Unknown strength: "{strength}"')
+        self.strength = strength
+
+        # Our engine can be taken away from another thread while pondering
+        self.ponder_lock = threading.Lock()
+        # Decides how much of the turn time to actually use
+        self.time_manager = TimeManager()
 
         # If we were given a difficulty, use that
-        if difficulty is not None:
-            self.difficulty = difficulty
-        # Otherwise, load it from file (default of .5)
-        else:
-            self.difficulty = save_file.load()['difficulty']
+        # (otherwise it is loaded once we know who we are playing)
+        self.difficulty = difficulty
 
-    def get_stockfish(self):
+    def prep(self, referee, name):
+        super().prep(referee, name)
+        if self.difficulty is None:
+            self.difficulty = self.load_difficulty()
+
+    def opponent_identity(self):
         """
-        Load the stockfish engine from an asset file
-        (searches for any file that starts with stockfish_10)
+        Who we are playing (see Player.identity)
         """
-        prefixed = [filename for filename in os.listdir('assets')
-                    if filename.startswith('stockfish_10')]
+        if self.name == 'white':
+            return self.referee.black_player.identity()
+        return self.referee.white_player.identity()
 
-        if len(prefixed) == 0:
-            raise ValueError('Stockfish engine file not found. Download '
-                             '"stockfish_10_x64", or whichever archatecture '
-                             'version suits the platform.')
-        if len(prefixed) > 1:
-            raise ValueError(f'Found multiple possible stockfish files: '
-                             f'{prefixed}. Change prefix on (or remove) '
-                             f'unwated files.')
+    def load_difficulty(self):
+        """
+        Return the difficulty saved for our opponent (or if we haven't
+        played them before, the difficulty we start everyone on)
+        """
+        default = store.STORE.get(store.DEFAULTS_SCOPE, 'difficulty',
+                                  store.DEFAULT_DIFFICULTY)
+        return store.STORE.get(store.opponent_scope(self.opponent_identity()),
+                               'difficulty', default)
 
-        stock_file = f'assets/{prefixed[0]}'
-        return SimpleEngine.popen_uci(stock_file)
+    def get_stockfish(self):
+        """
+        Borrow a stockfish engine from the process-wide pool
+        (keeping hold of it until release_stockfish is called)
+        """
+        if self.stockfish is None:
+            self.stockfish = engine_pool.POOL.checkout()
+        return self.stockfish
+
+    def release_stockfish(self):
+        """
+        Give our borrowed engine back to the pool, so other players
+        (and games) can use it
+        """
+        engine_pool.POOL.checkin(self.stockfish)
+        self.stockfish = None
 
     def get_move(self):
         """
@@ -59,73 +124,402 @@ class StockfishPlayer(Player):
         one that this difficulty level of stockfish thinks
         is 'good enough'. Also, can choose to resign.
         """
-        moves = self.get_sorted_moves()
-        if self.should_resign(moves):
-            return '*resign'
-        return self.choose_move(moves).uci()
+        try:
+            analysis = self.get_analysis()
+            if self.should_resign(analysis):
+                return '*resign'
+            move = self.choose_move(analysis)
+            self.ponder_move = analysis.get(move).reply()
+            return move.uci()
+        finally:
+            self.release_stockfish()
 
-    def get_sorted_moves(self):
+    def ponder(self):
         """
-        Return a list of all the moves, as rated by
-        stockfish's score (in centipawns)
+        While our opponent thinks, start stockfish analysing the board we
+        expect to get back (in the background), so that if they play the
+        reply we expected, our search is already well underway.
+        Only uses an engine if the pool has one free, and gives it back
+        if anyone else needs it.
         """
+        # Skill limited players are meant to be cheap, so don't bother
+        if self.strength == 'skill' or not self.can_ponder:
+            return
+        with self.ponder_lock:
+            if self.pondering is not None or self.stockfish is not None:
+                return
+            board = bounded_copy(self.referee.board)
+            if board.is_game_over():
+                return
+            # If our tables know this endgame, there is nothing to ponder
+            if tablebase.TABLEBASE.covers(board):
+                return
 
-        # How long we can to spend thinking about the possible moves this turn
-        turn_time = self.turn_time.seconds
+            engine = engine_pool.POOL.checkout(
+                block=False, preempt=self.preempt_ponder)
+            if engine is None:
+                return
+            self.stockfish = engine
+
+            # If we don't know what to expect, we can still warm up
+            # stockfish's tables by looking at our opponent's options
+            if self.ponder_move in board.legal_moves:
+                board.push(self.ponder_move)
+                if board.is_game_over():
+                    board.pop()
+
+            self.ponder_board = board
+            self.ponder_start = time.monotonic()
+            self.pondering = engine.analysis(
+                board, multipv=len(list(board.legal_moves)))
+
+    def preempt_ponder(self, engine):
+        """
+        Someone else needs the engine we are pondering with,
+        so stop and give it back
+        """
+        with self.ponder_lock:
+            if self.pondering is not None and self.stockfish is engine:
+                self.pondering.stop()
+                self.pondering = None
+                self.stockfish = None
+        engine_pool.POOL.checkin(engine)
+
+    def stop_pondering(self):
+        """
+        Stop any background analysis, keeping hold of the engine.
+        If we were pondering the board we now have, return how long
+        we spent on it, along with the analysis stockfish got done
+        (otherwise, return 0 and None)
+        """
+        with self.ponder_lock:
+            if self.pondering is None:
+                return 0, None
+            self.pondering.stop()
+            infos = self.pondering.multipv
+            self.pondering = None
+            elapsed = time.monotonic() - self.ponder_start
+
+            # If our engine was taken away in the meantime,
+            # the one that took it will be giving it back
+            if not engine_pool.POOL.reclaim(self.stockfish):
+                self.stockfish = None
+                return 0, None
+
+            if self.ponder_board.fen() != self.referee.board.fen():
+                return 0, None
+            return elapsed, infos
+
+    def get_turn_time(self):
+        """
+        How long (in seconds) we can to spend thinking
+        about the possible moves this turn
+        """
+        turn_time = self.turn_time.total_seconds()
 
         # First move is more open, and we want immediate feedback, so
         # limit time spent thinking about the first move
-        # TODO bit sloppy, and maybe not what we want
+        # (on any move, the time manager may stop well before this)
         if self.referee.board.fullmove_number <= 1 and turn_time > 5:
             turn_time = 5
+        return turn_time
+
+    def get_sorted_moves(self):
+        """
+        Return a list of all the moves, as rated by
+        stockfish's score (in centipawns), best move first
+        """
+        return self.get_analysis().moves()
 
-        move_time = turn_time / len(list(self.referee.board.legal_moves))
+    def get_analysis(self):
+        """
+        Rank all the moves we could make this turn, returning (and keeping,
+        as self.analysis) the TurnAnalysis of them, best move first
+        """
+        # Anything stockfish worked out on our opponent's time is either
+        # used, or at least sits in the engine's tables
+        pondered_time, pondered_infos = self.stop_pondering()
+        start = time.monotonic()
+        # In an opening our book knows, or an endgame our tables know,
+        # there is no need to search
+        lines, source = self.get_book_lines(), 'book'
+        if lines is None:
+            lines, source = self.get_tablebase_lines(), 'tablebase'
+        if lines is None:
+            lines, source = self.get_engine_lines(pondered_time,
+                                                  pondered_infos)
 
-        # Get the score for each move, add to list as tuple for easy sorting
-        # (We use enumeration just as a tiebreaker, could use a specific
-        # tiebreaker class instance, but this works for now)
-        moves_with_score = sorted([
-            (self.get_move_score(m, move_time), i, m)
-            for i, m in enumerate(self.referee.board.legal_moves)
-        ], reverse=False)
-        moves = [move for score, idx, move in moves_with_score]
-        return moves
+        self.analysis = TurnAnalysis(self.referee.board.fen(), lines, source,
+                                     time.monotonic() - start)
+        self.record_analysis()
+        return self.analysis
 
-    def get_move_score(self, move, move_time=1):
+    def record_analysis(self):
         """
-        Return stockfish's score for a move (in centipawns)
+        Record how long this turn's analysis took, how deep it got,
+        and how quickly stockfish searched (if it searched at all)
         """
-        b = self.referee.board.copy()
-        b.push(move)
+        analysis = self.analysis
+        best = analysis.best()
+        nodes = best.nodes
+        nps = None
+        if nodes and analysis.elapsed:
+            nps = round(nodes / analysis.elapsed)
+        metrics.METRICS.record(
+            'analysis', labels={'source': analysis.source},
+            seconds=analysis.elapsed, moves=len(analysis), depth=best.depth,
+            nodes=nodes, nps=nps)
 
-        # Only load when we need it (once the game has started)
-        # because it spawns new threads
-        if self.stockfish is None:
-            self.stockfish = self.get_stockfish()
+    def get_engine_lines(self, pondered_time=0, pondered_infos=None):
+        """
+        Have stockfish look at the moves (however our strength and
+        multipv say to), returning their MoveAnalysis and where they came from
+        """
+        if self.strength == 'skill':
+            return [self.get_skill_line()], 'skill'
+        if self.multipv:
+            return self.get_multipv_lines(pondered_time, pondered_infos)
+        return self.get_separate_lines(), 'engine'
+
+    def get_book_lines(self):
+        """
+        If the opening book has moves for the current board, pick one
+        (according to our difficulty), returning its MoveAnalysis as the
+        only line, otherwise None
+        """
+        move = opening_book.BOOK.choose(self.referee.board, self.difficulty)
+        if move is None:
+            return None
+        return [MoveAnalysis(move)]
+
+    def get_tablebase_lines(self):
+        """
+        If the endgame tables have the current board, return the (exact)
+        MoveAnalysis of each move, otherwise None
+        """
+        scores = tablebase.TABLEBASE.probe(self.referee.board)
+        if scores is None:
+            return None
+        return [MoveAnalysis(move, score) for move, score in scores.items()]
+
+    def get_skill_line(self):
+        """
+        Have stockfish, limited to the skill level of our difficulty,
+        pick a single move (without ranking any others),
+        returning its MoveAnalysis
+        """
+        board = self.referee.board
+        level, random_share = skill.skill_settings(self.difficulty)
+        # (stockfish can't make itself weak enough for the easiest
+        # difficulties, so some moves are just random)
+        if rand.random() < random_share:
+            return MoveAnalysis(rand.choice(list(board.legal_moves)))
+
+        result = self.get_stockfish().play(
+            board, skill.skill_limit(level, self.get_turn_time()),
+            info=INFO_ALL, options=skill.skill_options(level))
 
-        info = self.stockfish.analyse(
-            b, Limit(time=move_time)
-        )
-        return info['score'].relative
+        # (stockfish only reports on its best line, which may not be
+        # the move it weakened itself into playing)
+        info = result.info
+        if info.get('pv', [None])[0] == result.move and 'score' in info:
+            return MoveAnalysis.from_info(info)
+        score = info['score'].relative if 'score' in info else None
+        return MoveAnalysis(result.move, score, info.get('depth'),
+                            nodes=info.get('nodes'))
 
-    def should_resign(self, move_list):
+    def get_multipv_lines(self, pondered_time=0, pondered_infos=None):
+        """
+        Rank every legal move with a single MultiPV search from the
+        current board, so all moves share the same search tree (and the
+        whole turn time), rather than restarting a search for each move.
+        If we already pondered on this board, that time comes off of the
+        turn, and the search picks up where the pondering left off.
+        Return the MoveAnalysis of each move, and where they came from
+        """
+        legal_moves = list(self.referee.board.legal_moves)
+
+        # If we are forced, there is nothing to think about
+        if len(legal_moves) == 1:
+            return [MoveAnalysis(legal_moves[0])], 'forced'
+
+        # If we have ranked this board before, just use that
+        limit = Limit(time=self.get_turn_time())
+        lines = None
+        if self.nodes is None:
+            lines = self.get_cached_lines(legal_moves, limit)
+        if lines is not None:
+            return lines, 'cache'
+        return self.search_lines(legal_moves, limit,
+                                 pondered_time, pondered_infos)
+
+    def search_lines(self, moves, limit, pondered_time=0,
+                     pondered_infos=None):
+        """
+        Search the board for the given limit (minus whatever time we
+        already pondered on it), returning the MoveAnalysis of each move
+        (caching each of their scores, if the search used the whole
+        limit, so the cache never holds shallower scores than its keys
+        promise), and where they came from.
+        Any move the engine did not get around to reporting is left
+        unscored (so it ranks below all of the ones it did)
+        """
+        source = 'engine'
+        if pondered_infos and limit.time <= pondered_time:
+            infos, source, finished = pondered_infos, 'ponder', True
+        else:
+            infos, finished = self.run_search(moves, limit.time,
+                                              pondered_time)
+
+        board = self.referee.board.copy(stack=False)
+        lines = {}
+        for info in infos:
+            if 'pv' in info and 'score' in info:
+                line = MoveAnalysis.from_info(info)
+                lines[line.move] = line
+                if self.nodes is not None or not finished:
+                    continue
+
+                # (the cache holds scores relative to whoever is to move)
+                board.push(line.move)
+                eval_cache.CACHE.put(board, limit, -line.score,
+                                     line.depth or 0)
+                board.pop()
+        return [lines.get(m, MoveAnalysis(m)) for m in moves], source
+
+    def run_search(self, moves, turn_time, pondered_time=0):
+        """
+        Run a MultiPV search over the given moves, letting the time manager
+        stop it early (once the ranking settles down) but never letting it
+        run past the turn time (including any time we already pondered).
+        Return stockfish's info for each move, and whether the search
+        ran to the end of the turn time (rather than being stopped early)
+        """
+        board = self.referee.board
+        soft, hard = self.time_manager.allocate(board, turn_time)
+        start = time.monotonic() - pondered_time
+
+        # (pondering that used up the turn without a single line to show
+        # for it still leaves us a short search, rather than none at all)
+        limit = Limit(time=max(hard - pondered_time,
+                               self.time_manager.min_time),
+                      nodes=self.nodes)
+        with self.get_stockfish().analysis(
+                board, limit, multipv=len(moves)) as analysis:
+            for info in analysis:
+                # Once the last line of a depth is in, see where we stand
+                if info.get('multipv') == len(moves) and 'score' in info:
+                    lines = analysis.multipv
+                    if len(lines) > 1 and 'pv' in lines[0]:
+                        self.time_manager.record(
+                            lines[0].get('depth', 0), lines[0]['pv'][0],
+                            lines[0]['score'].relative,
+                            lines[1]['score'].relative)
+
+                if self.time_manager.should_stop(time.monotonic() - start):
+                    analysis.stop()
+                    return analysis.multipv, False
+            return analysis.multipv, True
+
+    def get_cached_lines(self, moves, limit):
+        """
+        If every one of the given moves has a cached score (for this limit),
+        return the MoveAnalysis of each, otherwise None
+        """
+        board = self.referee.board.copy(stack=False)
+        lines = []
+        for move in moves:
+            board.push(move)
+            entry = eval_cache.CACHE.get_entry(board, limit)
+            board.pop()
+            if entry is None:
+                return None
+            score, depth = entry
+            # (we don't know what stockfish expects after a cached move)
+            lines.append(MoveAnalysis(move, -score, depth))
+        return lines
+
+    def get_separate_lines(self):
+        """
+        Rank every legal move by giving each one a separate search
+        (with an equal share of the turn time),
+        returning the MoveAnalysis of each
+        """
+        move_time = (self.get_turn_time() /
+                     len(list(self.referee.board.legal_moves)))
+        # (every move is played on, then taken back off, the one copy)
+        board = bounded_copy(self.referee.board)
+        return [self.analyse_move(m, move_time, board)
+                for m in self.referee.board.legal_moves]
+
+    def analyse_move(self, move, move_time=1, board=None):
+        """
+        Search the board after the given move,
+        returning the MoveAnalysis of that move
+        (the move is played on the given copy of our board, if there is one,
+        which is left as it was)
+        """
+        if board is None:
+            board = bounded_copy(self.referee.board)
+        board.push(move)
+        try:
+            return self.search_move(board, move, move_time)
+        finally:
+            board.pop()
+
+    def search_move(self, board, move, move_time):
+        """
+        Search the board the given move led to (see analyse_move)
+        """
+        start = time.monotonic()
+        limit = Limit(time=move_time)
+        if self.nodes is None:
+            entry = eval_cache.CACHE.get_entry(board, limit)
+            if entry is not None:
+                score, depth = entry
+                metrics.METRICS.record(
+                    'move_score', seconds=time.monotonic() - start,
+                    depth=depth, cached=True)
+                return MoveAnalysis(move, -score, depth)
+
+        info = self.get_stockfish().analyse(
+            board, Limit(time=move_time, nodes=self.nodes))
+        score = info['score'].relative
+        if self.nodes is None:
+            eval_cache.CACHE.put(board, limit, score, info.get('depth', 0))
+        metrics.METRICS.record(
+            'move_score', seconds=time.monotonic() - start,
+            depth=info.get('depth'), nodes=info.get('nodes'),
+            nps=info.get('nps'), cached=False)
+        return MoveAnalysis(move, -score, info.get('depth'),
+                            [move] + info.get('pv', []), info.get('nodes'))
+
+    def get_move_score(self, move, move_time=1):
+        """
+        Return stockfish's score for a move (in centipawns)
+        """
+        return -self.analyse_move(move, move_time).score
+
+    def should_resign(self, analysis):
         """
         Have ai decide if it wishes to resign or offer a draw,
         returning true if it wishes to resign
+        (from this turn's analysis, without searching any further)
         """
         # If the best move is still pretty bad, then resign
-        best_move = move_list[0]
-        move_score = self.get_move_score(best_move)
+        # (a forced move has no score, so we just play it)
+        score = analysis.best().score
         # TODO may still need to fine tune
-        if move_score > Cp(2000):
+        if score is not None and score < Cp(-2000):
             return True
         return False
 
-    def choose_move(self, move_list):
+    def choose_move(self, analysis):
         """
-        Given the sorted list of possible moves, choose one 'organically'
+        Given this turn's analysis, choose one of the moves 'organically'
         (by randomly sampling according to the difficulty)
         """
+        move_list = analysis.moves()
         # TODO ideally we would choose with some sort of linear or bell curve
         # determined from the difficulty, but for now:
         # randomly choose from the x% of moves, where %x is 1 - difficulty
@@ -148,18 +542,16 @@ class StockfishPlayer(Player):
 
     def win(self):
         """
-        TODO when saving difficulty, win causes decrease
+        Winning makes us easier on this opponent next time
         """
-        self.difficulty -= 0.02
-        self.difficulty = max(self.difficulty, 0)
+        self.change_difficulty(-self.difficulty_step)
         self.quit()
 
     def lose(self):
         """
-        TODO when saving difficulty, lose causes increase
+        Losing makes us harder on this opponent next time
         """
-        self.difficulty += 0.02
-        self.difficulty = min(self.difficulty, 1)
+        self.change_difficulty(self.difficulty_step)
         self.quit()
 
     def draw(self):
@@ -170,17 +562,34 @@ class StockfishPlayer(Player):
 
     def quit(self):
         """
-        Need to kill the stockfish thread to allow the script to exit,
-        as well as saving any changes to difficulty
+        Give back any engine we are still holding (the pool keeps it
+        running for the next game)
         """
-        self.stockfish.quit()
-        self.stockfish = None
-        self.save()
+        self.stop_pondering()
+        self.release_stockfish()
+
+    def checkpoint(self):
+        return {'difficulty': self.difficulty,
+                'turn_time': self.turn_time.total_seconds(),
+                'multipv': self.multipv, 'strength': self.strength,
+                'persist': self.persist, 'can_ponder': self.can_ponder,
+                'nodes': self.nodes}
+
+    @classmethod
+    def restore(cls, state):
+        state = dict(state, turn_time=timedelta(seconds=state['turn_time']))
+        return cls(**state)
 
-    def save(self):
+    def change_difficulty(self, change):
         """
-        Save any changes in difficulty to the yaml save file
+        Change our difficulty (kept between 0 and 1), saving it for
+        our opponent if persist is set.
+        The change is added to what is saved (rather than overwriting it),
+        so games played against the same opponent at once all count
         """
-        dikt = save_file.load()
-        dikt['difficulty'] = self.difficulty
-        save_file.save(dikt)
+        if not self.persist:
+            self.difficulty = min(max(self.difficulty + change, 0), 1)
+            return
+        self.difficulty = store.STORE.adjust(
+            store.opponent_scope(self.opponent_identity()), 'difficulty',
+            change, default=self.difficulty, low=0, high=1)
@@ -0,0 +1,201 @@
+import os
+import sqlite3
+import threading
+import time
+
+import yaml
+
+# Where everything we keep between runs lives
+STORE_FILE_NAME = 'assets/store.db'
+# What we kept before the store (only read once, to move it over)
+OLD_SAVE_FILE_NAME = 'assets/save.yaml'
+
+# The scope of settings for whoever we haven't played yet
+DEFAULTS_SCOPE = 'defaults'
+# How difficult to be against them (unless the old save file says)
+DEFAULT_DIFFICULTY = 0.5
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS settings (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value,
+    PRIMARY KEY (scope, key)
+);
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    match TEXT,
+    white TEXT NOT NULL,
+    black TEXT NOT NULL,
+    result TEXT NOT NULL,
+    plies INTEGER NOT NULL,
+    ended REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS games_by_match ON games (match);
+CREATE INDEX IF NOT EXISTS games_by_white ON games (white);
+CREATE INDEX IF NOT EXISTS games_by_black ON games (black);
+'''
+
+
+class Store():
+    """
+    What we keep between runs (e.g. how difficult to be against each
+    opponent, and how every game went), in a SQLite database.
+    Settings are kept per 'scope' (e.g. 'opponent:<identity>', see
+    opponent_scope, or 'match:<match name>'), and each
+    one is read or changed on its own, so games being played at once
+    (even in other processes) never overwrite each other's changes.
+    The database is in WAL mode, so reading never waits on writing,
+    and every thread gets its own connection
+    """
+
+    def __init__(self, file_name=STORE_FILE_NAME):
+        self.file_name = file_name
+        self.local = threading.local()
+        # Every connection we opened (from any thread), to close them all
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connection(self):
+        """
+        Return this thread's connection (opening it, and setting up the
+        database, if need be)
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            return conn
+        folder = os.path.dirname(self.file_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # (autocommit, with transactions started explicitly where needed)
+        conn = sqlite3.connect(self.file_name, timeout=30,
+                               isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # (WAL stays safe from corruption without syncing every commit)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        with self.lock:
+            self.connections.append(conn)
+            if len(self.connections) == 1:
+                self.import_save_file(conn)
+        self.local.conn = conn
+        return conn
+
+    def close(self):
+        """
+        Close every connection
+        (any thread that uses the store again gets a new one)
+        """
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+
+    def get(self, scope, key, default=None):
+        """
+        Return a setting (or the default, if it was never set)
+        """
+        row = self.connection().execute(
+            'SELECT value FROM settings WHERE scope = ? AND key = ?',
+            (scope, key)).fetchone()
+        return default if row is None else row[0]
+
+    def set(self, scope, key, value):
+        """
+        Change a setting (a number, string, or None)
+        """
+        self.connection().execute(
+            'INSERT INTO settings (scope, key, value) VALUES (?, ?, ?) '
+            'ON CONFLICT (scope, key) DO UPDATE SET value = excluded.value',
+            (scope, key, value))
+
+    def adjust(self, scope, key, change, default=0, low=None, high=None):
+        """
+        Add to a numeric setting (starting from the default, if it was
+        never set), keeping it within low and high (if given),
+        and return its new value.
+        The change (and reading it back) is made in one transaction,
+        so changes made at the same time (e.g. by two games against the
+        same opponent) all count.
+        (this sticks to what SQLite 3.24 can do, e.g. no RETURNING,
+        as older systems like Raspberry Pi OS ship older versions)
+        """
+        low = float('-inf') if low is None else low
+        high = float('inf') if high is None else high
+        conn = self.connection()
+        # (taking the write lock up front, so no-one changes it between
+        # our change and reading it back)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT INTO settings (scope, key, value) '
+                'VALUES (?, ?, MIN(MAX(? + ?, ?), ?)) '
+                'ON CONFLICT (scope, key) DO UPDATE '
+                'SET value = MIN(MAX(value + ?, ?), ?)',
+                (scope, key, default, change, low, high, change, low, high))
+            value = conn.execute(
+                'SELECT value FROM settings WHERE scope = ? AND key = ?',
+                (scope, key)).fetchone()[0]
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return value
+
+    def add_game(self, white, black, result, plies, match=None):
+        """
+        Record how a game went (players are given by who they are,
+        see Player.identity)
+        """
+        self.connection().execute(
+            'INSERT INTO games (match, white, black, result, plies, ended) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (match, white, black, result, plies, time.time()))
+
+    def games(self, player=None, match=None, limit=100):
+        """
+        Return the latest games (of a player, and/or of a match),
+        most recent first, as (match, white, black, result, plies, ended)
+        """
+        where, args = [], []
+        if player is not None:
+            where.append('(white = ? OR black = ?)')
+            args += [player, player]
+        if match is not None:
+            where.append('match = ?')
+            args.append(match)
+        sql = 'SELECT match, white, black, result, plies, ended FROM games'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY id DESC LIMIT ?'
+        return self.connection().execute(sql, args + [limit]).fetchall()
+
+    def import_save_file(self, conn):
+        """
+        Move the difficulty over from the old save file (the first time
+        the store is used), as the difficulty against any opponent
+        we don't know yet
+        """
+        if not os.path.exists(OLD_SAVE_FILE_NAME) or conn.execute(
+                'SELECT 1 FROM settings WHERE scope = ? AND key = ?',
+                (DEFAULTS_SCOPE, 'difficulty')).fetchone():
+            return
+        with open(OLD_SAVE_FILE_NAME) as f:
+            saved = yaml.safe_load(f) or {}
+        if 'difficulty' in saved:
+            conn.execute(
+                'INSERT OR IGNORE INTO settings (scope, key, value) '
+                'VALUES (?, ?, ?)',
+                (DEFAULTS_SCOPE, 'difficulty', float(saved['difficulty'])))
+
+
+def opponent_scope(identity):
+    """
+    The scope of an opponent's settings
+    """
+    return f'opponent:{identity}'
+
+
+# The store every game in this process uses
+STORE = Store()
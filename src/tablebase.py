@@ -0,0 +1,102 @@
+import os
+import threading
+
+import chess
+import chess.syzygy
+from chess.engine import Cp, Mate
+
+# Scores given to tablebase wins (and losses), minus how far off they are
+# (well past anything that would make us resign, but still below mate)
+WIN_SCORE = 10000
+
+
+class Tablebase():
+    """
+    Any Syzygy endgame tables (.rtbw and .rtbz files) kept in a folder.
+    When there are few enough pieces left, these tell us exactly which
+    moves win, draw or lose, without searching at all.
+    The tables are opened once, and kept open across games
+    (probing is safe from several games at once)
+    """
+
+    def __init__(self, folder='assets'):
+        self.folder = folder
+        self.tables = None
+        # The most pieces any of our tables cover (0 if we have none)
+        self.max_pieces = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        """
+        Find the tables in our folder (only the first time we are asked)
+        """
+        with self.lock:
+            if self.tables is not None:
+                return
+            tables = chess.syzygy.Tablebase()
+            if self.folder and os.path.isdir(self.folder):
+                tables.add_directory(self.folder)
+            # (table names are like KQvKR, one letter per piece)
+            self.max_pieces = max(
+                (len(name) - 1 for name in tables.wdl), default=0)
+            self.tables = tables
+
+    def close(self):
+        """
+        Close any tables we opened
+        """
+        with self.lock:
+            if self.tables is not None:
+                self.tables.close()
+                self.tables = None
+                self.max_pieces = 0
+
+    def covers(self, board):
+        """
+        Check if our tables could have the given board in them
+        """
+        self.open()
+        return (chess.popcount(board.occupied) <= self.max_pieces and
+                not board.castling_rights)
+
+    def probe(self, board):
+        """
+        Return a dict of each legal move to its exact score (from the point
+        of view of whoever is to move), or None if our tables don't have
+        this board (or something goes wrong reading them)
+        """
+        if not self.covers(board):
+            return None
+        board = board.copy(stack=False)
+        scores = {}
+        try:
+            for move in board.legal_moves:
+                board.push(move)
+                scores[move] = self.score_after(board)
+                board.pop()
+        except (KeyError, OSError, chess.syzygy.MissingTableError):
+            return None
+        return scores
+
+    def score_after(self, board):
+        """
+        Score the move that led to the given board, for whoever made it.
+        Wins are better the sooner the win is made safe (a capture or
+        pawn move), and losses are better the longer they are put off
+        """
+        if board.is_checkmate():
+            return Mate(1)
+        wdl = -self.tables.probe_wdl(board)
+        if wdl == 0:
+            return Cp(0)
+        if abs(wdl) == 1:
+            # (a win, or loss, that the fifty move rule turns into a draw)
+            return Cp(wdl)
+        dtz = abs(self.tables.probe_dtz(board))
+        if wdl > 0:
+            return Cp(WIN_SCORE - dtz)
+        return Cp(-WIN_SCORE + dtz)
+
+
+# The tables every game in this process probes
+TABLEBASE = Tablebase()
@@ -1,9 +1,82 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import random as rand
+import re
+import smtplib
+import socket
+import tempfile
+import threading
+import time
+import types
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.text import MIMEText
+
+import chess
+import chess.pgn
+from chess.engine import Cp, Limit, Mate, MateGiven, PovScore
+
 from player import QueuePlayer
 from referee import Referee
+import journal as journal_module
+from journal import Journal
+import mail_transport
+from mail_transport import IMAPTransport, Outbox
+from mail_router import MailRouter
+from analysis import MoveAnalysis, TurnAnalysis
+from stockfish_player import StockfishPlayer
+import engine_pool
+from engine_pool import EnginePool
+import skill
+from time_manager import TimeManager
+from tablebase import Tablebase
+from opening_book import OpeningBook, parse_games
+from journal import MemoryJournal
+import tournament
+from tournament import Entrant, Tournament, elo, random_opening, to_pgn
+import benchmark
+import eval_cache
+from eval_cache import EvalCache
+import metrics
+from checkpoint import Checkpoint, restore_player
+from scheduler import Scheduler
+from async_player import AsyncInbox, adapt
+from async_referee import AsyncReferee, play_games
+import store
+from review import Review
+from game_state import GameState, Ply, pack_move, unpack_move, SLACK
 
 
 def main():
     test_check()
+    test_journal()
+    test_imap()
+    test_imap_idle()
+    test_outbox()
+    test_mail_router()
+    test_analysis()
+    test_eval_cache()
+    test_time_manager()
+    test_skill()
+    test_engine_pool()
+    test_ponder()
+    test_multipv()
+    test_tablebase()
+    test_opening_book()
+    test_english()
+    test_check_move()
+    test_tournament()
+    test_benchmark_compare()
+    test_metrics()
+    test_checkpoint()
+    test_scheduler()
+    test_async_games()
+    test_analyse()
+    test_store()
+    test_review()
+    test_game_state()
 
 
 def test_check():
@@ -14,9 +87,1032 @@ def test_check():
     white = QueuePlayer(white_moves)
     black = QueuePlayer(black_moves)
 
-    r = Referee(white, black)
+    r = Referee(white, black, journal=MemoryJournal())
     r.play_game()
     print('All we were looking for was the " - check"')
 
 
+def test_journal():
+    # Play a couple games into a throwaway journal, loading a previous
+    # board partway through the second
+    folder = tempfile.mkdtemp()
+    journal = Journal(os.path.join(folder, 'journal.txt'), sync_every=2)
+
+    r = Referee(QueuePlayer(['e2e3', 'f1b5']), QueuePlayer(['d7d6']),
+                journal=journal)
+    r.play_game()
+    start_fen = r.board.fen()
+
+    r.white_player.moves = ['e2e4', 'g1f3', 'd2d4']
+    r.black_player.moves = ['e7e5', '*prev 1', 'b8c6']
+    r.play_game()
+    # (boards back from the end: game end, resign, b8c6, d2d4)
+    d2d4_fen = journal.previous_fen(3)
+    assert d2d4_fen.startswith('rnbqkbnr/pppp1ppp/8/4p3/3PP3/8/'), d2d4_fen
+
+    # Finished games get moved to the archive when the next one starts,
+    # where previous boards can still be found (even after a restart)
+    end_fen = journal.previous_fen(0)
+    journal.start_game(start_fen)
+    assert journal.previous_fens(5)[:2] == [start_fen, end_fen]
+    with open(journal.archive_name) as archive:
+        kinds = [line.split('\t')[0] for line in archive]
+    assert kinds.count('start') == 2 and kinds.count('end') == 2, kinds
+    journal.close()
+    journal = Journal(journal.file_name, sync_every=2)
+    assert journal.previous_fen(4) == d2d4_fen
+    assert len(journal.previous_fens(100)) == len(kinds) + 1
+
+    # A half written record (from a crash) is dropped when reopened
+    journal.close()
+    with open(journal.file_name, 'a') as f:
+        f.write('move\t123')
+    journal = Journal(journal.file_name)
+    assert journal.previous_fen(0) == start_fen
+
+    # A crash partway through compacting doesn't archive games twice
+    journal.end_game('*', start_fen)
+    real_write_synced = journal_module.write_synced
+
+    def crash(file_name, data):
+        if file_name == journal.file_name:
+            raise RuntimeError('Crashed')
+        real_write_synced(file_name, data)
+    journal_module.write_synced = crash
+    try:
+        journal.start_game(start_fen)
+        assert False, 'Should have crashed'
+    except RuntimeError:
+        pass
+    finally:
+        journal_module.write_synced = real_write_synced
+    journal = Journal(journal.file_name)
+    journal.start_game(start_fen)
+    with open(journal.archive_name) as archive:
+        kinds = [line.split('\t')[0] for line in archive]
+    assert kinds.count('start') == 3 and kinds.count('end') == 3, kinds
+
+
+class FakeIMAP():
+    """
+    A stand-in for an IMAP server connection,
+    which just searches through a dict of uid to raw email
+    """
+    capabilities = ('IMAP4REV1',)
+
+    def __init__(self, emails):
+        self.emails = emails
+
+    def login(self, username, password):
+        return 'OK', [b'Logged in']
+
+    def select(self, mailbox):
+        return 'OK', [str(len(self.emails)).encode()]
+
+    def status(self, mailbox, names):
+        return 'OK', [b'INBOX (UIDNEXT %d)' % (max(self.emails) + 1)]
+
+    def header(self, uid, name):
+        match = re.search(rf'^{name}: (.*)$', self.emails[uid], re.M)
+        return match.group(1)
+
+    def uid(self, command, *args):
+        if command == 'SEARCH':
+            criteria = ' '.join(args[1:])
+            first = int(re.search(r'UID (\d+):\*', criteria).group(1))
+            senders = re.findall(r'FROM "([^"]*)"', criteria)
+            subject = re.search(r'SUBJECT "([^"]*)"', criteria)
+            subject = subject.group(1) if subject else ''
+            uids = [
+                uid for uid in self.emails
+                if uid >= first and subject in self.header(uid, 'Subject')
+                and any(s in self.header(uid, 'From') for s in senders)
+            ]
+            # (n:* always includes the newest email, even if before n)
+            if max(self.emails) < first:
+                uids.append(max(self.emails))
+            return 'OK', [' '.join(str(uid) for uid in uids).encode()]
+
+        if command == 'FETCH':
+            header, body = self.emails[int(args[0])].split('\n\n', 1)
+            return 'OK', [(b'HEADER', header.encode()),
+                          (b'BODY[1]', body.encode()), b')']
+
+    def logout(self):
+        return 'BYE', []
+
+
+def email(sender, subject, body):
+    return f'From: {sender}\nSubject: {subject}\nDate: now\n\n{body}'
+
+
+def test_imap():
+    # Only new emails, from the targets, about the match are fetched
+    emails = {1: email('alice@example.com', 'Re: The Red Fox', 'e2e4')}
+    server = FakeIMAP(emails)
+    transport = IMAPTransport('localhost', 143, 'bob', 'pw',
+                              ['alice@example.com'],
+                              connect=lambda host, port: server)
+    assert transport.fetch_new('The Red Fox') == []
+
+    emails[2] = email('alice@example.com', 'Re: The Red Fox', 'e7e5')
+    emails[3] = email('eve@example.com', 'Re: The Red Fox', 'a7a6')
+    emails[4] = email('alice@example.com', 'Re: The Blue Cat', 'h7h6')
+    new = transport.fetch_new('The Red Fox')
+    assert [(uid, m.get_payload()) for uid, m in new] == [('2', 'e7e5')], new
+    assert transport.fetch_new('The Red Fox') == []
+
+
+class IdlingIMAP():
+    """
+    A stand-in for an IMAP server connection that can IDLE, over a real
+    socket (with whatever the server says written up front)
+    """
+    capabilities = ('IMAP4REV1', 'IDLE')
+
+    def __init__(self, said, hang_up=False):
+        self.sock, server = socket.socketpair()
+        server.sendall(said)
+        if hang_up:
+            server.shutdown(socket.SHUT_WR)
+        self.server = server
+        self.file = self.sock.makefile('rb')
+
+    def _new_tag(self):
+        return b'A001'
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        return self.file.readline()
+
+    def logout(self):
+        self.sock.close()
+
+
+def test_imap_idle():
+    # Mail arriving while idling is noticed right away (even when the
+    # server's lines all come in at once)
+    transport = IMAPTransport('localhost', 143, 'bob', 'pw', [])
+    transport.last_uid = 0
+    transport.conn = IdlingIMAP(
+        b'+ idling\r\n* 3 EXISTS\r\nA001 OK IDLE done\r\n')
+    start = time.monotonic()
+    transport.wait(5)
+    assert time.monotonic() - start < 1
+    assert transport.conn is not None
+
+    # and the server hanging up on us drops the connection
+    # (rather than waiting on it forever)
+    transport.conn = IdlingIMAP(b'+ idling\r\n', hang_up=True)
+    waiting = threading.Thread(target=transport.wait, args=(0.1,))
+    waiting.start()
+    waiting.join(5)
+    assert not waiting.is_alive() and transport.conn is None
+
+
+class FakeSMTP():
+    """
+    A stand-in for an SMTP server connection,
+    which drops the connection on the first email it is sent
+    """
+
+    def __init__(self, sent):
+        self.sent = sent
+
+    def login(self, username, password):
+        pass
+
+    def sendmail(self, sender, targets, message):
+        if not self.sent:
+            self.sent.append(None)
+            raise smtplib.SMTPServerDisconnected('Dropped')
+        self.sent.append(message)
+
+    def quit(self):
+        pass
+
+
+def test_outbox():
+    # Emails are sent in the background, and retried if they fail
+    sent = []
+    folder = tempfile.mkdtemp()
+    outbox = Outbox('localhost', 465, 'bob', 'pw', spool_folder=folder,
+                    connect=lambda host, port: FakeSMTP(sent))
+    outbox.first_retry_wait = 0
+    outbox.send(MIMEText('e2e4'), 'bob@example.com', ['alice@example.com'])
+    outbox.flush()
+    assert len(sent) == 2 and sent[1].endswith('e2e4'), sent
+    assert os.listdir(folder) == []
+
+    # An email left in the spool by a crash is sent as soon as the
+    # outbox is made again, without waiting on a new one
+    with open(os.path.join(folder, '1-000000.json'), 'w') as f:
+        json.dump({'sender': 'bob@example.com',
+                   'targets': ['alice@example.com'],
+                   'message': MIMEText('e7e5').as_string()}, f)
+    sent = [None]
+
+    class ScratchOutbox(Outbox):
+        def __init__(self, *args):
+            super().__init__(*args, spool_folder=folder,
+                             connect=lambda host, port: FakeSMTP(sent))
+
+    real_outbox = mail_transport.Outbox
+    mail_transport.Outbox, mail_transport.OUTBOX = ScratchOutbox, None
+    try:
+        config = types.SimpleNamespace(
+            smtp_ssl_host='localhost', smtp_ssl_port=465, username='bob',
+            password='pw')
+        mail_transport.get_outbox(config).flush()
+    finally:
+        mail_transport.Outbox, mail_transport.OUTBOX = real_outbox, None
+    assert len(sent) == 2 and sent[1].endswith('e7e5'), sent
+    assert os.listdir(folder) == []
+
+
+def test_mail_router():
+    # Each email is handed to the match it is about, and only once
+    emails = {1: email('alice@example.com', 'Old', 'e2e4')}
+    server = FakeIMAP(emails)
+    seen_file = os.path.join(tempfile.mkdtemp(), 'seen.txt')
+
+    def make_router():
+        transport = IMAPTransport('localhost', 143, 'bob', 'pw',
+                                  ['alice@example.com'],
+                                  connect=lambda host, port: server)
+        return MailRouter(transport, seen_file=seen_file)
+
+    router = make_router()
+    router.check()
+    fox = router.register('The Red Fox')
+    emails[2] = email('alice@example.com', 'Re: The Red Fox', 'e7e5')
+    emails[3] = email('alice@example.com', 'RE: the red fox!', 'd7d5')
+    emails[4] = email('alice@example.com', 'Re: The Blue Cat', 'h7h6')
+    router.check()
+    read = [fox.get_nowait() for i in range(2)]
+    assert [m.get_payload() for m in read] == ['e7e5', 'd7d5']
+    router.consumed(read)
+
+    # Emails for a match that isn't registered yet wait for it
+    cat = router.register('The Blue Cat')
+    assert cat.get_nowait().get_payload() == 'h7h6'
+
+    # After a restart, read emails are not handed over again,
+    # but unread ones, and ones that came in while we were down, are
+    emails[5] = email('alice@example.com', 'Re: The Red Fox', 'c7c5')
+    router = make_router()
+    fox = router.register('The Red Fox')
+    router.check()
+    assert fox.get_nowait().get_payload() == 'c7c5'
+    assert fox.empty()
+    cat = router.register('The Blue Cat')
+    assert cat.get_nowait().get_payload() == 'h7h6'
+
+
+def test_analysis():
+    # Moves are ranked best first (unscored last), and deciding whether
+    # to resign only looks at the analysis
+    e4, d4, a3, h3 = (chess.Move.from_uci(m)
+                      for m in ['e2e4', 'd2d4', 'a2a3', 'h2h3'])
+    analysis = TurnAnalysis(chess.STARTING_FEN, [
+        MoveAnalysis(a3, Cp(-30), 10), MoveAnalysis(h3),
+        MoveAnalysis(e4, Cp(40), 12, [e4, chess.Move.from_uci('e7e5')]),
+        MoveAnalysis(d4, Cp(35), 12)])
+    assert analysis.moves() == [e4, d4, a3, h3], analysis.moves()
+    assert analysis.get(e4).reply() == chess.Move.from_uci('e7e5')
+
+    player = StockfishPlayer(difficulty=1)
+    assert not player.should_resign(analysis)
+    assert player.choose_move(analysis) == e4
+    lost = TurnAnalysis(chess.STARTING_FEN, [
+        MoveAnalysis(a3, Mate(-3)), MoveAnalysis(e4, Cp(-2500))])
+    assert lost.best().move == e4
+    assert player.should_resign(lost)
+
+
+def test_eval_cache():
+    # Scores are packed into records (and back) as they were,
+    # keyed by the board and the limit they were searched with
+    cache = EvalCache(None, buckets=1)
+    board = chess.Board()
+    scores = [Cp(-35), Mate(3), Mate(-2), MateGiven]
+    for i, score in enumerate(scores):
+        cache.put(board, Limit(time=i + 1), score, depth=20 + i)
+    for i, score in enumerate(scores):
+        assert cache.get_entry(board, Limit(time=i + 1)) == (score, 20 + i)
+    assert cache.get(board, Limit(depth=1)) is None
+    assert eval_cache.RECORD.size == 24
+
+    # A full bucket (of 4) makes room by dropping its least recently
+    # used record (not the oldest one put in)
+    cache.get(board, Limit(time=1))
+    cache.put(board, Limit(time=5), Cp(10))
+    assert cache.get(board, Limit(time=1)) == Cp(-35)
+    assert cache.get(board, Limit(time=2)) is None
+    # (putting a key that is already there just replaces it)
+    cache.put(board, Limit(time=5), Cp(20))
+    assert cache.get(board, Limit(time=3)) == Mate(-2)
+    assert cache.get(board, Limit(time=5)) == Cp(20)
+
+    # The cache file keeps everything when reopened,
+    # but one of another size is started over
+    file_name = os.path.join(tempfile.mkdtemp(), 'cache.bin')
+    cache = EvalCache(file_name, buckets=8)
+    cache.put(board, Limit(time=1), Cp(42), depth=12)
+    cache.close()
+    assert EvalCache(file_name, buckets=8).get_entry(
+        board, Limit(time=1)) == (Cp(42), 12)
+    assert EvalCache(file_name, buckets=16).get(board, Limit(time=1)) is None
+
+
+def test_time_manager():
+    # Recaptures are obvious, and only get a small share of the turn
+    manager = TimeManager()
+    board = chess.Board()
+    assert not manager.is_recapture(board)
+    assert manager.allocate(board, 10) == (5, 10)
+    for uci in ['e2e4', 'd7d5', 'e4d5']:
+        board.push_uci(uci)
+    assert manager.is_recapture(board)
+    assert manager.allocate(board, 10) == (1, 10)
+    # (a capture that can't be taken back isn't one)
+    board = chess.Board('4k3/8/8/3p4/4P3/8/8/4K3 w - - 0 1')
+    board.push_uci('e4d5')
+    assert not manager.is_recapture(board)
+
+    # A depth reported again replaces what it said before
+    e4, d4 = chess.Move.from_uci('e2e4'), chess.Move.from_uci('d2d4')
+    manager.allocate(chess.Board(), 10)
+    manager.record(1, e4, Cp(20), Cp(10))
+    manager.record(1, d4, Cp(30))
+    assert manager.history == [(1, d4, Cp(30), None)]
+
+    def settled(best_scores, margin, moves=(e4,) * 4):
+        manager.allocate(chess.Board(), 10)
+        for depth, (move, score) in enumerate(zip(moves, best_scores)):
+            manager.record(depth, move, Cp(score), Cp(score - margin))
+        return manager
+
+    # A settled ranking stops at the soft time (half the turn),
+    # one that is well ahead stops at the obvious share already
+    assert not settled([20] * 4, 50).should_stop(4.9)
+    assert settled([20] * 4, 50).should_stop(5)
+    assert not settled([20] * 4, 50).should_stop(1)
+    assert settled([20] * 4, 200).should_stop(1)
+    assert not settled([20] * 4, 200).should_stop(0.9)
+
+    # Whereas critical rankings (too few depths, a changing best move,
+    # a swinging score, a close second) never stop early
+    assert not settled([20] * 3, 200).should_stop(9.9)
+    assert not settled([20] * 4, 200, (e4, d4, e4, e4)).should_stop(9.9)
+    assert not settled([20, 90, 20, 20], 200).should_stop(9.9)
+    assert not settled([20] * 4, 10).should_stop(9.9)
+
+
+def test_skill():
+    # Harder difficulties get higher skill levels, and fewer random moves
+    settings = [skill.skill_settings(d / 20) for d in range(21)]
+    assert settings[0] == (0, 1.0) and settings[-1] == (20, 0.0)
+    for (level, share), (next_level, next_share) in zip(settings,
+                                                        settings[1:]):
+        assert level <= next_level and share >= next_share, settings
+
+
+class FakeTables():
+    """
+    Stands in for the syzygy tables of KQvK: the side with the queen
+    wins (sooner the closer its king is to the other king)
+    """
+
+    wdl = {'KQvK': None}
+
+    def probe_wdl(self, board):
+        return 2 if board.turn == chess.WHITE else -2
+
+    def probe_dtz(self, board):
+        kings = chess.square_distance(board.king(chess.WHITE),
+                                      board.king(chess.BLACK))
+        return kings if board.turn == chess.WHITE else -kings
+
+
+class FakeEngine():
+    """
+    A stand-in for a running engine, which only knows if it has quit,
+    and which boards it was asked to analyse
+    """
+
+    def __init__(self):
+        self.returncode = concurrent.futures.Future()
+        self.analysed = []
+
+    def ping(self):
+        pass
+
+    def quit(self):
+        self.returncode.set_result(0)
+
+    def analysis(self, board, limit=None, multipv=None):
+        self.analysed.append(board.fen())
+        return FakeAnalysis(board)
+
+
+class FakeAnalysis():
+    """
+    A stand-in for a running analysis, which has found that the first
+    legal move is worth a pawn
+    """
+
+    def __init__(self, board):
+        move = next(iter(board.legal_moves))
+        self.multipv = [{'pv': [move], 'depth': 8, 'multipv': 1,
+                         'score': PovScore(Cp(100), board.turn)}]
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class FakePool(EnginePool):
+    """
+    An engine pool of FakeEngines
+    """
+
+    def spawn(self):
+        engine = FakeEngine()
+        with self.condition:
+            self.engines.add(engine)
+        return engine
+
+
+def test_engine_pool():
+    # Someone taking back a lent engine keeps their place in line,
+    # and closing the pool quits every engine, even those checked out
+    pool = FakePool(size=1)
+    got = []
+    third_waiting = threading.Event()
+
+    def give_back(engine):
+        # (someone else gets in line while the engine is being given back)
+        third_waiting.wait(5)
+        time.sleep(0.1)
+        pool.checkin(engine)
+
+    def take(name):
+        engine = pool.checkout()
+        got.append(name)
+        time.sleep(0.1)
+        pool.checkin(engine)
+
+    lent = pool.checkout(preempt=give_back)
+    second = threading.Thread(target=take, args=('second',))
+    second.start()
+    time.sleep(0.1)
+    third = threading.Thread(target=take, args=('third',))
+    third.start()
+    time.sleep(0.1)
+    third_waiting.set()
+    second.join(5)
+    third.join(5)
+    assert got == ['second', 'third'], got
+
+    engine = pool.checkout()
+    pool.close()
+    assert engine is lent and engine.returncode.done()
+    pool.checkin(engine)
+    assert pool.spawned == 0 and not pool.engines
+
+
+def test_ponder():
+    # Pondering uses a free engine on our opponent's time, and either
+    # hands over what it found (if they played what we expected), or
+    # just the engine (if not), and gives the engine back if another
+    # game needs it
+    real_pool, real_cache = engine_pool.POOL, eval_cache.CACHE
+    engine_pool.POOL = FakePool(size=1)
+    eval_cache.CACHE = EvalCache(None)
+    try:
+        player = StockfishPlayer(difficulty=1, persist=False)
+        referee = Referee(QueuePlayer([]), player, journal=MemoryJournal())
+        referee.board = chess.Board()
+        e4 = chess.Move.from_uci('e2e4')
+
+        # A hit: the time (and lines) pondered count towards our turn
+        player.ponder_move = e4
+        player.ponder()
+        engine = player.stockfish
+        referee.board.push(e4)
+        pondered_time, infos = player.stop_pondering()
+        assert engine.analysed == [referee.board.fen()]
+        assert pondered_time > 0 and infos and player.stockfish is engine
+        moves = list(referee.board.legal_moves)
+        lines, source = player.search_lines(
+            moves, Limit(time=pondered_time / 2), pondered_time, infos)
+        assert source == 'ponder' and len(engine.analysed) == 1
+        # (scores come out from our side, and unreported moves are left
+        # unscored)
+        assert lines[0].score == Cp(100) and lines[1].score is None
+        player.release_stockfish()
+
+        # A miss: we keep the engine, but nothing else
+        player.ponder_move = chess.Move.from_uci('e7e5')
+        player.ponder()
+        referee.board.push_uci('d7d5')
+        assert player.stop_pondering() == (0, None)
+        assert player.stockfish is engine
+        player.release_stockfish()
+
+        # Another game taking the engine back stops the pondering
+        player.ponder()
+        assert player.stockfish is engine
+        assert engine_pool.POOL.checkout() is engine
+        assert player.stockfish is None and player.pondering is None
+        assert player.stop_pondering() == (0, None)
+        # (and with no engine free, there is no pondering at all)
+        player.ponder()
+        assert player.pondering is None
+        engine_pool.POOL.checkin(engine)
+    finally:
+        engine_pool.POOL, eval_cache.CACHE = real_pool, real_cache
+
+
+def test_multipv():
+    # The one MultiPV search ranks moves the way searching each move on
+    # its own does, with scores from the player's side (either colour)
+    for fen, best in [('4k3/8/8/3q4/8/8/3R4/4K3 w - - 0 1', 'd2d5'),
+                      ('4k3/3r4/8/8/3Q4/8/8/4K3 b - - 0 1', 'd7d4')]:
+        player = StockfishPlayer(difficulty=1, persist=False,
+                                 can_ponder=False, nodes=20000)
+        if ' w ' in fen:
+            referee = Referee(player, QueuePlayer([]),
+                              journal=MemoryJournal())
+        else:
+            referee = Referee(QueuePlayer([]), player,
+                              journal=MemoryJournal())
+        referee.board = chess.Board(fen)
+        try:
+            lines, source = player.get_multipv_lines()
+            multipv = TurnAnalysis(fen, lines, source)
+            separate = TurnAnalysis(fen, player.get_separate_lines())
+        finally:
+            player.release_stockfish()
+        assert len(multipv.moves()) == len(separate.moves())
+        for analysis in (multipv, separate):
+            assert analysis.best().move.uci() == best, analysis.moves()
+            assert analysis.best().score.score() > 500, analysis.best()
+        # (a move the search didn't report on ranks last, however good)
+        unreported = [MoveAnalysis(line.move) if line.move.uci() == best
+                      else line for line in lines]
+        assert TurnAnalysis(fen, unreported).moves()[-1].uci() == best
+
+
+def test_tablebase():
+    # Without tables, we fall back to the engine
+    assert Tablebase(tempfile.mkdtemp()).probe(chess.Board()) is None
+
+    # With them, moves are ranked exactly
+    tables = Tablebase()
+    tables.tables = FakeTables()
+    tables.max_pieces = 3
+    assert tables.probe(chess.Board()) is None
+    board = chess.Board('8/8/8/3k4/8/8/1Q6/K7 w - - 0 1')
+    scores = tables.probe(board)
+    player = StockfishPlayer(difficulty=1)
+    analysis = TurnAnalysis(board.fen(), [MoveAnalysis(move, score)
+                                          for move, score in scores.items()])
+    assert analysis.best().move == chess.Move.from_uci('a1a2'), analysis
+    assert not player.should_resign(analysis)
+
+
+def test_opening_book():
+    # Our own book learns from the journal which moves won
+    records = []
+    for moves, result in [('e2e4 e7e5 g1f3 b8c6 f1c4 g8f6 e1g1', '1-0'),
+                          ('e2e4 c7c5 d2d4', '0-1')]:
+        board = chess.Board()
+        records.append(['start', '0', '-', board.fen()])
+        for move in moves.split():
+            board.push_uci(move)
+            records.append(['move', '0', move, board.fen()])
+        # (resigning jumps to a made up board, which isn't learnt from)
+        records.append(['move', '0', '0000', '7k/5KQ1/8/8/8/8/8/8 b - - 1 1'])
+        records.append(['end', '0', result, '7k/5KQ1/8/8/8/8/8/8 b - - 1 1'])
+
+    folder = tempfile.mkdtemp()
+    book = OpeningBook(os.path.join(folder, 'book.bin'),
+                       os.path.join(folder, 'own-book.bin'))
+    book.add_games(parse_games(records))
+    board = chess.Board()
+    assert book.find(board) == {chess.Move.from_uci('e2e4'): 2}
+    board.push_uci('e2e4')
+    # (e7e5 only ever lost, so is never played)
+    assert book.choose(board, 0) == chess.Move.from_uci('c7c5')
+    for move in 'e7e5 g1f3 b8c6 f1c4 g8f6'.split():
+        board.push_uci(move)
+    assert book.find(board) == {chess.Move.from_uci('e1g1'): 2}
+    board.push_uci('e1g1')
+    assert book.find(board) == {}
+
+
+def test_english():
+    # Moves read exactly as they always have (see assets/english-golden.txt,
+    # lines of: fen, input, s for a string or m for a move, english)
+    referee = Referee(QueuePlayer([]), QueuePlayer([]),
+                      journal=MemoryJournal())
+    with open('assets/english-golden.txt') as f:
+        golden = [line.rstrip('\n').split('\t') for line in f]
+    # (twice over, so remembered translations are checked too)
+    for fen, inp, mode, expected in golden + golden:
+        referee.board = chess.Board(fen)
+        if mode == 'm':
+            inp = chess.Move.from_uci(inp)
+            referee.board.push(inp)
+        try:
+            english = referee.parser.move_to_english(inp)
+        except ValueError:
+            english = '!ValueError'
+        assert english == expected, (fen, inp, english, expected)
+
+
+def test_check_move():
+    # Bad moves say whether they couldn't be read, or couldn't be played
+    referee = Referee(QueuePlayer([]), QueuePlayer([]),
+                      journal=MemoryJournal())
+    referee.board = chess.Board()
+    assert referee.check_move('e2e4').move == chess.Move.from_uci('e2e4')
+    assert referee.is_move('0000')
+    assert referee.check_move('e2e5').problem == 'illegal'
+    assert referee.check_move('hello').problem == 'invalid'
+    assert not referee.is_move('e7e5')
+
+
+def test_tournament():
+    # Games can be played without touching any files,
+    # and still be written out as PGN
+    journal = MemoryJournal()
+    white, black = QueuePlayer(['f2f3', 'g2g4']), QueuePlayer(['e7e5', 'd8h4'])
+    Referee(white, black, journal=journal).play_game()
+    pgn = to_pgn(journal, Entrant('fool'), Entrant('mate'), (0.5, 0.5))
+    assert pgn.endswith('1. f3 e5 2. g4 Qh4# 0-1'), pgn
+    # Entrants are read from 'name:key=value,...'
+    weak = Entrant.parse('weak:difficulty=0.3,adapt=1,step=0.1,'
+                         'strength=skill,multipv=no,time=0.5')
+    assert (weak.name, weak.difficulty, weak.adapt, weak.step) == \
+        ('weak', 0.3, True, 0.1)
+    assert (weak.strength, weak.multipv, weak.time) == ('skill', False, 0.5)
+    strong = Entrant.parse('strong')
+    assert (strong.difficulty, strong.adapt, strong.step) == (0.5, False, None)
+    try:
+        Entrant.parse('odd:speed=2')
+        assert False, 'Should have failed'
+    except ValueError:
+        pass
+
+    # The Elo difference (and its 95% confidence interval) of the scores
+    difference, margin = elo([1, 0, 0.5, 0.5])
+    assert difference == 0 and round(margin) == 297, margin
+    difference, margin = elo([1, 1, 1, 0])
+    assert round(difference) == 191, difference
+    difference, margin = elo([1, 0] * 50)
+    assert difference == 0 and round(margin) == 69, margin
+    # (a perfect score is kept finite)
+    difference, margin = elo([1] * 10)
+    assert round(difference) == 1200 and margin == 0
+
+    # Openings are random, but the same for the same seed
+    assert random_opening(rand.Random(1), 4).fen() == \
+        random_opening(rand.Random(1), 4).fen()
+    assert len(random_opening(rand.Random(1), 4).move_stack) == 4
+
+    # A pairing with an adapting entrant plays its chunks one after
+    # another, each starting on the difficulty the last one ended on
+    calls = []
+
+    def play_chunk(first, second, games, seed, opening_plies,
+                   difficulties=(None, None)):
+        calls.append((first.name, second.name, difficulties))
+        ended = tuple(
+            (difficulty or entrant.difficulty) + 0.1 if entrant.adapt
+            else entrant.difficulty
+            for entrant, difficulty in zip((first, second), difficulties))
+        return first.name, second.name, [('', 1)] * games, ended
+
+    real = tournament.play_chunk, tournament.ProcessPoolExecutor
+    tournament.play_chunk = play_chunk
+    tournament.ProcessPoolExecutor = ThreadPoolExecutor
+    try:
+        table = Tournament([weak, strong, Entrant.parse('other')],
+                           games=30, workers=2).run()
+    finally:
+        tournament.play_chunk, tournament.ProcessPoolExecutor = real
+    adapting = [d for first, second, d in calls
+                if (first, second) == ('weak', 'strong')]
+    assert [tuple(round(d, 1) if d else d for d in pair)
+            for pair in adapting] == \
+        [(None, None), (0.4, 0.5), (0.5, 0.5)], adapting
+    assert len(calls) == 9 and 'strong vs other' in table, calls
+
+
+def test_benchmark_compare():
+    # Rates are better higher, times better lower, and small changes are noise
+    baseline = {'results': {'english': {'english_per_sec': 100},
+                            'storage': {'commit_fen_mean_ms': 1.0,
+                                        'save_update_mean_ms': 1.0}}}
+    table = benchmark.compare(
+        {'english': {'english_per_sec': 50},
+         'storage': {'commit_fen_mean_ms': 0.5, 'save_update_mean_ms': 1.01}},
+        baseline).splitlines()
+    assert table[1].endswith('WORSE'), table
+    assert table[2].endswith('better'), table
+    assert table[3].endswith('%'), table
+
+
+def test_metrics():
+    # Every ply of a game is written as a line of JSON (the file rotating
+    # once full), and added up for the endpoint
+    file_name = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+    real_metrics = metrics.METRICS
+    metrics.METRICS = metrics.Metrics(file_name, max_bytes=400, backups=1)
+    try:
+        white, black = QueuePlayer(['f2f3', 'g2g4']), \
+            QueuePlayer(['e7e4', 'e7e5', 'd8h4'])
+        Referee(white, black, journal=MemoryJournal()).play_game()
+
+        lines = []
+        for name in (f'{file_name}.1', file_name):
+            with open(name) as f:
+                lines += [json.loads(line) for line in f]
+        assert [line['event'] for line in lines] == ['ply'] * 4 + ['game']
+        assert lines[0]['player'] == 'QueuePlayer' and lines[0]['ply'] == 0
+        assert lines[-1]['result'] == '0-1'
+
+        assert metrics.METRICS.get('ply_total',
+                                   {'player': 'QueuePlayer'}) == 4
+        assert metrics.METRICS.get('bad_moves_total',
+                                   {'problem': 'illegal'}) == 1
+        port = metrics.METRICS.serve(port=0)
+        url = f'http://127.0.0.1:{port}/metrics'
+        with urllib.request.urlopen(url) as response:
+            text = response.read().decode()
+        assert 'chess_ply_total{player="QueuePlayer"} 4' in text, text
+        assert '# TYPE chess_game_plies_total counter' in text, text
+        assert 'chess_game_plies_total 4' in text, text
+        assert '_sum' not in text, text
+
+        # A second copy (finding the port taken) carries on without serving
+        assert metrics.Metrics().serve(port=port) is None
+    finally:
+        metrics.METRICS.close()
+        metrics.METRICS = real_metrics
+
+
+class CrashingPlayer(QueuePlayer):
+    """
+    A test player which crashes (rather than resigns) once out of moves
+    """
+
+    def get_move(self):
+        if not self.moves:
+            raise RuntimeError('Crashed')
+        return self.moves.pop(0)
+
+
+def test_checkpoint():
+    # A game that crashes partway through is picked back up from its
+    # journal and checkpoint, players and all
+    folder = tempfile.mkdtemp()
+    journal = Journal(os.path.join(folder, 'journal.txt'))
+    checkpoint = Checkpoint(os.path.join(folder, 'checkpoint.json'))
+    white = CrashingPlayer(['e2e4', 'g1f3'])
+    black = CrashingPlayer(['e7e5', '*fen 4k3/8/8/8/8/8/8/4K2R b K - 0 1',
+                            'e8d8'])
+    referee = Referee(white, black, journal=journal, checkpoint=checkpoint)
+    try:
+        referee.play_game()
+        assert False, 'Should have crashed'
+    except RuntimeError:
+        pass
+
+    # (as if the process was started again)
+    journal = Journal(journal.file_name)
+    checkpoint = Checkpoint(checkpoint.file_name)
+    white, black, board = checkpoint.resume(journal)
+    assert isinstance(white, CrashingPlayer) and white.moves == []
+    # (players are found by the module they are from)
+    assert checkpoint.load()['white']['module'] == __name__
+    player = restore_player({'kind': 'QueuePlayer', 'module': 'player',
+                             'state': {'moves': ['e2e4']}})
+    assert player.moves == ['e2e4']
+    assert board.fen() == '3k4/8/8/8/8/8/8/4K2R w K - 1 2', board.fen()
+
+    white.moves, black.moves = ['h1h8'], ['*resign']
+    referee = Referee(white, black, journal=journal, checkpoint=checkpoint)
+    referee.play_game(board, resume=True)
+    assert referee.board.result() == '1-0'
+    assert checkpoint.resume(journal) is None
+    assert not os.path.exists(checkpoint.file_name)
+    kinds = [record[0] for record in journal.game_records()]
+    assert kinds == ['start'] + ['move'] * 6 + ['end'], kinds
+
+
+class ScratchScheduler(Scheduler):
+    """
+    A scheduler whose slots keep their files in a scratch folder
+    """
+
+    folder = tempfile.mkdtemp()
+
+    def journal_name(self, slot):
+        return os.path.join(self.folder, f'journal-{slot}.txt')
+
+    def checkpoint_name(self, slot):
+        return os.path.join(self.folder, f'checkpoint-{slot}.json')
+
+
+def test_scheduler():
+    # Not being able to start (e.g. no stockfish) isn't retried
+    # over and over, but stops every slot
+    def make_players():
+        raise FileNotFoundError('No stockfish')
+    scheduler = ScratchScheduler(make_players, games=2)
+    try:
+        scheduler.run()
+        assert False, 'Should have stopped'
+    except FileNotFoundError:
+        pass
+    assert not scheduler.running
+
+
+def test_async_games():
+    # Sync players play in async games (several at once),
+    # and the mail router can hand emails to a coroutine
+    referees = [AsyncReferee(QueuePlayer(['f2f3', 'g2g4']),
+                             QueuePlayer(['e7e5', 'd8h4']),
+                             journal=MemoryJournal()),
+                AsyncReferee(QueuePlayer(['e2e4', 'h2h9']),
+                             QueuePlayer(['e7e5']), journal=MemoryJournal())]
+    play_games(referees)
+    assert [r.board.result() for r in referees] == ['0-1', '0-1']
+    assert referees[0].board.is_checkmate()
+    # (subclasses are adapted as their parents are)
+    assert not adapt(CrashingPlayer([])).threaded
+    assert adapt(StockfishPlayer(difficulty=1, persist=False)).threaded
+
+    emails = {1: email('alice@example.com', 'Old', 'e2e4')}
+    server = FakeIMAP(emails)
+    transport = IMAPTransport('localhost', 143, 'bob', 'pw',
+                              ['alice@example.com'],
+                              connect=lambda host, port: server)
+    router = MailRouter(transport, seen_file=os.path.join(
+        tempfile.mkdtemp(), 'seen.txt'))
+    router.check()
+
+    async def wait_for_email():
+        inbox = router.register('The Red Fox',
+                                AsyncInbox(asyncio.get_running_loop()))
+        emails[2] = email('alice@example.com', 'Re: The Red Fox', 'e7e5')
+        # (the router checks on its own thread)
+        await asyncio.to_thread(router.check)
+        return await asyncio.wait_for(inbox.get(), 5)
+    assert asyncio.run(wait_for_email()).get_payload() == 'e7e5'
+
+    # Once the loop is gone, emails wait for the match to come back
+    emails[3] = email('alice@example.com', 'Re: The Red Fox', 'g8f6')
+    router.check()
+    assert router.register('The Red Fox').get_nowait().get_payload() == \
+        'g8f6'
+
+
+def test_analyse():
+    # A one-shot analysis lists the best moves, best first
+    import main as cli
+    text = cli.analyse('6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1', 0.05)
+    assert '1. d1d8' in text, text
+    assert cli.analyse('7k/6Q1/6K1/8/8/8/8/8 b - - 0 1') == 'Game over: 1-0'
+
+
+def test_store():
+    # Changes made at once (from threads, or another connection entirely)
+    # all count, and each opponent keeps their own difficulty
+    file_name = os.path.join(tempfile.mkdtemp(), 'store.db')
+    real_store = store.STORE
+    store.STORE = store.Store(file_name)
+    other = store.Store(file_name)
+    try:
+        alice = store.opponent_scope('email:alice@example.com')
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            changes = [executor.submit(saves.adjust, alice, 'difficulty',
+                                       0.01, default=0)
+                       for saves in [store.STORE, other] * 50]
+            for change in changes:
+                change.result()
+        assert round(store.STORE.get(alice, 'difficulty'), 6) == 1.0
+        assert store.STORE.adjust(alice, 'difficulty', 5, high=1) == 1
+        assert store.STORE.get(store.opponent_scope('bob'), 'difficulty',
+                               0.5) == 0.5
+
+        # A player picks up the difficulty of who they are playing
+        store.STORE.set(store.opponent_scope('QueuePlayer'), 'difficulty',
+                        0.3)
+        player = StockfishPlayer()
+        Referee(player, QueuePlayer([]), journal=MemoryJournal())
+        assert player.difficulty == 0.3
+        player.lose()
+        assert round(other.get(store.opponent_scope('QueuePlayer'),
+                               'difficulty'), 6) == 0.32
+
+        store.STORE.add_game('StockfishPlayer', 'QueuePlayer', '1-0', 9,
+                             match='happy-hippo')
+        store.STORE.add_game('StockfishPlayer', 'EmailPlayer', '0-1', 4)
+        games = other.games(player='QueuePlayer')
+        assert [game[:5] for game in games] == [
+            ('happy-hippo', 'StockfishPlayer', 'QueuePlayer', '1-0', 9)]
+        assert len(other.games()) == 2
+    finally:
+        other.close()
+        store.STORE.close()
+        store.STORE = real_store
+
+
+def test_review():
+    # Finished games (from PGN or journals) are written out annotated,
+    # and reviewing again only reviews games it hasn't already
+    folder = tempfile.mkdtemp()
+    pgn_file = os.path.join(folder, 'games.pgn')
+    with open(pgn_file, 'w') as f:
+        f.write('[White "fool"]\n[Black "mate"]\n[Result "0-1"]\n\n'
+                '1. f3 e5 2. g4 Qh4# 0-1\n\n')
+    journal = Journal(os.path.join(folder, 'journal.txt'))
+    white, black = QueuePlayer(['f2f3', 'g2g4']), QueuePlayer(['e7e5', 'd8h4'])
+    Referee(white, black, journal=journal).play_game()
+    journal.close()
+
+    out_file = os.path.join(folder, 'review.pgn')
+
+    def review():
+        return Review([pgn_file, journal.file_name], out_file=out_file,
+                      depth=4, batch_size=1, niceness=0,
+                      cache_file=os.path.join(folder, 'cache.bin')).run()
+
+    table = review()
+    with open(out_file) as f:
+        games = [chess.pgn.read_game(f), chess.pgn.read_game(f)]
+    assert games[0].headers['WhiteBlunders'] == '2', games[0]
+    assert '[%eval' in games[0].next().comment, games[0]
+    assert games[1].headers['Event'] == 'Journal', games[1]
+    assert 'fool' in table and 'Journal white' in table, table
+
+    # (anything written after the last checkpoint is thrown away)
+    size = os.path.getsize(out_file)
+    with open(out_file, 'a') as f:
+        f.write('half a game')
+    assert review() == table
+    assert os.path.getsize(out_file) == size
+
+    # (only the games added since are reviewed)
+    with open(pgn_file, 'a') as f:
+        f.write('[White "fool"]\n[Black "mate"]\n[Result "0-1"]\n\n'
+                '1. f3 e5 2. g4 Qh4# 0-1\n\n')
+    fool = [line.split() for line in review().split('\n')
+            if line.startswith('fool')]
+    assert fool[0][1] == '2', fool
+    with open(out_file) as f:
+        assert f.read().count('[Event ') == 3
+
+
+def test_game_state():
+    # Moves pack into 2 bytes each (and back)
+    for uci in ['e2e4', 'a7a8q', 'h2h1n', '0000']:
+        move = chess.Move.from_uci(uci)
+        assert unpack_move(pack_move(move)) == move, uci
+
+    # However long the game, the board only keeps the moves it needs
+    game = GameState()
+    shuffle = [chess.Move.from_uci(m)
+               for m in ['g1f3', 'g8f6', 'f3g1', 'f6g8']]
+    for move in [chess.Move.from_uci('e2e4')] + shuffle * 20:
+        game.push(move, Ply(seconds=1))
+    assert len(game.moves) == 81 and game.moves.itemsize == 2
+    assert len(game.board.move_stack) <= 80 + SLACK
+    game.push(chess.Move.from_uci('e7e5'))
+    for move in shuffle * 20:
+        game.push(move)
+    assert len(game.board.move_stack) <= game.board.halfmove_clock + SLACK
+    # (and can still tell a repetition, or if the last move was a capture)
+    assert game.board.is_repetition(), game.board
+    assert game.seconds(chess.WHITE) == 41 and game.seconds(chess.BLACK) == 40
+
+    # The whole game can be rebuilt (e.g. to take moves back past the
+    # ones the board kept)
+    full = game.full_board()
+    assert full.fen() == game.board.fen()
+    assert full.move_stack == game.move_list()
+    while game.moves:
+        game.pop()
+    assert game.board.fen() == chess.Board().fen(), game.board
+    game.set_fen('7k/5KQ1/8/8/8/8/8/8 w - - 0 1')
+    assert game.move_list() == [] and game.full_board() == game.board
+
+
 main()
@@ -0,0 +1,122 @@
+from chess.engine import Cp
+
+
+class TimeManager():
+    """
+    Decides how much of the turn time stockfish should actually use.
+    Obvious moves (like a recapture) get only a little of it,
+    and the search stops early once the ranking settles down,
+    while critical positions (the best move keeps changing, its score
+    swings, or it is barely better than the next best) get to use all of it.
+    The turn time is never exceeded
+    """
+
+    # What share of the turn a move gets before we are happy to stop
+    # (if the ranking has settled)
+    normal_share = 0.5
+    # ... and for a move that is probably obvious (like a recapture)
+    obvious_share = 0.1
+
+    # How many depths in a row the best move has to stay the best
+    stable_depths = 4
+    # A best move this much better than the next best is obvious
+    obvious_margin = Cp(150)
+    # A best move this little better than the next best is critical
+    critical_margin = Cp(30)
+    # A best score that moves this much between depths is critical
+    critical_swing = 50
+    # The least time (in seconds) a search is given, even if the turn
+    # time is already used up (e.g. by pondering that came to nothing)
+    min_time = 0.1
+
+    def __init__(self):
+        self.soft_time = 0
+        self.hard_time = 0
+        # The (depth, best move, best score, margin) of each finished depth
+        self.history = []
+
+    def allocate(self, board, turn_time):
+        """
+        Given the most time (in seconds) we can spend thinking this turn,
+        decide how long we would like to spend on this board,
+        returning the (soft) time after which we are happy to stop,
+        and the (hard) time we can never go past
+        """
+        share = self.normal_share
+        if self.is_recapture(board):
+            share = self.obvious_share
+
+        self.soft_time = turn_time * share
+        self.hard_time = turn_time
+        self.history = []
+        return self.soft_time, self.hard_time
+
+    def is_recapture(self, board):
+        """
+        Check if our opponent just took a piece, that we can take back
+        """
+        if not board.move_stack:
+            return False
+        last = board.peek()
+        board.pop()
+        was_capture = board.is_capture(last)
+        board.push(last)
+        return was_capture and any(
+            m.to_square == last.to_square for m in board.legal_moves
+            if board.is_capture(m))
+
+    def record(self, depth, best_move, best_score, second_score=None):
+        """
+        Given the ranking stockfish came up with at a depth
+        (scores from our point of view)
+        """
+        if self.history and self.history[-1][0] == depth:
+            self.history.pop()
+        margin = None
+        if second_score is not None:
+            margin = score_cp(best_score) - score_cp(second_score)
+        self.history.append((depth, best_move, best_score, margin))
+
+    def is_critical(self):
+        """
+        Check if the ranking is still up in the air
+        (best move changing, its score swinging, or a close second)
+        """
+        recent = self.history[-self.stable_depths:]
+        if len(recent) < self.stable_depths:
+            return True
+        if len({best_move for _, best_move, _, _ in recent}) > 1:
+            return True
+        scores = [score_cp(score) for _, _, score, _ in recent]
+        if max(scores) - min(scores) > self.critical_swing:
+            return True
+        margin = recent[-1][3]
+        return margin is not None and margin < self.critical_margin.score()
+
+    def is_obvious(self):
+        """
+        Check if the best move has been the best for a while,
+        and by a long way
+        """
+        margin = self.history[-1][3] if self.history else None
+        return (not self.is_critical() and margin is not None and
+                margin >= self.obvious_margin.score())
+
+    def should_stop(self, elapsed):
+        """
+        Given how long we have been searching, check if we can stop now
+        """
+        if elapsed >= self.hard_time * self.obvious_share:
+            if self.is_obvious():
+                return True
+        if elapsed >= self.soft_time:
+            return not self.is_critical()
+        return False
+
+
+def score_cp(score):
+    """
+    A score in centipawns, counting mates as very large scores
+    (so scores can be compared, subtracted, etc)
+    """
+    return score.score(mate_score=100000)
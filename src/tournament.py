@@ -0,0 +1,316 @@
+import argparse
+import itertools
+import math
+import os
+import random as rand
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import timedelta
+
+import chess
+import chess.pgn
+
+import engine_pool
+import eval_cache
+import opening_book
+import tablebase
+from journal import MemoryJournal
+from opening_book import parse_games
+from referee import Referee
+from stockfish_player import StockfishPlayer
+
+# How many games each worker plays before handing back its results
+CHUNK_SIZE = 10
+
+
+class Entrant():
+    """
+    One of the stockfish player setups playing in a tournament,
+    e.g. 'weak:difficulty=0.3,time=0.1,strength=skill'.
+    An adapting entrant keeps its difficulty from game to game (changing
+    after each win or loss, by 'step', and carried on from one chunk of
+    games to the next), otherwise it starts every game on the difficulty
+    it was given
+    """
+
+    def __init__(self, name, difficulty=0.5, time=0.1, strength='sample',
+                 multipv=True, adapt=False, step=None):
+        self.name = name
+        self.difficulty = difficulty
+        self.time = time
+        self.strength = strength
+        self.multipv = multipv
+        self.adapt = adapt
+        self.step = step
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Create from 'name:key=value,key=value'
+        """
+        name, _, settings = text.partition(':')
+        kwargs = {}
+        for setting in filter(None, settings.split(',')):
+            key, _, value = setting.partition('=')
+            if key in ('difficulty', 'time', 'step'):
+                kwargs[key] = float(value)
+            elif key in ('multipv', 'adapt'):
+                kwargs[key] = value.lower() in ('1', 'true', 'yes')
+            elif key == 'strength':
+                kwargs[key] = value
+            else:
+                raise ValueError(f'Unknown setting "{key}" for {name}')
+        return cls(name, **kwargs)
+
+    def make_player(self, difficulty=None):
+        """
+        Create a player with this setup (or, if given, on another
+        difficulty), which never touches the store
+        (nor thinks on its opponent's time, so the engines are shared fairly)
+        """
+        if difficulty is None:
+            difficulty = self.difficulty
+        player = StockfishPlayer(
+            difficulty=difficulty, turn_time=timedelta(seconds=self.time),
+            multipv=self.multipv, strength=self.strength, persist=False,
+            can_ponder=False)
+        if self.step is not None:
+            player.difficulty_step = self.step
+        return player
+
+    def __str__(self):
+        return self.name
+
+
+def random_opening(rng, plies):
+    """
+    Return a board after the given number of random (legal) moves,
+    so games between the same players don't all play out the same
+    """
+    board = chess.Board()
+    for _ in range(plies):
+        moves = list(board.legal_moves)
+        if not moves:
+            break
+        board.push(rng.choice(moves))
+    return board
+
+
+def play_chunk(first, second, games, seed, opening_plies,
+               difficulties=(None, None)):
+    """
+    Play a number of games between two entrants (in a worker process),
+    each opening played twice, with the colours swapped.
+    Adapting entrants start on the given difficulties (where they left
+    off in the pairing's last chunk, see Tournament.run).
+    Returns the PGN text of each game, along with the result (from the
+    first entrant's point of view: 1 for a win, .5 a draw, 0 a loss),
+    and both entrants' difficulties at the end
+    """
+    # Every worker has its own engine, and its own (in memory) cache,
+    # so workers never step on each other, and no book or tables,
+    # so the games are down to the entrants' setups alone
+    engine_pool.POOL.size = 1
+    eval_cache.CACHE = eval_cache.EvalCache(None)
+    opening_book.BOOK = opening_book.OpeningBook(None, None)
+    tablebase.TABLEBASE = tablebase.Tablebase(None)
+
+    rng = rand.Random(seed)
+    players = {entrant: entrant.make_player(difficulty if entrant.adapt
+                                            else None)
+               for entrant, difficulty in zip((first, second), difficulties)}
+    journal = MemoryJournal()
+    results = []
+    try:
+        for game in range(games):
+            if game % 2 == 0:
+                opening = random_opening(rng, opening_plies)
+            white, black = (first, second) if game % 2 == 0 else \
+                (second, first)
+            for entrant in (first, second):
+                if not entrant.adapt:
+                    players[entrant] = entrant.make_player()
+
+            referee = Referee(players[white], players[black], journal=journal)
+            difficulties = (players[white].difficulty,
+                            players[black].difficulty)
+            referee.play_game(opening.copy())
+
+            result = referee.board.result()
+            score = {'1-0': 1, '0-1': 0}.get(result, 0.5)
+            if white is not first:
+                score = 1 - score
+            results.append((to_pgn(journal, white, black, difficulties),
+                            score))
+    finally:
+        engine_pool.POOL.close()
+    return (first.name, second.name, results,
+            (players[first].difficulty, players[second].difficulty))
+
+
+def to_pgn(journal, white, black, difficulties):
+    """
+    Return the PGN text of the game just played
+    (the moves come from the journal, as resigning changes the board)
+    """
+    fen, moves, result = parse_games(journal.game_records())[0]
+    game = chess.pgn.Game()
+    if fen != chess.STARTING_FEN:
+        game.setup(fen)
+    node = game
+    for move in moves:
+        node = node.add_variation(move)
+    game.headers['Event'] = 'Tournament'
+    game.headers['White'] = white.name
+    game.headers['Black'] = black.name
+    game.headers['Result'] = result
+    game.headers['WhiteDifficulty'] = f'{difficulties[0]:.2f}'
+    game.headers['BlackDifficulty'] = f'{difficulties[1]:.2f}'
+    return str(game)
+
+
+def elo(scores):
+    """
+    Given the results of games (1 win, .5 draw, 0 loss), return the Elo
+    difference they suggest, and the margin of its 95% confidence interval
+    """
+    n = len(scores)
+    mean = sum(scores) / n
+    deviation = math.sqrt(sum((s - mean) ** 2 for s in scores) / n)
+    margin = 1.96 * deviation / math.sqrt(n)
+
+    def to_elo(p):
+        # (a perfect score has no finite Elo, so keep it just short)
+        p = min(max(p, 0.001), 0.999)
+        return -400 * math.log10(1 / p - 1)
+
+    low, high = to_elo(mean - margin), to_elo(mean + margin)
+    return to_elo(mean), (high - low) / 2
+
+
+class Tournament():
+    """
+    Plays every pair of entrants against each other (a round robin),
+    spreading the games across a pool of processes (one per core),
+    without any of the file writing of real games
+    """
+
+    def __init__(self, entrants, games=100, workers=None, seed=0,
+                 opening_plies=4, pgn_file=None):
+        """
+        Each pair of entrants plays 'games' games
+        (rounded up to an even number, so both get each colour equally)
+        """
+        self.entrants = entrants
+        self.games = games + games % 2
+        self.workers = workers or os.cpu_count() or 1
+        self.seed = seed
+        self.opening_plies = opening_plies
+        self.pgn_file = pgn_file
+        # (first, second) entrant names to the first's results
+        self.scores = {}
+
+    def chunks(self):
+        """
+        Split each pairing's games up into chunks of work for the workers
+        (each an even number of games, for the colour swapping),
+        yielding a list of the chunks for each pairing
+        """
+        seeds = itertools.count(self.seed)
+        for first, second in itertools.combinations(self.entrants, 2):
+            yield [(first, second, min(CHUNK_SIZE, self.games - start),
+                    next(seeds), self.opening_plies)
+                   for start in range(0, self.games, CHUNK_SIZE)]
+
+    def run(self):
+        """
+        Play all of the games, writing each one to the PGN file as it
+        comes in, and return the summary table
+        """
+        pgn = open(self.pgn_file, 'w') if self.pgn_file else None
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                # Each future, to the chunks of its pairing still to come
+                # (a pairing with an adapting entrant plays its chunks one
+                # after another, each carrying on from the last one's
+                # difficulties, the others play them all at once)
+                waiting = {}
+                for chunks in self.chunks():
+                    first, second = chunks[0][:2]
+                    if first.adapt or second.adapt:
+                        waiting[executor.submit(play_chunk, *chunks[0])] = \
+                            chunks[1:]
+                    else:
+                        for chunk in chunks:
+                            waiting[executor.submit(play_chunk, *chunk)] = []
+                while waiting:
+                    done, _ = wait(waiting, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.record(future.result(), pgn)
+                        chunks = waiting.pop(future)
+                        if chunks:
+                            difficulties = future.result()[3]
+                            waiting[executor.submit(
+                                play_chunk, *chunks[0], difficulties)] = \
+                                chunks[1:]
+        finally:
+            if pgn is not None:
+                pgn.close()
+        return self.summary()
+
+    def record(self, chunk_result, pgn):
+        """
+        Keep the results of a chunk of games, writing each game to the
+        PGN file (if there is one)
+        """
+        first, second, results, _ = chunk_result
+        for text, score in results:
+            self.scores.setdefault((first, second), []).append(score)
+            if pgn is not None:
+                pgn.write(f'{text}\n\n')
+        print(f'{first} vs {second}: '
+              f'{len(self.scores[first, second])} games done')
+
+    def summary(self):
+        """
+        Return a table of how each pairing went
+        """
+        lines = [f'{"Pairing":<30} {"Games":>5} {"W-D-L":>11} '
+                 f'{"Score":>6} {"Elo":>14}']
+        for (first, second), scores in self.scores.items():
+            wins, draws = scores.count(1), scores.count(0.5)
+            losses = len(scores) - wins - draws
+            difference, margin = elo(scores)
+            lines.append(
+                f'{first + " vs " + second:<30} {len(scores):>5} '
+                f'{f"{wins}-{draws}-{losses}":>11} '
+                f'{sum(scores) / len(scores):>6.1%} '
+                f'{f"{difference:+.0f} +/- {margin:.0f}":>14}')
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Play stockfish player setups against each other, e.g. '
+                    'python src/tournament.py '
+                    '"weak:difficulty=0.3" "strong:difficulty=0.9"')
+    parser.add_argument('entrants', nargs='+',
+                        help='name:key=value,... with keys difficulty, '
+                             'time (seconds per turn), strength (sample or '
+                             'skill), multipv, adapt, step')
+    parser.add_argument('--games', type=int, default=100,
+                        help='games per pairing')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--opening-plies', type=int, default=4)
+    parser.add_argument('--pgn', default='assets/tournament.pgn')
+    args = parser.parse_args()
+
+    entrants = [Entrant.parse(text) for text in args.entrants]
+    tournament = Tournament(entrants, games=args.games, workers=args.workers,
+                            seed=args.seed, opening_plies=args.opening_plies,
+                            pgn_file=args.pgn)
+    print(tournament.run())
+
+
+if __name__ == '__main__':
+    main()